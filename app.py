@@ -1,12 +1,34 @@
-from flask import render_template, request, redirect, url_for, flash, session
+from flask import Response, abort, jsonify, render_template, request, redirect, url_for, flash, session
 from sqlalchemy.exc import IntegrityError
-from datetime import datetime, date
-from config import app, db
+from sqlalchemy import select, union
+from sqlalchemy.orm import aliased, joinedload
+from datetime import datetime, date, timedelta
+from config import app, db, current_branch
 from models import (
     Patient, Doctor, Department, Treatment,
-    Appointment, Appointment_status,
-    insert_departments, insert_doctors
+    Appointment, Appointment_status, Medicine, WaitlistEntry
 )
+from catalog import catalog
+from fragments import conditional_page
+from ids import next_patient_id, next_doctor_id, next_appointment_id
+from migrations import check_schema
+from pagination import keyset_paginate, paginate_from_args
+from timeline import patient_timeline, invalidate_timeline, invalidate_all_timelines
+from search import match_expression, search_treatments
+from exports import DATASETS, csv_chunks, export_filters, gzip_chunks
+from archive import SOURCES as ARCHIVE_SOURCES, all_appointments, archived_through
+import stats
+import branches
+import medicines
+import openings
+import waitlist
+import keys
+from slots import availability, claim_slot, default_slot_labels, is_valid_slot
+import bulk  # registers the import-data / export-data commands
+import query_plans  # registers the check-query-plans command
+import metrics  # request instrumentation and the /metrics route
+import serve  # registers the serve command
+import assets  # fingerprinted static URLs and the assets command
 
 # Jinja date filter
 @app.template_filter('date')
@@ -15,11 +37,31 @@ def date_filter(dt, format='%Y-%m-%d'):
         return dt.strftime(format)
     return dt
 
-# Create tables
-with app.app_context():
-    db.create_all()
-    insert_departments()
-    insert_doctors()
+# url for the current page with some query string arguments replaced
+@app.template_global()
+def modify_query(**updates):
+    args = request.args.to_dict()
+    for key, value in updates.items():
+        if value is None:
+            args.pop(key, None)
+        else:
+            args[key] = value
+    return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+# Importing this module only registers routes and commands. Creating and
+# seeding the database is done once with `flask init-db` and `flask seed`;
+# a serving process just checks the stored schema version (one query).
+def create_app():
+    with app.app_context():
+        check_schema()
+    return app
+
+# ?<name>=YYYY-MM-DD from the query string, or `default`
+def date_arg(name, default):
+    try:
+        return date.fromisoformat(request.args[name])
+    except (KeyError, ValueError):
+        return default
 
 #connection to html pages through routing
 @app.route('/')
@@ -41,6 +83,7 @@ def login():
         patient = Patient.query.filter_by(patient_name=username, password=password).first()
         if patient:
             session['user_type'] = "patient"
+            session['branch'] = current_branch()
             session['patient_id'] = patient.patient_id
             session['patient_name'] = patient.patient_name
             return redirect(url_for('patient_dashboard'))
@@ -49,6 +92,7 @@ def login():
         if doctor:
             if username == doctor.doctor_name and password == "doctor":
                 session['user_type'] = "doctor"
+                session['branch'] = current_branch()
                 session['doctor_id'] = doctor.doctor_id
                 session['doctor_name'] = doctor.doctor_name
                 return redirect(url_for('doctor_dashboard'))
@@ -62,29 +106,174 @@ def login():
 #rendering the html admin page
 @app.route('/admin', methods=['GET'])
 def admin_dashboard():
-    doctors = Doctor.query.all()
-    patients = Patient.query.all()
-    appointments = Appointment.query.all()
-    
-    total_doctors = len(doctors)
-    total_patients = len(patients)
-    total_appointments = len(appointments)
-
-    # Include patient object in appointments for table display
-    appointments_with_patient = []
-    for appt in appointments:
-        patient = Patient.query.get(appt.patient_id)
-        appt.patient = patient
-        appointments_with_patient.append(appt)
+    # running totals maintained by stats.py, one small query
+    totals = stats.totals()
+
+    # one keyset-paginated query per table, joins loaded eagerly; the doctor
+    # table is a cached fragment, so its query only runs when it is rendered
+    def load_doctors():
+        return paginate_from_args(
+            Doctor.query.options(joinedload(Doctor.department)),
+            request.args, 'doctors',
+            sorts={
+                'id': Doctor.doctor_id,
+                'name': Doctor.doctor_name,
+                'department': Doctor.department_id,
+            },
+            key_column=Doctor.doctor_id,
+            default_sort='id'
+        )
+    patients = paginate_from_args(
+        Patient.query,
+        request.args, 'patients',
+        sorts={
+            'id': Patient.patient_id,
+            'name': Patient.patient_name,
+        },
+        key_column=Patient.patient_id,
+        default_sort='id'
+    )
+    appointments = paginate_from_args(
+        Appointment.query.options(joinedload(Appointment.patient)),
+        request.args, 'appointments',
+        sorts={
+            'id': Appointment.appointment_id,
+            'date': Appointment.date,
+            'doctor': Appointment.doctor_name,
+            'status': Appointment.status,
+        },
+        key_column=Appointment.appointment_id,
+        default_sort='id'
+    )
 
     return render_template(
         'admin.html',
-        doctors=doctors,
+        load_doctors=load_doctors,
         patients=patients,
-        appointments=appointments_with_patient,
-        total_doctors=total_doctors,
-        total_patients=total_patients,
-        total_appointments=total_appointments
+        appointments=appointments,
+        total_doctors=totals['doctors'],
+        total_patients=totals['patients'],
+        total_appointments=totals['appointments'],
+        export_doctors=catalog.doctors(),
+        export_departments=catalog.departments(),
+        statuses=list(Appointment_status.__members__)
+    )
+
+#streaming CSV export of one table for admin dashboard
+@app.route('/admin/export/<string:dataset>', methods=['GET'])
+def admin_export(dataset):
+    if session.get('user_type') != "admin":
+        return redirect(url_for('login'))
+    if dataset not in DATASETS:
+        abort(404)
+
+    # the body is generated after this view returns, outside the app context
+    chunks = csv_chunks(DATASETS[dataset](export_filters(request.args)), db.engine)
+    filename = f"{dataset}-{date.today().isoformat()}.csv"
+    mimetype = 'text/csv; charset=utf-8'
+    if request.args.get('gzip') == '1':
+        chunks = gzip_chunks(chunks)
+        filename += '.gz'
+        mimetype = 'application/gzip'
+
+    return Response(chunks, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"'
+    })
+
+#rendering the appointment statistics for admin dashboard
+@app.route('/admin/reports', methods=['GET'])
+def admin_reports():
+    if session.get('user_type') != "admin":
+        return redirect(url_for('login'))
+    start = date_arg('start', date.today() - timedelta(days=30))
+    end = date_arg('end', date.today() + timedelta(days=30))
+
+    doctor_rows = stats.by_doctor(start, end)
+
+    return render_template(
+        'reports.html',
+        start=start,
+        end=end,
+        statuses=stats.status_columns(),
+        totals=stats.totals(),
+        days=stats.by_day(start, end),
+        doctors=[(name, counts) for _, name, counts in doctor_rows],
+        departments=stats.by_department(doctor_rows)
+    )
+
+#switching the branch the following pages show, for URLs without a branch prefix
+@app.route('/branches/<string:name>', methods=['GET'])
+def select_branch(name):
+    if name not in branches.names():
+        abort(404)
+    # a patient or doctor login belongs to one branch
+    if session.get('user_type') in ('patient', 'doctor') and session.get('branch') != name:
+        session.clear()
+    session['branch'] = name
+    if session.get('user_type') == "admin":
+        return redirect(url_for('admin_dashboard'))
+    return redirect(url_for('index'))
+
+#rendering the statistics of all branches for admin dashboard
+@app.route('/admin/branches', methods=['GET'])
+def admin_branches():
+    if session.get('user_type') != "admin":
+        return redirect(url_for('login'))
+    start = date_arg('start', date.today() - timedelta(days=30))
+    end = date_arg('end', date.today() + timedelta(days=30))
+
+    # every branch at once, so the page takes as long as the slowest branch
+    summaries, errors = branches.fan_out(lambda: stats.summary(start, end))
+    merged = stats.merge(summaries.values())
+
+    return render_template(
+        'branches.html',
+        start=start,
+        end=end,
+        statuses=stats.status_columns(),
+        branches=[(branch, summaries.get(branch), errors.get(branch)) for branch in branches.names()],
+        totals=merged['totals'],
+        period=merged['period'],
+        departments=merged['departments'],
+        days=merged['days']
+    )
+
+#rendering the medicine prescribing report for admin dashboard
+@app.route('/admin/medicines', methods=['GET'])
+def admin_medicines():
+    if session.get('user_type') != "admin":
+        return redirect(url_for('login'))
+    today = date.today()
+    start = date_arg('start', today.replace(day=1))
+    end = date_arg('end', today)
+    query = request.args.get('q', '')
+
+    overall, departments = medicines.top_medicines(start, end)
+    return render_template(
+        'medicines.html',
+        start=start,
+        end=end,
+        q=query,
+        found=medicines.find(query) if query else [],
+        overall=overall,
+        departments=departments
+    )
+
+#rendering the patients on one medicine for admin dashboard
+@app.route('/admin/medicines/<int:medicine_id>', methods=['GET'])
+def medicine_patients(medicine_id):
+    if session.get('user_type') != "admin":
+        return redirect(url_for('login'))
+    medicine = db.session.get(Medicine, medicine_id)
+    if not medicine:
+        abort(404)
+    since = date_arg('since', date.today() - timedelta(days=app.config['MEDICINE_CURRENT_DAYS']))
+
+    return render_template(
+        'medicine_patients.html',
+        medicine=medicine,
+        since=since,
+        patients=medicines.patients_on(medicine_id, since, request.args.get('cursor'))
     )
 
 #rendering the html register page
@@ -101,11 +290,7 @@ def register():
             return redirect(url_for('register'))
 
         # Auto-generate patient ID (P001, P002...)
-        last_patient = Patient.query.order_by(Patient.patient_id.desc()).first()
-        if last_patient:
-            new_patient_id = 'P' + str(int(last_patient.patient_id[1:]) + 1).zfill(3)
-        else:
-            new_patient_id = 'P001'
+        new_patient_id = next_patient_id()
 
         # Save new patient including password
         new_patient = Patient(
@@ -116,6 +301,7 @@ def register():
 
         try:
             db.session.add(new_patient)
+            stats.patient_added()
             db.session.commit()
             flash('Account created successfully!', 'success')
             return redirect(url_for('login'))
@@ -132,29 +318,92 @@ def doctor_dashboard():
     if session.get('user_type') != "doctor":
         return redirect(url_for('login'))
 
-    doctor_name = session.get('doctor_name')
+    # looked up by code, so a renamed doctor keeps their dashboard
+    doctor = catalog.doctor(session.get('doctor_id'))
+    if not doctor:
+        return redirect(url_for('login'))
 
-    # JOIN Appointment with Patient table
-    appointments = (
-        db.session.query(Appointment, Patient)
-        .join(Patient, Appointment.patient_id == Patient.patient_id)
-        .filter(Appointment.doctor_name == doctor_name)
-        .all()
+    # worklist window, today and the next WORKLIST_DAYS days by default
+    start = date_arg('start', date.today())
+    end = date_arg('end', start + timedelta(days=app.config['WORKLIST_DAYS']))
+    status = request.args.get('status')
+    if status not in Appointment_status.__members__:
+        status = None
+
+    # windows reaching back into archived days read live and archived rows
+    archived = archived_through(doctor.doctor_key)
+    source = Appointment
+    if archived and start <= archived:
+        source = aliased(Appointment, all_appointments())
+
+    worklist = db.session.query(source).options(joinedload(source.patient)).filter(
+        source.doctor_key == doctor.doctor_key,
+        source.date >= start,
+        source.date <= end
+    )
+    if status:
+        worklist = worklist.filter(source.status == Appointment_status[status])
+    appointments = paginate_from_args(
+        worklist,
+        request.args, 'appointments',
+        sorts={'date': source.date},
+        key_column=source.appointment_id,
+        default_sort='date'
     )
 
-    # Get unique completed patients
-    completed_patients = {}
-    for appt, patient in appointments:
-        if appt.status == Appointment_status.Completed:
-            completed_patients[patient.patient_id] = patient
+    # every patient this doctor has completed an appointment with, once each
+    # (UNION drops the duplicates across live and archived appointments)
+    completed_keys = union(*[
+        select(appointment.patient_key).where(
+            appointment.doctor_key == doctor.doctor_key,
+            appointment.status == Appointment_status.Completed
+        )
+        for appointment, _ in ARCHIVE_SOURCES
+    ]).subquery('completed')
+    completed = (
+        db.session.query(Patient.patient_id, Patient.patient_name)
+        .join(completed_keys, completed_keys.c.patient_key == Patient.patient_key)
+    )
+    completed_patients = keyset_paginate(
+        completed, Patient.patient_name, Patient.patient_id,
+        cursor=request.args.get('patients_cursor'),
+        key=lambda row: [row.patient_name, row.patient_id]
+    )
 
     return render_template(
         'doctor.html',
-        doctor_name=doctor_name,
+        doctor_name=doctor.doctor_name,
         appointments=appointments,
-        completed_patients=completed_patients.values()  # only unique patients
+        completed_patients=completed_patients,
+        start=start,
+        end=end,
+        status=status,
+        statuses=list(Appointment_status.__members__)
     )
 
+#rendering the treatment search for doctor dashboard
+@app.route('/doctor/search', methods=['GET'])
+def search_records():
+    if session.get('user_type') != "doctor":
+        return redirect(url_for('login'))
+
+    doctor = catalog.doctor(session.get('doctor_id'))
+    if not doctor:
+        return redirect(url_for('login'))
+
+    terms = request.args.get('q', '').strip()
+    mine = request.args.get('mine') == '1'
+
+    results = None
+    if match_expression(terms):
+        results = search_treatments(
+            terms,
+            cursor=request.args.get('cursor'),
+            doctor_name=doctor.doctor_name if mine else None
+        )
+
+    return render_template('search.html', terms=terms, mine=mine, results=results)
+
 #rendering the html patient dashboard
 @app.route('/patient', methods=['GET'])
 def patient_dashboard():
@@ -163,88 +412,83 @@ def patient_dashboard():
 
     patient_name = session.get('patient_name')
 
-    # Fetch all departments
-    departments = Department.query.all()
-
-    return render_template(
-        'patient.html',
-        patient_name=patient_name,
-        departments=departments
+    # the page only changes with the catalog and the patient's own name
+    return conditional_page(
+        lambda: render_template(
+            'patient.html',
+            patient_name=patient_name,
+            departments=catalog.departments()
+        ),
+        'patient_dashboard', session.get('patient_id'), patient_name
     )
 
 #rendering to view doctors
 @app.route('/view_doctors/<int:department_id>')
 def view_doctors(department_id):
-
-    department = Department.query.get(department_id)
-    doctors = Doctor.query.filter_by(department_id=department_id).all()
-
-    return render_template(
-        'doctor_list.html',
-        department=department,
-        doctors=doctors
+    department = catalog.department(department_id)
+    if not department:
+        abort(404)
+
+    return conditional_page(
+        lambda: render_template(
+            'doctor_list.html',
+            department=department,
+            doctors=catalog.doctors_in(department_id)
+        ),
+        'view_doctors', department_id
     )
 
-#rendering to see patient past history
-@app.route('/past_history/<string:patient_id>')
-def past_history(patient_id):
-    patient = Patient.query.get(patient_id)
+def render_timeline(template, patient_id):
+    timeline = patient_timeline(patient_id, request.args.get('cursor'))
 
-    if not patient:
+    if not timeline:
         flash("Patient not found!", "error")
         return redirect(url_for('doctor_dashboard'))
-    treatments = (
-        db.session.query(Treatment, Appointment)
-        .join(Appointment, Treatment.appointment_id == Appointment.appointment_id)
-        .filter(Treatment.patient_id == patient_id)
-        .all()
-    )
 
-    return render_template('past_history.html', patient=patient,treatments=treatments)
+    return render_template(template, patient=timeline.patient, timeline=timeline)
+
+#rendering to see patient past history
+@app.route('/past_history/<string:patient_id>')
+def past_history(patient_id):
+    return render_timeline('past_history.html', patient_id)
 
 #rendering to see patient past history from patient dashboard
 @app.route('/history/<string:patient_id>')
 def history(patient_id):
-    patient = Patient.query.get(patient_id)
-
-    if not patient:
-        flash("Patient not found!", "error")
-        return redirect(url_for('doctor_dashboard'))
-    treatments = (
-        db.session.query(Treatment, Appointment)
-        .join(Appointment, Treatment.appointment_id == Appointment.appointment_id)
-        .filter(Treatment.patient_id == patient_id)
-        .all()
-    )
-
-    return render_template('history.html', patient=patient,treatments=treatments)
+    return render_timeline('history.html', patient_id)
 
 #rendering to see patient past history from admin dashboard
 @app.route('/patient_history/<string:patient_id>')
 def patient_history(patient_id):
-    patient = Patient.query.get(patient_id)
-
-    if not patient:
-        flash("Patient not found!", "error")
-        return redirect(url_for('doctor_dashboard'))
-    treatments = (
-        db.session.query(Treatment, Appointment)
-        .join(Appointment, Treatment.appointment_id == Appointment.appointment_id)
-        .filter(Treatment.patient_id == patient_id)
-        .all()
-    )
-
-    return render_template('patient_history.html', patient=patient,treatments=treatments)
+    return render_timeline('patient_history.html', patient_id)
 
 #rendering to view doctor availability in patient dashboard
 @app.route('/availability')
 def check_availability():
-    return render_template('availability.html')
+    doctors = catalog.doctors()
+    doctor = None
+    chart = []
+
+    doctor_id = request.args.get('doctor_id')
+    if doctor_id:
+        doctor = catalog.doctor(doctor_id)
+        if doctor:
+            chart = availability(doctor)
+
+    return render_template('availability.html', doctors=doctors, doctor=doctor, chart=chart)
 
 #rendering to view doctor availability in doctor dashboard
 @app.route('/doc_availability')
 def doctor_availability():
-    return render_template('doctor_availability.html')
+    if session.get('user_type') != "doctor":
+        return redirect(url_for('login'))
+
+    doctor = catalog.doctor(session.get('doctor_id'))
+    if not doctor:
+        return redirect(url_for('login'))
+    chart = availability(doctor)
+
+    return render_template('doctor_availability.html', doctor=doctor, chart=chart)
 
 #render to logout page which will clear session
 @app.route('/logout',methods=['POST'])
@@ -257,13 +501,6 @@ def logout():
 def book_appointment():
     if session.get('user_type') != "patient":
         return redirect(url_for('login'))
-    
-    last_appointment = Appointment.query.order_by(Appointment.appointment_id.desc()).first()
-    
-    if last_appointment:
-        new_appointment_id = str(int(last_appointment.appointment_id) + 1)
-    else:
-        new_appointment_id = '101'
 
     if request.method == 'POST':
         patient_id = session.get('patient_id')             # Automatically taken from login session
@@ -271,21 +508,58 @@ def book_appointment():
         appointment_date = datetime.strptime(request.form['date'], "%Y-%m-%d").date()
         appointment_time = request.form['time']
 
-        new_appointment = Appointment(
-            appointment_id=new_appointment_id,
-            patient_id=patient_id,
-            doctor_name=doctor_name,
-            date=appointment_date,
-            time=appointment_time,
-            status=Appointment_status.Booked
-        )
+        doctor = catalog.doctor_by_name(doctor_name)
+        if not doctor or not is_valid_slot(doctor, appointment_date, appointment_time):
+            flash("The doctor does not work in that slot. Please choose another time.", "error")
+            return redirect(url_for('book_appointment'))
 
-        db.session.add(new_appointment)
-        db.session.commit()
+        appointment = claim_slot(next_appointment_id(), patient_id, doctor, appointment_date, appointment_time)
+        if not appointment:
+            flash("That slot has just been booked. Please choose another time.", "error")
+            return redirect(url_for('book_appointment'))
+        openings.booked(appointment)
+
+        flash("Appointment booked successfully!", "success")
+        return redirect(url_for('view_appointment'))
 
     # GET request → load doctors list
-    doctors = Doctor.query.all()
-    return render_template('book_appointment.html', doctors=doctors, today=date.today())
+    doctors = catalog.doctors()
+    return render_template(
+        'book_appointment.html',
+        doctors=doctors,
+        today=date.today(),
+        slot_labels=default_slot_labels(),
+        selected=request.args
+    )
+
+#rendering the earliest free slots in a department
+@app.route('/next_available/<int:department_id>')
+def next_available(department_id):
+    department = catalog.department(department_id)
+    if not department:
+        abort(404)
+    limit = min(request.args.get('n', app.config['SLOT_SEARCH_RESULTS'], type=int), 100)
+    found = openings.next_available(department_id, limit)
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(
+            department_id=department_id,
+            openings=[
+                {
+                    'doctor_id': opening.doctor.doctor_id,
+                    'doctor_name': opening.doctor.doctor_name,
+                    'date': opening.slot.day.isoformat(),
+                    'time': opening.slot.label,
+                }
+                for opening in found
+            ]
+        )
+    return render_template(
+        'next_available.html',
+        department=department,
+        openings=found,
+        days=app.config['SLOT_SEARCH_DAYS']
+    )
 
 #rendering to view appointment page
 @app.route('/view_appointment')
@@ -303,10 +577,74 @@ def view_appointment():
 @app.route('/cancel_appointment/<int:appointment_id>', methods=['POST'])
 def cancel_appointment(appointment_id):
     appointment = Appointment.query.get(appointment_id)
-    appointment.status = Appointment_status.Cancelled
+    cancelled, replacement = waitlist.cancel(appointment)
     db.session.commit()
+    if cancelled and not replacement:
+        openings.released([appointment])
     return redirect(url_for('view_appointment'))
 
+#rendering the patient's waitlist entries and the form to join one
+@app.route('/waitlist', methods=['GET', 'POST'])
+def waitlist_page():
+    if session.get('user_type') != "patient":
+        return redirect(url_for('login'))
+    patient_id = session.get('patient_id')
+
+    if request.method == 'POST':
+        kind, _, value = request.form.get('target', '').partition(':')
+        try:
+            start = datetime.strptime(request.form['start'], "%Y-%m-%d").date()
+            end = datetime.strptime(request.form['end'], "%Y-%m-%d").date()
+        except (KeyError, ValueError):
+            start = end = None
+        doctor = catalog.doctor_by_name(value) if kind == 'doctor' else None
+        department = catalog.department(int(value)) if kind == 'department' and value.isdigit() else None
+
+        if not doctor and not department:
+            flash("Please choose a doctor or a department.", "error")
+        elif not start or not end or start < date.today() or end < start:
+            flash("Please choose a date range from today on.", "error")
+        elif (end - start).days >= app.config['WAITLIST_MAX_DAYS']:
+            flash(f"A waitlist entry can cover at most {app.config['WAITLIST_MAX_DAYS']} days.", "error")
+        elif waitlist.open_entries(patient_id) >= app.config['WAITLIST_MAX_ENTRIES']:
+            flash(f"You can wait for at most {app.config['WAITLIST_MAX_ENTRIES']} slots at a time.", "error")
+        else:
+            waitlist.join(
+                patient_id, start, end,
+                doctor_name=doctor.doctor_name if doctor else None,
+                department_id=department.department_id if department else None
+            )
+            db.session.commit()
+            flash("You are on the waitlist. A cancelled slot will be booked for you automatically.", "success")
+        return redirect(url_for('waitlist_page'))
+
+    if request.args.get('doctor_name'):
+        selected = 'doctor:' + request.args['doctor_name']
+    else:
+        selected = 'department:' + request.args.get('department_id', '')
+    departments = catalog.departments()
+    today = date.today()
+    return render_template(
+        'waitlist.html',
+        entries=waitlist.entries(patient_id),
+        departments=departments,
+        department_names={dep.department_id: dep.department_name for dep in departments},
+        doctors=catalog.doctors(),
+        selected=selected,
+        today=today,
+        end=today + timedelta(days=13)
+    )
+
+#rendering to leave a waitlist
+@app.route('/waitlist/<int:entry_id>/leave', methods=['POST'])
+def leave_waitlist(entry_id):
+    if session.get('user_type') != "patient":
+        return redirect(url_for('login'))
+    if waitlist.withdraw(session.get('patient_id'), entry_id):
+        db.session.commit()
+        flash("You have left the waitlist.", "success")
+    return redirect(url_for('waitlist_page'))
+
 #rendering to mark as completed appointment
 @app.route('/complete_appointment/<int:appointment_id>', methods=['POST'])
 def complete_appointment(appointment_id):
@@ -319,8 +657,10 @@ def complete_appointment(appointment_id):
         flash("Appointment not found!", "error")
         return redirect(url_for('doctor_dashboard'))
 
-    # Update the status
-    appointment.status = Appointment_status.Completed
+    # only a booked appointment can be completed
+    if not stats.set_status(appointment, Appointment_status.Completed):
+        flash("Only booked appointments can be marked as completed.", "error")
+        return redirect(url_for('doctor_dashboard'))
     db.session.commit()
 
     flash("Appointment marked as completed!", "success")
@@ -330,10 +670,135 @@ def complete_appointment(appointment_id):
 @app.route('/doctor_cancel/<int:appointment_id>', methods=['POST'])
 def cancel_appointment_by_doctor(appointment_id):
     appointment = Appointment.query.get(appointment_id)
-    appointment.status = Appointment_status.Cancelled
+    cancelled, replacement = waitlist.cancel(appointment)
     db.session.commit()
+    if cancelled and not replacement:
+        openings.released([appointment])
     return redirect(url_for('doctor_dashboard'))
 
+# status changes the bulk endpoints accept
+BULK_ACTIONS = {
+    'complete': Appointment_status.Completed,
+    'cancel': Appointment_status.Cancelled,
+}
+
+# Applies one status change to many appointments in a single transaction and
+# returns (action, [(appointment_id, result), ...]) in the order the ids were
+# sent. `doctor_key` limits it to that doctor's appointments.
+def bulk_status_change(doctor_key=None):
+    if request.is_json:
+        data = request.get_json()
+        if not isinstance(data, dict):
+            abort(400, description="expected an object with action and appointment_ids")
+        action, values = data.get('action'), data.get('appointment_ids') or []
+    else:
+        action, values = request.form.get('action'), request.form.getlist('appointment_id')
+    if action not in BULK_ACTIONS:
+        abort(400, description="action must be one of " + ", ".join(BULK_ACTIONS))
+    if not isinstance(values, list) or len(values) > app.config['BULK_ACTION_LIMIT']:
+        abort(400, description=f"at most {app.config['BULK_ACTION_LIMIT']} appointments per request")
+    status = BULK_ACTIONS[action]
+
+    # each id once, in the order sent; anything that is not a number is kept
+    # as sent and reported as invalid
+    ids = []
+    for value in values:
+        try:
+            ids.append(int(value))
+        except (TypeError, ValueError):
+            ids.append(str(value))
+    ids = list(dict.fromkeys(ids))
+    wanted = {i for i in ids if isinstance(i, int)}
+
+    rows = {
+        row.appointment_id: row
+        for row in db.session.execute(
+            select(Appointment.appointment_id, Appointment.patient_id, Appointment.patient_key,
+                   Appointment.date, Appointment.time, Appointment.doctor_name,
+                   Appointment.doctor_key, Appointment.status)
+            .where(Appointment.appointment_id.in_(wanted))
+            .with_for_update()
+        )
+    } if wanted else {}
+    allowed = [row for row in rows.values() if doctor_key is None or row.doctor_key == doctor_key]
+    # ids for the waitlist bookings of the freed slots, taken before the first write
+    spare_ids = {}
+    if status == Appointment_status.Cancelled:
+        spare_ids = {
+            row.appointment_id: next_appointment_id()
+            for row in allowed if row.status == Appointment_status.Booked and row.date >= date.today()
+        }
+    changed = stats.set_statuses(allowed, status)
+    # freed slots go to the waitlist in the same transaction
+    refilled = set()
+    for row in allowed:
+        if row.appointment_id in changed and row.appointment_id in spare_ids:
+            if waitlist.backfill(row, spare_ids[row.appointment_id]):
+                refilled.add(row.appointment_id)
+    db.session.commit()
+    if status == Appointment_status.Cancelled:
+        openings.released([row for row in allowed if row.appointment_id in changed - refilled])
+
+    results = []
+    for appointment_id in ids:
+        row = rows.get(appointment_id)
+        if not isinstance(appointment_id, int):
+            result = 'invalid'
+        elif row is None:
+            result = 'not_found'
+        elif doctor_key is not None and row.doctor_key != doctor_key:
+            result = 'forbidden'
+        elif appointment_id in changed:
+            result = 'updated'
+        elif row.status == status:
+            result = 'unchanged'
+        elif row.status != Appointment_status.Booked:
+            result = 'invalid'  # only booked appointments are completed or cancelled
+        else:
+            result = 'conflict'  # changed by another request meanwhile
+        results.append((appointment_id, result))
+    return action, results
+
+# JSON for API clients, otherwise a summary message and back to the page
+def bulk_response(action, results, fallback):
+    if request.is_json or request.accept_mimetypes.best == 'application/json':
+        return jsonify(
+            action=action,
+            updated=sum(1 for _, result in results if result == 'updated'),
+            results=[{'appointment_id': i, 'result': result} for i, result in results]
+        )
+    counts = {}
+    for _, result in results:
+        counts[result] = counts.get(result, 0) + 1
+    if not results:
+        flash("No appointments selected.", "error")
+    else:
+        flash(", ".join(f"{count} {result.replace('_', ' ')}" for result, count in sorted(counts.items())),
+              "success" if counts.get('updated') else "error")
+    target = request.form.get('next', '')
+    if not target.startswith('/') or target.startswith('//'):
+        target = url_for(fallback)
+    return redirect(target)
+
+#bulk complete/cancel of the selected appointments on the doctor dashboard
+@app.route('/doctor/appointments/bulk', methods=['POST'])
+def doctor_bulk_action():
+    if session.get('user_type') != "doctor":
+        return redirect(url_for('login'))
+    doctor = catalog.doctor(session.get('doctor_id'))
+    if not doctor:
+        return redirect(url_for('login'))
+    action, results = bulk_status_change(doctor_key=doctor.doctor_key)
+    return bulk_response(action, results, 'doctor_dashboard')
+
+#bulk complete/cancel of the selected appointments on the admin dashboard
+@app.route('/admin/appointments/bulk', methods=['POST'])
+def admin_bulk_action():
+    if session.get('user_type') != "admin":
+        return redirect(url_for('login'))
+    action, results = bulk_status_change()
+    return bulk_response(action, results, 'admin_dashboard')
+
 #rendering to treatment page to add treatment for patient in doctor dashboard
 @app.route('/start_treatment/<int:appointment_id>', methods=['GET', 'POST'])
 def start_treatment(appointment_id):
@@ -343,13 +808,13 @@ def start_treatment(appointment_id):
         flash("Appointment not found!", "error")
         return redirect(url_for('doctor_dashboard'))
 
-    patient = Patient.query.get(appointment.patient_id)
+    patient = Patient.query.get(appointment.patient_key)
 
     if request.method == 'POST':
         test_done = request.form['test_done']
         diagnosis = request.form['diagnosis']
         prescription = request.form['prescription']
-        medicines = request.form['medicines']
+        medicine_text = request.form['medicines']
 
         # Check if treatment already exists
         existing_treatment = Treatment.query.filter_by(
@@ -362,20 +827,23 @@ def start_treatment(appointment_id):
             existing_treatment.test_done = test_done
             existing_treatment.diagnosis = diagnosis
             existing_treatment.prescription = prescription
-            existing_treatment.medicines = medicines
+            existing_treatment.medicines = medicine_text
         else:
             # INSERT query
             new_treatment = Treatment(
                 patient_id=appointment.patient_id,
+                patient_key=appointment.patient_key,
                 appointment_id=appointment_id,
                 test_done=test_done,
                 diagnosis=diagnosis,
                 prescription=prescription,
-                medicines=medicines,
+                medicines=medicine_text,
             )
             db.session.add(new_treatment)
+        medicines.record(db.session, appointment, medicine_text)
 
         db.session.commit()
+        invalidate_timeline(appointment.patient_id)
 
         flash("Treatment saved successfully!", "success")
         return redirect(url_for('doctor_dashboard'))
@@ -389,27 +857,38 @@ def start_treatment(appointment_id):
 #rendering to edit doctor page
 @app.route('/edit_doctor/<string:doctor_id>', methods=['GET', 'POST'])
 def edit_doctor(doctor_id):
-    doctor = Doctor.query.get(doctor_id)
+    doctor = Doctor.query.filter_by(doctor_id=doctor_id).first()
     
     if not doctor:
         flash("Doctor not found!", "error")
         return redirect(url_for('admin_dashboard'))
 
     if request.method == 'POST':
-        doctor.doctor_name = request.form['doctor_name']
+        old_name, new_name = doctor.doctor_name, request.form['doctor_name']
+        # doctors log in, and the waitlist and prescriptions are kept, by name
+        if new_name != old_name and Doctor.query.filter_by(doctor_name=new_name).first():
+            flash("Another doctor already has that name!", "error")
+            return redirect(url_for('admin_dashboard'))
+
+        doctor.doctor_name = new_name
         doctor.specialization = request.form['specialization']
         doctor.department_id = request.form['department_id']
+        keys.rename_doctor(doctor.doctor_key, old_name, new_name)
         db.session.commit()
+        catalog.invalidate()
+        if new_name != old_name:
+            openings.invalidate_all()
+            invalidate_all_timelines()
         flash("Doctor updated successfully!", "success")
         return redirect(url_for('admin_dashboard'))
 
-    departments = Department.query.all()
+    departments = catalog.departments()
     return render_template('edit_doctor.html', doctor=doctor, departments=departments)
 
 #rendering to delete doctor
 @app.route('/delete_doctor/<string:doctor_id>', methods=['POST'])
 def delete_doctor(doctor_id):
-    doctor = Doctor.query.get(doctor_id)
+    doctor = Doctor.query.filter_by(doctor_id=doctor_id).first()
     
     if not doctor:
         flash("Doctor not found!", "error")
@@ -417,7 +896,10 @@ def delete_doctor(doctor_id):
 
     # Delete the doctor
     db.session.delete(doctor)
+    waitlist.withdraw_doctor(doctor.doctor_name)
+    stats.doctor_removed()
     db.session.commit()
+    catalog.invalidate()
 
     flash("Doctor deleted successfully!", "success")
     return redirect(url_for('admin_dashboard'))
@@ -425,7 +907,7 @@ def delete_doctor(doctor_id):
 #rendering to edit patient
 @app.route('/edit_patient/<string:patient_id>', methods=['GET', 'POST'])
 def edit_patient(patient_id):
-    patient = Patient.query.get(patient_id)
+    patient = Patient.query.filter_by(patient_id=patient_id).first()
 
     if not patient:
         flash("Patient not found!", "error")
@@ -435,6 +917,7 @@ def edit_patient(patient_id):
         patient.patient_name = request.form['patient_name']
         patient.password = request.form['password']
         db.session.commit()
+        invalidate_timeline(patient_id)
 
         flash("Patient updated successfully!", "success")
         return redirect(url_for('admin_dashboard'))
@@ -444,14 +927,17 @@ def edit_patient(patient_id):
 #rendering to delete patient
 @app.route('/delete_patient/<string:patient_id>', methods=['POST'])
 def delete_patient(patient_id):
-    patient = Patient.query.get(patient_id)
+    patient = Patient.query.filter_by(patient_id=patient_id).first()
 
     if not patient:
         flash("Patient not found!", "error")
         return redirect(url_for('admin_dashboard'))
 
     db.session.delete(patient)
+    WaitlistEntry.query.filter_by(patient_id=patient_id).delete()
+    stats.patient_removed()
     db.session.commit()
+    invalidate_timeline(patient_id)
 
     flash("Patient deleted successfully!", "success")
     return redirect(url_for('admin_dashboard'))
@@ -464,13 +950,13 @@ def add_doctor():
         department_id = request.form['department_id']
         specialization = request.form['specialization']
 
+        # doctors log in, and the waitlist and prescriptions are kept, by name
+        if Doctor.query.filter_by(doctor_name=doctor_name).first():
+            flash("Another doctor already has that name!", "error")
+            return redirect(url_for('admin_dashboard'))
+
         # Auto-generate doctor ID (D001, D002, ...)
-        last_doctor = Doctor.query.order_by(Doctor.doctor_id.desc()).first()
-        if last_doctor:
-            next_id = int(last_doctor.doctor_id[1:]) + 1
-            doctor_id = f"D{next_id:03d}"
-        else:
-            doctor_id = "D001"
+        doctor_id = next_doctor_id()
 
         new_doctor = Doctor(
             doctor_id=doctor_id,
@@ -484,18 +970,26 @@ def add_doctor():
         dept.doctors_registered += 1
 
         db.session.add(new_doctor)
-        db.session.commit()
+        stats.doctor_added()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # the same name added by a concurrent request
+            db.session.rollback()
+            flash("Another doctor already has that name!", "error")
+            return redirect(url_for('admin_dashboard'))
+        catalog.invalidate()
 
         flash("Doctor added successfully!", "success")
         return redirect(url_for('admin_dashboard'))
 
-    departments = Department.query.all()
+    departments = catalog.departments()
     return render_template('add_doctor.html', departments=departments)
 
 #rendering to edit profile for admin dashboard
 @app.route('/edit_profile/<string:patient_id>', methods=['GET', 'POST'])
 def edit_profile(patient_id):
-    patient = Patient.query.get(patient_id)
+    patient = Patient.query.filter_by(patient_id=patient_id).first()
 
     if not patient:
         flash("Patient not found!", "error")
@@ -508,6 +1002,7 @@ def edit_profile(patient_id):
         patient.password = request.form['password']
 
         db.session.commit()
+        invalidate_timeline(patient_id)
         flash("Profile updated successfully!", "success")
         return redirect(url_for('patient_dashboard'))
 
@@ -516,7 +1011,7 @@ def edit_profile(patient_id):
 #rendering to view patient in admin dashboard
 @app.route('/view_patient/<string:patient_id>', methods=['GET'])
 def view_patient(patient_id):
-    patient = Patient.query.get(patient_id)
+    patient = Patient.query.filter_by(patient_id=patient_id).first()
 
     if not patient:
         flash("Patient not found!", "error")
@@ -527,6 +1022,7 @@ def view_patient(patient_id):
         patient=patient
     )
 
-# run flask app
+# development server, debugger on unless HMS_CONFIG=production;
+# production runs under gunicorn, see `flask serve` and wsgi.py
 if __name__ == '__main__':
-    app.run(debug=True, use_reloader=False)
\ No newline at end of file
+    create_app().run(use_reloader=False)
\ No newline at end of file
@@ -0,0 +1,183 @@
+from datetime import date, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, insert, select, union_all
+from sqlalchemy.exc import IntegrityError
+from config import app, db
+from models import Treatment, Appointment, Appointment_status, ArchivedAppointment, ArchivedTreatment
+
+# Hot/cold split of the appointment history. Completed and cancelled
+# appointments older than ARCHIVE_AFTER_DAYS move, with their treatments, to
+# appointment_archive / treatment_archive in chunked transactions, so the
+# live tables that every dashboard and booking query touches only hold recent
+# and upcoming rows. Reads that need the whole history go through the
+# unions below.
+
+# (appointment table, treatment table) for the live and the archived rows;
+# an appointment and its treatment are always archived together
+SOURCES = [(Appointment, Treatment), (ArchivedAppointment, ArchivedTreatment)]
+
+ARCHIVABLE = [Appointment_status.Completed, Appointment_status.Cancelled]
+
+APPOINTMENT_COLUMNS = [col.name for col in Appointment.__table__.columns]
+TREATMENT_COLUMNS = [col.name for col in Treatment.__table__.columns]
+
+# `columns` narrows the union to what the caller reads, which also keeps it
+# working for migrations that run before later columns are added
+def all_appointments(name='all_appointment', columns=APPOINTMENT_COLUMNS):
+    return union_all(
+        select(*[Appointment.__table__.c[n] for n in columns]),
+        select(*[ArchivedAppointment.__table__.c[n] for n in columns]),
+    ).subquery(name)
+
+# newest archived appointment date of a doctor, None when nothing is archived;
+# a date window after it can be served from the live table alone
+def archived_through(doctor_key):
+    return db.session.query(func.max(ArchivedAppointment.date)).filter(
+        ArchivedAppointment.doctor_key == doctor_key
+    ).scalar()
+
+def cutoff():
+    return date.today() - timedelta(days=current_app.config['ARCHIVE_AFTER_DAYS'])
+
+def totals(conn):
+    counts = {}
+    for appointment, treatment in SOURCES:
+        for model in (appointment, treatment):
+            counts[model.__tablename__] = conn.execute(select(func.count()).select_from(model)).scalar()
+    return {
+        'appointments': counts['appointment'] + counts['appointment_archive'],
+        'treatments': counts['treatment'] + counts['treatment_archive'],
+        'live_appointments': counts['appointment'],
+        'live_treatments': counts['treatment'],
+    }
+
+class CountMismatch(RuntimeError):
+    pass
+
+# Moves one chunk of appointments (and their treatments) in the caller's
+# transaction. Copies first, then deletes, and refuses to commit unless every
+# copied row was deleted from the live table and nothing else was.
+def move_chunk(conn, ids):
+    ids_filter = Appointment.appointment_id.in_(ids)
+    copied_treatments = conn.execute(insert(ArchivedTreatment).from_select(
+        TREATMENT_COLUMNS,
+        select(*[Treatment.__table__.c[n] for n in TREATMENT_COLUMNS]).where(Treatment.appointment_id.in_(ids))
+    )).rowcount
+    copied_appointments = conn.execute(insert(ArchivedAppointment).from_select(
+        APPOINTMENT_COLUMNS,
+        select(*[Appointment.__table__.c[n] for n in APPOINTMENT_COLUMNS]).where(ids_filter)
+    )).rowcount
+    deleted_treatments = conn.execute(delete(Treatment).where(Treatment.appointment_id.in_(ids))).rowcount
+    deleted_appointments = conn.execute(delete(Appointment).where(ids_filter)).rowcount
+    if (copied_appointments, copied_treatments) != (deleted_appointments, deleted_treatments) \
+            or copied_appointments != len(ids):
+        raise CountMismatch(
+            f"copied {copied_appointments} appointments / {copied_treatments} treatments, "
+            f"deleted {deleted_appointments} / {deleted_treatments} (chunk of {len(ids)})"
+        )
+    return copied_appointments, copied_treatments
+
+# Archives every completed or cancelled appointment dated before `before`,
+# chunk_size appointments per transaction, walking the primary key once.
+# Returns (appointments moved, treatments moved).
+def archive(before, chunk_size, echo=None):
+    moved_appointments = moved_treatments = 0
+    last_id = None
+    while True:
+        with db.engine.begin() as conn:
+            query = select(Appointment.appointment_id).where(
+                Appointment.date < before, Appointment.status.in_(ARCHIVABLE)
+            )
+            if last_id is not None:
+                query = query.where(Appointment.appointment_id > last_id)
+            ids = conn.execute(query.order_by(Appointment.appointment_id).limit(chunk_size)).scalars().all()
+            if not ids:
+                break
+            appointments, treatments = move_chunk(conn, ids)
+        last_id = ids[-1]
+        moved_appointments += appointments
+        moved_treatments += treatments
+        if echo:
+            echo(f"archived {moved_appointments} appointments, {moved_treatments} treatments")
+    return moved_appointments, moved_treatments
+
+# list of problems with the split, empty when live + archive is consistent
+def verify(conn):
+    problems = []
+    both = conn.execute(
+        select(func.count()).select_from(Appointment)
+        .join(ArchivedAppointment, ArchivedAppointment.appointment_id == Appointment.appointment_id)
+    ).scalar()
+    if both:
+        problems.append(f"{both} appointments are both live and archived")
+    orphans = conn.execute(
+        select(func.count()).select_from(ArchivedTreatment)
+        .outerjoin(ArchivedAppointment, ArchivedAppointment.appointment_id == ArchivedTreatment.appointment_id)
+        .where(ArchivedAppointment.appointment_id.is_(None))
+    ).scalar()
+    if orphans:
+        problems.append(f"{orphans} archived treatments have no archived appointment")
+    split = conn.execute(
+        select(func.count()).select_from(Treatment)
+        .join(ArchivedAppointment, ArchivedAppointment.appointment_id == Treatment.appointment_id)
+    ).scalar()
+    if split:
+        problems.append(f"{split} live treatments belong to archived appointments")
+    return problems
+
+archive_cli = AppGroup('archive', help='Move old appointments out of the live tables.')
+
+@archive_cli.command('run')
+@click.option('--before', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Archive appointments dated before this day (default: ARCHIVE_AFTER_DAYS ago).')
+@click.option('--chunk-size', type=int, help='Appointments per transaction (default: ARCHIVE_CHUNK_SIZE).')
+def run_command(before, chunk_size):
+    """Archive completed and cancelled appointments past the retention window."""
+    from stats import verify as verify_stats
+    from timeline import invalidate_all_timelines
+
+    before = before.date() if before else cutoff()
+    chunk_size = chunk_size or current_app.config['ARCHIVE_CHUNK_SIZE']
+
+    with db.engine.connect() as conn:
+        before_totals = totals(conn)
+    try:
+        appointments, treatments = archive(before, chunk_size, echo=lambda msg: click.echo(msg, err=True))
+    except (CountMismatch, IntegrityError) as e:
+        raise click.ClickException(f"chunk rolled back: {e}")
+    invalidate_all_timelines()
+
+    with db.engine.connect() as conn:
+        after_totals = totals(conn)
+        problems = verify(conn) + [f"statistic {what} drifted" for what, _, _ in verify_stats(conn)]
+    for key in ('appointments', 'treatments'):
+        if before_totals[key] != after_totals[key]:
+            problems.append(f"{key}: {before_totals[key]} before, {after_totals[key]} after")
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise click.ClickException("archive is inconsistent, see above")
+    click.echo(
+        f"archived {appointments} appointments and {treatments} treatments before {before}; "
+        f"live tables now hold {after_totals['live_appointments']} appointments, "
+        f"{after_totals['live_treatments']} treatments"
+    )
+
+@archive_cli.command('verify')
+def verify_command():
+    """Check that live and archived rows do not overlap."""
+    with db.engine.connect() as conn:
+        problems = verify(conn)
+        counts = totals(conn)
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise click.ClickException("archive is inconsistent, see above")
+    click.echo(
+        f"{counts['appointments']} appointments ({counts['live_appointments']} live), "
+        f"{counts['treatments']} treatments ({counts['live_treatments']} live)"
+    )
+
+app.cli.add_command(archive_cli)
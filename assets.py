@@ -0,0 +1,216 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup
+from config import app
+
+# Fingerprinted, precompressed static files. `flask assets build` copies
+# every file under static/ to static/dist/ with a hash of its content in the
+# name (style2.css -> dist/style2.3f9c2a1b7e4d.css), writes .gz and, when the
+# brotli package is installed, .br variants next to it, and records them in
+# static/dist/manifest.json. With a manifest present, url_for('static', ...)
+# in the templates returns the fingerprinted URL, and those URLs are served
+# with a one-year immutable Cache-Control: a changed file gets a new name, so
+# browsers never have to revalidate. Without a build (or with
+# ASSET_FINGERPRINTS off, the development default) the plain files are served.
+#
+# Builds are additive: files of earlier builds stay in static/dist, so
+# workers that still run on the previous manifest keep linking files that
+# exist, until a build no longer among the last ASSET_KEEP_BUILDS referenced
+# them. The manifest records the last build that referenced each file.
+
+BUILD_DIR = 'dist'
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+# a variant is kept only when it saves at least this share of the bytes;
+# images such as jpg and avif are compressed already and are served as is
+MIN_SAVING = 0.1
+# preferred first, for clients that accept several
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+def _compress_brotli(data):
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli.compress(data, quality=11)
+
+def _compress_gzip(data):
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+COMPRESSORS = {'br': _compress_brotli, 'gzip': _compress_gzip}
+
+def fingerprint(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:HASH_LENGTH]}{ext}"
+
+def _sources(static_folder):
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and BUILD_DIR in dirs:
+            dirs.remove(BUILD_DIR)
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, static_folder).replace(os.sep, '/'), path
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _read_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def _files(asset):
+    suffixes = dict(ENCODINGS)
+    return [asset['path']] + [asset['path'] + suffixes[encoding] for encoding in asset['encodings']]
+
+# Adds the current static/ to static/dist and returns the manifest: for each
+# source file (relative name, as passed to url_for) its fingerprinted name
+# and the encodings it has a variant for. Files no build among the last
+# `keep_builds` referenced are deleted.
+def build(static_folder, keep_builds=3):
+    target = os.path.join(static_folder, BUILD_DIR)
+    manifest_path = os.path.join(target, MANIFEST)
+    previous = _read_manifest(manifest_path)
+    number = previous.get('build', 0) + 1
+    # manifests from before files were tracked: their files count as build 0
+    files = previous.get('files') or {
+        name: 0 for asset in previous.get('assets', {}).values() for name in _files(asset)
+    }
+
+    assets = {}
+    for name, path in _sources(static_folder):
+        with open(path, 'rb') as f:
+            data = f.read()
+        built = fingerprint(name, data)
+        # same name, same content: a file kept from an earlier build is reused
+        if not os.path.exists(os.path.join(target, built)):
+            _write(os.path.join(target, built), data)
+        encodings = []
+        for encoding, suffix in ENCODINGS:
+            compressed = COMPRESSORS[encoding](data)
+            if compressed is not None and len(compressed) <= len(data) * (1 - MIN_SAVING):
+                if not os.path.exists(os.path.join(target, built + suffix)):
+                    _write(os.path.join(target, built + suffix), compressed)
+                encodings.append(encoding)
+        assets[name] = {
+            'path': f"{BUILD_DIR}/{built}",
+            'size': len(data),
+            'encodings': encodings,
+        }
+        for file in _files(assets[name]):
+            files[file] = number
+
+    for file, last in list(files.items()):
+        if last <= number - keep_builds:
+            try:
+                os.remove(os.path.join(static_folder, file))
+            except FileNotFoundError:
+                pass
+            del files[file]
+
+    # the new manifest replaces the old one in one step, after its files exist
+    tmp = f"{manifest_path}.{os.getpid()}"
+    _write(tmp, json.dumps({'build': number, 'assets': assets, 'files': files}, indent=2).encode())
+    os.replace(tmp, manifest_path)
+    global _manifest
+    _manifest = None
+    return assets
+
+# the manifest of the build, read once per process (a deploy builds, then
+# restarts the workers)
+_manifest = None
+
+def _load(static_folder):
+    try:
+        with open(os.path.join(static_folder, BUILD_DIR, MANIFEST), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        data = b''
+    manifest = json.loads(data) if data else {}
+    assets = manifest.get('assets', {})
+    # files kept from earlier builds are served as they are, still immutable
+    built = {path: [] for path in manifest.get('files', {})}
+    built.update({asset['path']: asset['encodings'] for asset in assets.values()})
+    return {
+        'assets': assets,
+        # fingerprinted path -> encodings, for serving
+        'built': built,
+        'version': hashlib.sha256(data).hexdigest()[:HASH_LENGTH] if data else '',
+    }
+
+def _current():
+    global _manifest
+    manifest = _manifest
+    if manifest is None:
+        manifest = _manifest = _load(current_app.static_folder)
+    return manifest
+
+# the build this process links to, part of the ETag of every conditional page
+# (see fragments.etag), so a page kept by a browser links the new build's files
+def version():
+    if not current_app.config['ASSET_FINGERPRINTS']:
+        return ''
+    return _current()['version']
+
+# url_for('static', filename='style.css') -> /static/dist/style.<hash>.css
+@app.url_defaults
+def fingerprinted_url(endpoint, values):
+    if endpoint != 'static' or not current_app.config['ASSET_FINGERPRINTS']:
+        return
+    asset = _current()['assets'].get(values.get('filename'))
+    if asset:
+        values['filename'] = asset['path']
+
+def _encoding(available):
+    for encoding, suffix in ENCODINGS:
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding, suffix
+    return None, ''
+
+# Replaces Flask's static view. Fingerprinted files get the best precompressed
+# variant the client accepts and a long immutable lifetime; anything else is
+# served as Flask would.
+def static_file(filename):
+    available = _current()['built'].get(filename) if current_app.config['ASSET_FINGERPRINTS'] else None
+    if available is None:
+        return current_app.send_static_file(filename)
+
+    encoding, suffix = _encoding(available)
+    response = send_from_directory(
+        current_app.static_folder, filename + suffix,
+        mimetype=mimetypes.guess_type(filename)[0],
+        max_age=current_app.config['ASSET_MAX_AGE']
+    )
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if available:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.immutable = True
+    return response
+
+app.view_functions['static'] = static_file
+
+assets_cli = AppGroup('assets', help='Build the fingerprinted static files.')
+
+@assets_cli.command('build')
+def build_command():
+    """Fingerprint and precompress static/ into static/dist (run on deploy)."""
+    assets = build(app.static_folder, app.config['ASSET_KEEP_BUILDS'])
+    for name, asset in assets.items():
+        encodings = ', '.join(asset['encodings']) or 'uncompressed'
+        click.echo(f"{name} -> {asset['path']} ({asset['size']} bytes, {encodings})")
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        click.echo("brotli is not installed (pip install brotli), only gzip variants were written", err=True)
+app.cli.add_command(assets_cli)
@@ -0,0 +1,162 @@
+# Checks that adding branches does not slow the existing ones down, and
+# what the admin's cross-branch report costs. For each --branches count it
+# copies a generated database (see generate.py) once per branch, starts the
+# app with those branches in a fresh process, and serves doctor dashboards
+# spread round robin over every branch. It reports the latency of the main
+# branch's requests, and of /admin/branches, whose fan-out queries every
+# branch on a thread pool; with --sequential the pool has a single thread,
+# which is what the report would cost without the fan-out.
+#
+#   python benchmarks/generate.py --scale 100k
+#   python benchmarks/branches.py --scale 100k --branches 1,2,4,8
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate import database_path
+from load import copy_database, summarize
+
+def child(requests, warmup, seed, window_days):
+    from sqlalchemy import select
+    from app import app, create_app
+    from config import db
+    from migrations import upgrade
+    from models import Doctor
+    import branches
+
+    for branch in branches.names():
+        with branches.using(branch):
+            db.metadata.create_all(db.engine)
+            upgrade()
+    create_app()
+
+    rng = random.Random(seed)
+    names = branches.names()
+    doctors = {}
+    for branch in names:
+        with branches.using(branch):
+            doctors[branch] = db.session.execute(select(Doctor.doctor_id, Doctor.doctor_name)).all()
+
+    client = app.test_client()
+    start = (date.today() - timedelta(days=window_days)).isoformat()
+    end = date.today().isoformat()
+    samples = {'main_branch': [], 'other_branches': []}
+    for n in range(warmup + requests * len(names)):
+        branch = names[n % len(names)]
+        doctor_id, doctor_name = rng.choice(doctors[branch])
+        with client.session_transaction() as sess:
+            sess.clear()
+            sess.update({'user_type': 'doctor', 'branch': branch, 'doctor_id': doctor_id, 'doctor_name': doctor_name})
+        t0 = time.perf_counter()
+        response = client.get(f'/{branch}/doctor?start={start}&end={end}')
+        ms = (time.perf_counter() - t0) * 1000
+        if n >= warmup:
+            route = 'main_branch' if branch == names[0] else 'other_branches'
+            samples[route].append({'ms': ms, 'status': response.status_code, 'queries': 0})
+
+    admin = app.test_client()
+    with admin.session_transaction() as sess:
+        sess.update({'user_type': 'admin', 'admin': 'Admin'})
+    samples['admin_branches'] = []
+    for n in range(warmup // 10 + requests // 10):
+        t0 = time.perf_counter()
+        response = admin.get('/admin/branches')
+        ms = (time.perf_counter() - t0) * 1000
+        if n >= warmup // 10:
+            samples['admin_branches'].append({'ms': ms, 'status': response.status_code, 'queries': 0})
+
+    result = {route: summarize(s, None) for route, s in samples.items() if s}
+    for summary in result.values():
+        for key in ('queries_mean', 'queries_p95', 'queries_max'):
+            summary.pop(key)
+    print(json.dumps(result))
+
+def run(source, count, args):
+    workdir = tempfile.mkdtemp()
+    try:
+        paths = []
+        for n in range(count):
+            os.makedirs(os.path.join(workdir, str(n)))
+            paths.append(copy_database(source, os.path.join(workdir, str(n))))
+        env = dict(os.environ)
+        env.update({
+            'DATABASE_URL': 'sqlite:///' + paths[0],
+            'BRANCH_DATABASE_URLS': ' '.join(f"branch{n}=sqlite:///{path}" for n, path in enumerate(paths) if n),
+            'HMS_TIMELINE_CACHE_SIZE': '0',
+            'METRICS_ENABLED': '0',
+        })
+        if args.sequential:
+            env['BRANCH_FANOUT_WORKERS'] = '1'
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child',
+             '--requests', str(args.requests), '--warmup', str(args.warmup),
+             '--seed', str(args.seed), '--window-days', str(args.window_days)],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', default='10k', help='database built by generate.py --scale')
+    parser.add_argument('--database', help='any other database file, overrides --scale')
+    parser.add_argument('--branches', default='1,2,4,8', help='comma-separated branch counts to measure')
+    parser.add_argument('--requests', type=int, default=500, help='dashboard requests per branch')
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--window-days', type=int, default=7, help='days of worklist the doctor dashboard shows')
+    parser.add_argument('--sequential', action='store_true', help='query the branches one at a time')
+    parser.add_argument('--out', help='write the JSON results here instead of stdout')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.requests, args.warmup, args.seed, args.window_days)
+        return
+
+    source = args.database or database_path(args.scale)
+    if not os.path.exists(source):
+        sys.exit(f"{source} does not exist, run benchmarks/generate.py --scale {args.scale} first")
+
+    runs = []
+    for count in sorted(int(n) for n in args.branches.split(',')):
+        result = run(source, count, args)
+        runs.append({'branches': count, 'routes': result})
+        print(
+            f"{count:>3} branches: main branch p50 {result['main_branch']['p50_ms']} ms, "
+            f"p99 {result['main_branch']['p99_ms']} ms; "
+            f"/admin/branches p50 {result['admin_branches']['p50_ms']} ms",
+            file=sys.stderr
+        )
+
+    output = json.dumps({
+        'meta': {
+            'database': source,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'seed': args.seed,
+            'sequential': args.sequential,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'runs': runs,
+    }, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+# Builds a synthetic hospital database for the benchmarks: the seeded
+# departments and doctors (plus extra doctors at larger scales), patients,
+# appointments spread over past and upcoming working days, and a treatment
+# for every completed appointment. The same --seed always gives the same data.
+#
+#   python benchmarks/generate.py --scale 100k
+#   python benchmarks/generate.py --patients 5000 --appointments 20000 --out /tmp/hms.sqlite3
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# patients and appointments per scale
+SCALES = {
+    '10k': 10_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+}
+
+# share of a doctor's slots that are booked, and how far ahead bookings go
+FILL_RATE = 0.8
+# extra doctors are added until the appointments fit in about this many days
+HISTORY_DAYS = 730
+
+TESTS = ['Blood Test', 'X-Ray', 'MRI', 'ECG', 'Urine Test', 'None']
+DIAGNOSES = ['Viral Fever', 'Hypertension', 'Migraine', 'Type 2 Diabetes', 'Fracture', 'Gastritis', 'Asthma']
+PRESCRIPTIONS = ['Rest for 3 days', 'Follow up in 2 weeks', 'Physiotherapy', 'Diet control', 'Review reports']
+MEDICINES = ['Paracetamol 500mg', 'Amlodipine 5mg', 'Metformin 500mg', 'Pantoprazole 40mg', 'Salbutamol inhaler', 'Ibuprofen 400mg']
+
+def database_path(scale):
+    return os.path.join(DATA_DIR, f"hms-{scale}.sqlite3")
+
+def working_days(last, count, working):
+    day = last
+    while count:
+        if day.weekday() in working:
+            yield day
+            count -= 1
+        day -= timedelta(days=1)
+
+def extra_doctors(first, count, department_ids):
+    for n in range(first, first + count):
+        yield {
+            'doctor_id': f"D{n:03d}",
+            'doctor_name': f"Dr. Synthetic {n}",
+            'department_id': department_ids[n % len(department_ids)],
+            'specialization': 'General Practice',
+        }
+
+def patients(count):
+    for n in range(1, count + 1):
+        yield {
+            'patient_id': 'P' + str(n).zfill(3),
+            'patient_name': f"patient{n}",
+            'password': 'x',
+            'email': f"patient{n}@example.com",
+            'contact_no': f"9{n:09d}"[:10],
+        }
+
+# Walks working days backwards from the end of the booking horizon, filling
+# FILL_RATE of every doctor's slots until `count` appointments exist.
+def appointments(rng, count, n_patients, doctor_names, labels, horizon, working):
+    from models import Appointment_status
+
+    today = date.today()
+    per_day = len(doctor_names) * len(labels)
+    days = math.ceil(count / (per_day * FILL_RATE)) + 1
+    appointment_id = 101
+    for day in working_days(today + timedelta(days=horizon), days, working):
+        for doctor_name in doctor_names:
+            for label in labels:
+                if appointment_id - 101 >= count:
+                    return
+                if rng.random() > FILL_RATE:
+                    continue
+                roll = rng.random()
+                if day >= today:
+                    status = Appointment_status.Cancelled if roll < 0.1 else Appointment_status.Booked
+                elif roll < 0.7:
+                    status = Appointment_status.Completed
+                elif roll < 0.85:
+                    status = Appointment_status.Cancelled
+                else:
+                    status = Appointment_status.Booked
+                yield {
+                    'appointment_id': appointment_id,
+                    'patient_id': 'P' + str(rng.randint(1, n_patients)).zfill(3),
+                    'doctor_name': doctor_name,
+                    'date': day,
+                    'time': label,
+                    'status': status,
+                }
+                appointment_id += 1
+
+# one treatment per completed appointment, written in a single INSERT ... SELECT
+def insert_treatments(conn):
+    from sqlalchemy import case, insert, select
+    from models import Appointment, Appointment_status, Treatment
+
+    def pick(options):
+        return case(
+            *[(Appointment.appointment_id % len(options) == i, value) for i, value in enumerate(options)],
+            else_=options[0]
+        )
+
+    conn.execute(insert(Treatment).from_select(
+        ['patient_id', 'appointment_id', 'test_done', 'diagnosis', 'prescription', 'medicines'],
+        select(
+            Appointment.patient_id, Appointment.appointment_id,
+            pick(TESTS), pick(DIAGNOSES), pick(PRESCRIPTIONS), pick(MEDICINES)
+        ).where(Appointment.status == Appointment_status.Completed)
+    ))
+
+def generate(path, n_patients, n_appointments, seed):
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(path)
+
+    from sqlalchemy import func, select, update
+    from app import app, db
+    from bulk import after_import, import_records
+    from ids import resync
+    from migrations import upgrade
+    from models import Department, Doctor, Patient, Appointment, insert_departments, insert_doctors
+    from slots import HORIZON_DAYS, WORKING_DAYS, default_slot_labels
+
+    rng = random.Random(seed)
+    timings = {}
+
+    with app.app_context():
+        started = time.perf_counter()
+        db.create_all()
+        upgrade()
+        insert_departments()
+        insert_doctors()
+
+        labels = default_slot_labels()
+        slots_per_doctor = HISTORY_DAYS * len(WORKING_DAYS) / 7 * len(labels) * FILL_RATE
+        doctor_count = db.session.query(func.count(Doctor.doctor_id)).scalar()
+        wanted = max(doctor_count, math.ceil(n_appointments / slots_per_doctor))
+        department_ids = [dep_id for (dep_id,) in db.session.query(Department.department_id).order_by(Department.department_id)]
+        import_records(Doctor.__table__, extra_doctors(doctor_count + 1, wanted - doctor_count, department_ids))
+        with db.engine.begin() as conn:
+            conn.execute(update(Department).values(doctors_registered=(
+                select(func.count(Doctor.doctor_id))
+                .where(Doctor.department_id == Department.department_id)
+                .scalar_subquery()
+            )))
+        timings['doctors'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        import_records(Patient.__table__, patients(n_patients))
+        timings['patients'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        doctor_names = [name for (name,) in db.session.query(Doctor.doctor_name).order_by(Doctor.doctor_id)]
+        import_records(Appointment.__table__, appointments(
+            rng, n_appointments, n_patients, doctor_names, labels, HORIZON_DAYS, WORKING_DAYS
+        ))
+        timings['appointments'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        with db.engine.begin() as conn:
+            insert_treatments(conn)
+        timings['treatments'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        resync('doctor')
+        resync('patient')
+        # also rebuilds the medicine rows of the treatments
+        after_import('appointment')
+        timings['statistics'] = time.perf_counter() - started
+
+        counts = {
+            table: db.session.execute(select(func.count()).select_from(db.metadata.tables[table])).scalar()
+            for table in ('department', 'doctor', 'patient', 'appointment', 'treatment')
+        }
+        db.session.remove()
+        # fold the WAL into the main file so the database can be copied as one file
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+        db.engine.dispose()
+    return counts, timings
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', choices=sorted(SCALES), default='10k',
+                        help='number of patients and of appointments')
+    parser.add_argument('--patients', type=int, help='overrides --scale')
+    parser.add_argument('--appointments', type=int, help='overrides --scale')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', help='database file, default benchmarks/data/hms-<scale>.sqlite3')
+    args = parser.parse_args()
+
+    n_patients = args.patients or SCALES[args.scale]
+    n_appointments = args.appointments or SCALES[args.scale]
+    path = args.out or database_path(args.scale)
+
+    started = time.perf_counter()
+    counts, timings = generate(path, n_patients, n_appointments, args.seed)
+    elapsed = time.perf_counter() - started
+
+    print(f"{path} built in {elapsed:.1f}s")
+    for table, count in counts.items():
+        print(f"  {table:<12} {count:>9}")
+    for step, seconds in timings.items():
+        print(f"  {step:<12} {seconds:>8.1f}s")
+
+if __name__ == '__main__':
+    main()
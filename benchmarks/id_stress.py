@@ -0,0 +1,90 @@
+# Hammers /register from many threads (optionally in several forked
+# processes) against a scratch database and checks that every patient got a
+# distinct id. Exits non-zero on duplicates, on any failed or raising
+# registration, or when the patient count differs from the number of
+# registrations: a clashing id surfaces as a failed insert, not as a
+# duplicate row.
+#
+#   python benchmarks/id_stress.py --processes 4 --threads 16 --per-thread 25
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def register_many(prefix, threads, per_thread):
+    from app import app, db
+
+    # never share the parent's pooled sqlite connections across a fork
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    failures = []
+
+    def worker(t):
+        client = app.test_client()
+        for i in range(per_thread):
+            name = f"{prefix}-{t}-{i}"
+            try:
+                response = client.post('/register', data={'username': name, 'password': 'x'})
+            except Exception as exc:
+                # e.g. a pool timeout; the thread keeps going so the run finishes
+                failures.append(name)
+                print(f"{name}: {exc!r}", file=sys.stderr)
+                continue
+            if response.status_code != 302 or response.location != '/login':
+                failures.append(name)
+
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processes', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--per-thread', type=int, default=25)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), 'id_stress.sqlite3')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+
+    from app import app, db
+    from migrations import upgrade
+    from models import Patient
+
+    with app.app_context():
+        db.create_all()
+        upgrade()
+
+    started = time.perf_counter()
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(args.processes) as pool:
+        results = pool.starmap(
+            register_many,
+            [(f"p{n}", args.threads, args.per_thread) for n in range(args.processes)]
+        )
+    elapsed = time.perf_counter() - started
+
+    failures = [name for result in results for name in result]
+    with app.app_context():
+        ids = [pid for (pid,) in db.session.query(Patient.patient_id)]
+
+    expected = args.processes * args.threads * args.per_thread
+    duplicates = len(ids) - len(set(ids))
+    print(f"registrations: {expected} in {elapsed:.2f}s "
+          f"({expected / elapsed:.0f}/s), failed requests: {len(failures)}")
+    print(f"patients: {len(ids)}, distinct ids: {len(set(ids))}, duplicates: {duplicates}")
+
+    if duplicates or failures or len(ids) != expected:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+# Times the two join-heavy pages: the doctor dashboard (worklist joined to
+# patients, and the patients the doctor has completed appointments with) and
+# a patient's treatment history (treatments joined to appointments). Runs
+# against a copy of a generated database (see generate.py) with the history
+# cache disabled, so every request runs its queries. Each page is reported
+# twice: whole request, and time spent in SQL only (`<route>_sql`). Results
+# are in the same format as load.py, so two runs compare with --baseline.
+#
+#   python benchmarks/generate.py --scale 100k
+#   python benchmarks/joins.py --scale 100k --out before.json
+#   (change the schema or queries)
+#   python benchmarks/joins.py --scale 100k --baseline before.json
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate import database_path
+from load import compare, copy_database, summarize
+
+def run(path, requests, warmup, seed, window_days):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+    os.environ['HMS_TIMELINE_CACHE_SIZE'] = '0'
+    os.environ['METRICS_ENABLED'] = '0'
+
+    from sqlalchemy import event, func, select
+    from app import app, create_app
+    from config import db
+    from migrations import upgrade
+    from models import Appointment, Doctor, Treatment
+
+    with app.app_context():
+        db.create_all()
+        upgrade()
+    create_app()
+    rng = random.Random(seed)
+    with app.app_context():
+        doctors = db.session.execute(select(Doctor.doctor_id, Doctor.doctor_name).order_by(Doctor.doctor_id)).all()
+        # patients with the most treatments, so the history join has rows to join
+        patients = db.session.execute(
+            select(Treatment.patient_id).group_by(Treatment.patient_id)
+            .order_by(func.count().desc(), Treatment.patient_id).limit(200)
+        ).scalars().all()
+        counts = {
+            'appointments': db.session.execute(select(func.count()).select_from(Appointment)).scalar(),
+            'treatments': db.session.execute(select(func.count()).select_from(Treatment)).scalar(),
+        }
+        engine = db.engine
+
+    sql = {'ms': 0.0, 'statements': 0}
+
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        context._started = time.perf_counter()
+
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        sql['ms'] += (time.perf_counter() - context._started) * 1000
+        sql['statements'] += 1
+
+    event.listen(engine, 'before_cursor_execute', before_execute)
+    event.listen(engine, 'after_cursor_execute', after_execute)
+
+    client = app.test_client()
+    start = (date.today() - timedelta(days=window_days)).isoformat()
+    end = date.today().isoformat()
+    samples = {}
+    for n in range(warmup + requests):
+        if n % 2:
+            route = 'doctor_dashboard'
+            doctor_id, doctor_name = rng.choice(doctors)
+            with client.session_transaction() as sess:
+                sess.clear()
+                sess.update({'user_type': 'doctor', 'doctor_id': doctor_id, 'doctor_name': doctor_name})
+            url = f'/doctor?start={start}&end={end}'
+        else:
+            route = 'history'
+            url = f'/history/{rng.choice(patients)}'
+
+        sql['ms'] = 0.0
+        sql['statements'] = 0
+        t0 = time.perf_counter()
+        response = client.get(url)
+        ms = (time.perf_counter() - t0) * 1000
+        if n >= warmup:
+            samples.setdefault(route, []).append(
+                {'ms': ms, 'status': response.status_code, 'queries': sql['statements']})
+            samples.setdefault(route + '_sql', []).append(
+                {'ms': sql['ms'], 'status': response.status_code, 'queries': sql['statements']})
+
+    event.remove(engine, 'before_cursor_execute', before_execute)
+    event.remove(engine, 'after_cursor_execute', after_execute)
+
+    pages = [s for route in ('doctor_dashboard', 'history') for s in samples[route]]
+    return {
+        'meta': {
+            'database': path,
+            'rows': counts,
+            'requests': requests,
+            'warmup': warmup,
+            'seed': seed,
+            'window_days': window_days,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'overall': summarize(pages, None),
+        'routes': {route: summarize(samples[route], None) for route in sorted(samples)},
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', default='10k', help='database built by generate.py --scale')
+    parser.add_argument('--database', help='any other database file, overrides --scale')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--warmup', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--window-days', type=int, default=90, help='days of worklist the doctor dashboard shows')
+    parser.add_argument('--out', help='write the JSON results here instead of stdout')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    source = args.database or database_path(args.scale)
+    if not os.path.exists(source):
+        sys.exit(f"{source} does not exist, run benchmarks/generate.py --scale {args.scale} first")
+
+    # the copy is upgraded to the current schema before measuring
+    workdir = tempfile.mkdtemp()
+    path = copy_database(source, workdir)
+    try:
+        result = run(path, args.requests, args.warmup, args.seed, args.window_days)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    result['meta']['database'] = source
+
+    output = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    elif not args.baseline:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+# Replays a weighted mix of patient, doctor and admin traffic against a copy
+# of a generated database (see generate.py) through the Flask test client and
+# reports p50/p95/p99 latency, throughput and SQL statements per route as
+# JSON. Runs with the same --seed replay the same requests, so two results
+# files can be compared with --baseline.
+#
+#   python benchmarks/generate.py --scale 100k
+#   python benchmarks/load.py --scale 100k --requests 5000 --out before.json
+#   python benchmarks/load.py --scale 100k --requests 5000 --baseline before.json
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate import database_path
+
+# (route, role, weight); a role of None sends the request without logging in
+MIX = [
+    ('index', None, 2),
+    ('login', None, 5),
+    ('patient_dashboard', 'patient', 10),
+    ('view_doctors', 'patient', 5),
+    ('check_availability', 'patient', 6),
+    ('book_appointment', 'patient', 4),
+    ('book_appointment_post', 'patient', 4),
+    ('view_appointment', 'patient', 6),
+    ('history', 'patient', 6),
+    ('doctor_dashboard', 'doctor', 10),
+    ('doctor_availability', 'doctor', 3),
+    ('past_history', 'doctor', 5),
+    ('admin_dashboard', 'admin', 6),
+    ('admin_reports', 'admin', 2),
+    ('patient_history', 'admin', 4),
+    ('view_patient', 'admin', 3),
+]
+
+# ids and names the requests are drawn from
+class Population:
+    def __init__(self, rng, sample):
+        from config import db
+        from models import Patient, Doctor, Department
+        from slots import default_slot_labels
+
+        ids = [pid for (pid,) in db.session.query(Patient.patient_id).order_by(Patient.patient_id)]
+        chosen = rng.sample(ids, min(sample, len(ids)))
+        self.patients = db.session.query(Patient.patient_id, Patient.patient_name, Patient.password) \
+            .filter(Patient.patient_id.in_(chosen)).order_by(Patient.patient_id).all()
+        self.doctors = db.session.query(Doctor.doctor_id, Doctor.doctor_name).order_by(Doctor.doctor_id).all()
+        self.departments = [dep_id for (dep_id,) in db.session.query(Department.department_id)]
+        self.labels = default_slot_labels()
+        self.rng = rng
+
+    def patient(self):
+        return self.rng.choice(self.patients)
+
+    def doctor(self):
+        return self.rng.choice(self.doctors)
+
+def login_as(client, role, population):
+    with client.session_transaction() as session:
+        session.clear()
+        if role == 'patient':
+            patient = population.patient()
+            session.update(user_type='patient', patient_id=patient.patient_id, patient_name=patient.patient_name)
+        elif role == 'doctor':
+            doctor = population.doctor()
+            session.update(user_type='doctor', doctor_id=doctor.doctor_id, doctor_name=doctor.doctor_name)
+        elif role == 'admin':
+            session.update(user_type='admin', admin='Admin')
+
+# (method, url, form data) for one request of `route`
+def build_request(route, client, population):
+    rng = population.rng
+    with client.session_transaction() as session:
+        patient_id = session.get('patient_id')
+    if route == 'index':
+        return 'GET', '/', None
+    if route == 'login':
+        patient = population.patient()
+        return 'POST', '/login', {'username': patient.patient_name, 'password': patient.password}
+    if route == 'patient_dashboard':
+        return 'GET', '/patient', None
+    if route == 'view_doctors':
+        return 'GET', f"/view_doctors/{rng.choice(population.departments)}", None
+    if route == 'check_availability':
+        return 'GET', f"/availability?doctor_id={population.doctor().doctor_id}", None
+    if route == 'book_appointment':
+        return 'GET', '/book_appointment', None
+    if route == 'book_appointment_post':
+        day = date.today() + timedelta(days=rng.randint(1, 7))
+        return 'POST', '/book_appointment', {
+            'doctor_name': population.doctor().doctor_name,
+            'date': day.isoformat(),
+            'time': rng.choice(population.labels),
+        }
+    if route == 'view_appointment':
+        return 'GET', '/view_appointment', None
+    if route == 'history':
+        return 'GET', f"/history/{patient_id}", None
+    if route == 'doctor_dashboard':
+        return 'GET', '/doctor', None
+    if route == 'doctor_availability':
+        return 'GET', '/doc_availability', None
+    if route == 'past_history':
+        return 'GET', f"/past_history/{population.patient().patient_id}", None
+    if route == 'admin_dashboard':
+        sort = rng.choice(['', '?appointments_sort=date&appointments_dir=desc', '?patients_sort=name'])
+        return 'GET', '/admin' + sort, None
+    if route == 'admin_reports':
+        return 'GET', '/admin/reports', None
+    if route == 'patient_history':
+        return 'GET', f"/patient_history/{population.patient().patient_id}", None
+    if route == 'view_patient':
+        return 'GET', f"/view_patient/{population.patient().patient_id}", None
+    raise ValueError(route)
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[rank]
+
+def summarize(samples, elapsed):
+    latencies = [s['ms'] for s in samples]
+    queries = [s['queries'] for s in samples]
+    busy = sum(latencies) / 1000
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for s in samples if s['status'] >= 400),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'max_ms': round(max(latencies), 3),
+        'throughput_rps': round(len(samples) / (elapsed if elapsed is not None else busy), 1),
+        'queries_mean': round(sum(queries) / len(queries), 2),
+        'queries_p95': percentile(queries, 95),
+        'queries_max': max(queries),
+    }
+
+def run(path, requests, warmup, seed, sample):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+
+    from sqlalchemy import event, func, select
+    from app import create_app
+    from config import db
+
+    app = create_app()
+    rng = random.Random(seed)
+    routes = [route for route, _, _ in MIX]
+    roles = {route: role for route, role, _ in MIX}
+    weights = [weight for _, _, weight in MIX]
+
+    with app.app_context():
+        population = Population(rng, sample)
+        counts = {
+            table: db.session.execute(select(func.count()).select_from(db.metadata.tables[table])).scalar()
+            for table in ('doctor', 'patient', 'appointment', 'treatment')
+        }
+        engine = db.engine
+
+    statements = [0]
+
+    def count_statement(*args):
+        statements[0] += 1
+
+    event.listen(engine, 'before_cursor_execute', count_statement)
+
+    client = app.test_client()
+    samples = {}
+    started = None
+    for n in range(warmup + requests):
+        if n == warmup:
+            started = time.perf_counter()
+        route = rng.choices(routes, weights)[0]
+        login_as(client, roles[route], population)
+        method, url, data = build_request(route, client, population)
+
+        statements[0] = 0
+        t0 = time.perf_counter()
+        response = client.open(url, method=method, data=data)
+        ms = (time.perf_counter() - t0) * 1000
+        if n >= warmup:
+            samples.setdefault(route, []).append({'ms': ms, 'status': response.status_code, 'queries': statements[0]})
+    elapsed = time.perf_counter() - started
+
+    event.remove(engine, 'before_cursor_execute', count_statement)
+
+    everything = [s for route_samples in samples.values() for s in route_samples]
+    return {
+        'meta': {
+            'database': path,
+            'rows': counts,
+            'requests': requests,
+            'warmup': warmup,
+            'seed': seed,
+            'elapsed_s': round(elapsed, 3),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'overall': summarize(everything, elapsed),
+        'routes': {route: summarize(samples[route], None) for route in sorted(samples)},
+    }
+
+def compare(result, baseline):
+    print(f"{'route':<24}{'p50 ms':>18}{'p95 ms':>18}{'p99 ms':>18}{'queries':>16}")
+
+    def cell(old, new, width):
+        if old is None:
+            return f"{new:>{width}}"
+        change = f"{old} -> {new}"
+        return f"{change:>{width}}"
+
+    rows = [('overall', baseline.get('overall'), result['overall'])]
+    rows += [(route, baseline['routes'].get(route), stats) for route, stats in result['routes'].items()]
+    for route, old, new in rows:
+        old = old or {}
+        print(
+            f"{route:<24}"
+            f"{cell(old.get('p50_ms'), new['p50_ms'], 18)}"
+            f"{cell(old.get('p95_ms'), new['p95_ms'], 18)}"
+            f"{cell(old.get('p99_ms'), new['p99_ms'], 18)}"
+            f"{cell(old.get('queries_mean'), new['queries_mean'], 16)}"
+        )
+
+# copy of `source` (and its WAL) in `workdir`, so runs that write start from the same data
+def copy_database(source, workdir):
+    path = os.path.join(workdir, os.path.basename(source))
+    for suffix in ('', '-wal'):
+        if os.path.exists(source + suffix):
+            shutil.copyfile(source + suffix, path + suffix)
+    return path
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', default='10k', help='database built by generate.py --scale')
+    parser.add_argument('--database', help='any other database file, overrides --scale')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--sample', type=int, default=1000, help='patients the traffic is drawn from')
+    parser.add_argument('--out', help='write the JSON results here instead of stdout')
+    parser.add_argument('--baseline', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    source = args.database or database_path(args.scale)
+    if not os.path.exists(source):
+        sys.exit(f"{source} does not exist, run benchmarks/generate.py --scale {args.scale} first")
+
+    # bookings write to the database, so every run starts from the same copy
+    workdir = tempfile.mkdtemp()
+    path = copy_database(source, workdir)
+    try:
+        result = run(path, args.requests, args.warmup, args.seed, args.sample)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    result['meta']['database'] = source
+
+    output = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    elif not args.baseline:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(result, json.load(f))
+
+if __name__ == '__main__':
+    main()
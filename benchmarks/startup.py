@@ -0,0 +1,56 @@
+# Measures how long a fresh worker process takes from `import app` to the
+# first served request, which is what worker recycling and autoscaling pay.
+# Each run is a separate interpreter so nothing is warm.
+#
+#   python benchmarks/startup.py --runs 20
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r'''
+import json, time
+t0 = time.perf_counter()
+import app as module
+t1 = time.perf_counter()
+application = module.create_app()
+t2 = time.perf_counter()
+response = application.test_client().get('/')
+t3 = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({'import': t1 - t0, 'create_app': t2 - t1, 'first_request': t3 - t2, 'total': t3 - t0}))
+'''
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help='print raw results as JSON')
+    args = parser.parse_args()
+
+    samples = []
+    for _ in range(args.runs):
+        out = subprocess.run(
+            [sys.executable, '-c', PROBE], cwd=ROOT, check=True,
+            capture_output=True, text=True
+        ).stdout
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+
+    summary = {
+        phase: {
+            'median_ms': statistics.median(s[phase] for s in samples) * 1000,
+            'max_ms': max(s[phase] for s in samples) * 1000,
+        }
+        for phase in ('import', 'create_app', 'first_request', 'total')
+    }
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    for phase, stats in summary.items():
+        print(f"{phase:>14}: median {stats['median_ms']:7.1f} ms   max {stats['max_ms']:7.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,206 @@
+# Measures how read throughput scales with gunicorn worker processes. For
+# each worker count it starts `flask serve` on a copy of a generated database
+# (see generate.py), lets a pool of client processes log in as patients and
+# replay read-only pages over keep-alive connections for --duration seconds,
+# then stops the server with SIGTERM and times the graceful shutdown.
+#
+#   python benchmarks/generate.py --scale 100k
+#   python benchmarks/throughput.py --scale 100k --workers 1,2,4 --clients 16
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from generate import database_path
+from load import copy_database, percentile
+
+# pages every client cycles through, picked at random per request
+def page(rng, people):
+    patient_id = rng.choice(people['patients'])[2]
+    return rng.choice([
+        '/patient',
+        f"/view_doctors/{rng.choice(people['departments'])}",
+        f"/availability?doctor_id={rng.choice(people['doctors'])}",
+        '/view_appointment',
+        f"/history/{patient_id}",
+    ])
+
+def population(path, sample, seed):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    try:
+        patients = conn.execute("SELECT patient_name, password, patient_id FROM patient ORDER BY patient_id").fetchall()
+        doctors = [row[0] for row in conn.execute("SELECT doctor_id FROM doctor ORDER BY doctor_id")]
+        departments = [row[0] for row in conn.execute("SELECT department_id FROM department ORDER BY department_id")]
+    finally:
+        conn.close()
+    return {
+        'patients': rng.sample(patients, min(sample, len(patients))),
+        'doctors': doctors,
+        'departments': departments,
+    }
+
+def session_cookie(response):
+    for name, value in response.getheaders():
+        if name.lower() == 'set-cookie' and value.startswith('session='):
+            return value.split(';', 1)[0]
+    return None
+
+# one client process: logs in, then requests pages until `deadline`
+def client(args):
+    port, people, seed, deadline = args
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    name, password, _ = rng.choice(people['patients'])
+    conn.request('POST', '/login', body=urlencode({'username': name, 'password': password}),
+                 headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    headers = {'Cookie': session_cookie(response) or ''}
+
+    latencies = []
+    errors = 0
+    while time.time() < deadline:
+        t0 = time.perf_counter()
+        try:
+            conn.request('GET', page(rng, people), headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        if response.status >= 400:
+            errors += 1
+        latencies.append((time.perf_counter() - t0) * 1000)
+    conn.close()
+    return latencies, errors
+
+def wait_until_up(port, process, log, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            with open(log) as f:
+                raise RuntimeError("server exited during startup:\n" + f.read())
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server did not start")
+
+def run(path, workers, threads, clients, duration, port, people, seed):
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + path, HMS_CONFIG='production', FLASK_APP='app')
+    env.pop('WEB_ACCESS_LOG', None)
+    log = path + '.server.log'
+    with open(log, 'w') as output:
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'flask', 'serve', '--bind', f"127.0.0.1:{port}",
+             '--workers', str(workers), '--threads', str(threads)],
+            cwd=ROOT, env=env, stdout=output, stderr=output
+        )
+    try:
+        wait_until_up(port, server, log)
+        deadline = time.time() + duration
+        with multiprocessing.Pool(clients) as pool:
+            results = pool.map(client, [(port, people, seed + i, deadline) for i in range(clients)])
+    finally:
+        t0 = time.perf_counter()
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        shutdown = time.perf_counter() - t0
+
+    latencies = [ms for result, _ in results for ms in result]
+    return {
+        'workers': workers,
+        'threads': threads,
+        'requests': len(latencies),
+        'errors': sum(errors for _, errors in results),
+        'throughput_rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'shutdown_s': round(shutdown, 3),
+        'exit_code': server.returncode,
+    }
+
+def main():
+    cpus = os.cpu_count() or 1
+    default_workers = sorted({1, 2, 4, cpus} & set(range(1, cpus + 1)))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', default='10k', help='database built by generate.py --scale')
+    parser.add_argument('--database', help='any other database file, overrides --scale')
+    parser.add_argument('--workers', default=','.join(map(str, default_workers)),
+                        help='comma-separated worker counts to measure (default: powers of two up to the CPU count)')
+    parser.add_argument('--threads', type=int, default=1, help='threads per worker')
+    parser.add_argument('--clients', type=int, default=2 * cpus, help='concurrent client processes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per worker count')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--sample', type=int, default=1000, help='patients the clients log in as')
+    parser.add_argument('--out', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    source = args.database or database_path(args.scale)
+    if not os.path.exists(source):
+        sys.exit(f"{source} does not exist, run benchmarks/generate.py --scale {args.scale} first")
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = copy_database(source, workdir)
+        people = population(path, args.sample, args.seed)
+        runs = []
+        for workers in [int(n) for n in args.workers.split(',')]:
+            runs.append(run(path, workers, args.threads, args.clients, args.duration, args.port, people, args.seed))
+            print(
+                f"{workers:>3} workers: {runs[-1]['throughput_rps']:>8} req/s, "
+                f"p95 {runs[-1]['p95_ms']} ms, {runs[-1]['errors']} errors, "
+                f"shutdown {runs[-1]['shutdown_s']} s",
+                file=sys.stderr
+            )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    # throughput relative to perfect linear scaling from the smallest run
+    base = runs[0]
+    for result in runs:
+        ideal = base['throughput_rps'] * result['workers'] / base['workers']
+        result['scaling_efficiency'] = round(result['throughput_rps'] / ideal, 2) if ideal else None
+
+    output = json.dumps({
+        'meta': {
+            'database': source,
+            'cpus': cpus,
+            'clients': args.clients,
+            'duration_s': args.duration,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'runs': runs,
+    }, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
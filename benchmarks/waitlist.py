@@ -0,0 +1,231 @@
+# Measures how cancelling an appointment holds up as the waitlist grows. On a
+# copy of a generated database (see generate.py) it fills the waitlist to each
+# --entries size with random doctor and department entries, then books and
+# cancels --cancellations random upcoming slots. Each cancellation runs as the
+# cancel routes do: status change, waitlist backfill and commit in one
+# transaction. Reports the latency of the whole transaction and of the
+# backfill alone, SQL statements per backfill, and how many slots were
+# refilled, per waitlist size.
+#
+#   python benchmarks/generate.py --scale 100k
+#   python benchmarks/waitlist.py --scale 100k --entries 0,1000,10000,100000
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate import database_path
+from load import copy_database, percentile
+
+# entries wait for a window starting up to WINDOW_START days ahead, lasting
+# 1 to WINDOW_DAYS days; cancelled slots are within the next CANCEL_DAYS days
+WINDOW_START = 20
+WINDOW_DAYS = 14
+CANCEL_DAYS = 14
+DOCTOR_SHARE = 0.7
+
+def add_entries(db, rng, count, patients, doctors, departments, first):
+    from sqlalchemy import insert
+    from models import WaitlistEntry, Waitlist_status
+
+    today = date.today()
+    rows = []
+    for i in range(count):
+        start = today + timedelta(days=rng.randrange(WINDOW_START))
+        by_doctor = rng.random() < DOCTOR_SHARE
+        rows.append({
+            'patient_id': rng.choice(patients),
+            'doctor_name': rng.choice(doctors).doctor_name if by_doctor else None,
+            'department_id': None if by_doctor else rng.choice(departments),
+            'start_date': start,
+            'end_date': start + timedelta(days=rng.randrange(WINDOW_DAYS)),
+            'created_at': datetime(2020, 1, 1) + timedelta(seconds=first + i),
+            'status': Waitlist_status.Waiting,
+        })
+        if len(rows) == 10000:
+            db.session.execute(insert(WaitlistEntry), rows)
+            rows = []
+    if rows:
+        db.session.execute(insert(WaitlistEntry), rows)
+    db.session.commit()
+
+# a booked appointment in a random free upcoming slot
+def book_random(rng, patients, doctors, templates):
+    from ids import next_appointment_id
+    from slots import Slot, claim_slot, day_slots
+
+    while True:
+        doctor = rng.choice(doctors)
+        day = date.today() + timedelta(days=1 + rng.randrange(CANCEL_DAYS))
+        slots = day_slots(templates[doctor.doctor_id], day)
+        if not slots:
+            continue
+        s, e = rng.choice(slots)
+        if Slot(day, s, e).past:
+            continue
+        appointment = claim_slot(next_appointment_id(), rng.choice(patients), doctor, day, Slot(day, s, e).label)
+        if appointment:
+            return appointment
+
+def measure(db, rng, cancellations, patients, doctors, templates, statements):
+    import stats
+    import waitlist
+    from ids import next_appointment_id
+    from models import Appointment_status
+
+    total, backfill, queries = [], [], []
+    refilled = 0
+    for _ in range(cancellations):
+        appointment = book_random(rng, patients, doctors, templates)
+        t0 = time.perf_counter()
+        spare_id = next_appointment_id()
+        stats.set_status(appointment, Appointment_status.Cancelled)
+        statements[0] = 0
+        t1 = time.perf_counter()
+        replacement = waitlist.backfill(appointment, spare_id)
+        t2 = time.perf_counter()
+        queries.append(statements[0])
+        db.session.commit()
+        t3 = time.perf_counter()
+        total.append((t3 - t0) * 1000)
+        backfill.append((t2 - t1) * 1000)
+        refilled += replacement is not None
+
+    def summary(values):
+        return {
+            'p50_ms': round(percentile(values, 50), 3),
+            'p95_ms': round(percentile(values, 95), 3),
+            'p99_ms': round(percentile(values, 99), 3),
+            'max_ms': round(max(values), 3),
+        }
+
+    return {
+        'cancellations': cancellations,
+        'refilled': refilled,
+        'cancel_transaction': summary(total),
+        'backfill': summary(backfill),
+        'backfill_queries_max': max(queries),
+    }
+
+def query_plan(db, doctor):
+    from sqlalchemy import event
+    from models import Appointment
+    from waitlist import best_waiter
+
+    probe = Appointment(patient_id='', doctor_name=doctor.doctor_name, date=date.today(), time='')
+    plans = []
+
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        probe_cursor = conn.connection.dbapi_connection.cursor()
+        try:
+            probe_cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plans.extend(row[3] for row in probe_cursor.fetchall())
+        finally:
+            probe_cursor.close()
+
+    event.listen(db.engine, 'before_cursor_execute', explain)
+    try:
+        best_waiter(doctor, probe)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', explain)
+    db.session.rollback()
+    return plans
+
+def run(path, sizes, cancellations, seed):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + path
+
+    from sqlalchemy import event, select
+    from app import app, create_app
+    from config import db
+    from migrations import upgrade
+    from models import Department, Patient
+    from catalog import catalog
+    from slots import working_templates
+
+    # the waitlist table may be newer than the generated database
+    with app.app_context():
+        db.create_all()
+        upgrade()
+    create_app()
+    rng = random.Random(seed)
+    results = []
+    with app.app_context():
+        patients = list(db.session.execute(select(Patient.patient_id)).scalars())
+        doctors = catalog.doctors()
+        departments = list(db.session.execute(select(Department.department_id)).scalars())
+        templates = working_templates([doctor.doctor_id for doctor in doctors])
+
+        statements = [0]
+
+        def count_statement(*args):
+            statements[0] += 1
+
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        waiting = 0
+        for size in sizes:
+            if size > waiting:
+                add_entries(db, rng, size - waiting, patients, doctors, departments, waiting)
+                waiting = size
+            result = {'entries': size}
+            result.update(measure(db, rng, cancellations, patients, doctors, templates, statements))
+            results.append(result)
+            print(
+                f"{size:>8} entries: backfill p50 {result['backfill']['p50_ms']} ms, "
+                f"p99 {result['backfill']['p99_ms']} ms, "
+                f"cancel p99 {result['cancel_transaction']['p99_ms']} ms, "
+                f"{result['refilled']}/{cancellations} refilled",
+                file=sys.stderr
+            )
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+        plan = query_plan(db, doctors[0])
+    return results, plan
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', default='10k', help='database built by generate.py --scale')
+    parser.add_argument('--database', help='any other database file, overrides --scale')
+    parser.add_argument('--entries', default='0,1000,10000,100000',
+                        help='comma-separated waitlist sizes to measure, in increasing order')
+    parser.add_argument('--cancellations', type=int, default=300, help='cancellations per waitlist size')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', help='write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    source = args.database or database_path(args.scale)
+    if not os.path.exists(source):
+        sys.exit(f"{source} does not exist, run benchmarks/generate.py --scale {args.scale} first")
+
+    workdir = tempfile.mkdtemp()
+    try:
+        path = copy_database(source, workdir)
+        sizes = sorted(int(n) for n in args.entries.split(','))
+        runs, plan = run(path, sizes, args.cancellations, args.seed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps({
+        'meta': {
+            'database': source,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'best_waiter_plan': plan,
+        },
+        'runs': runs,
+    }, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
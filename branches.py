@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import click
+from flask import abort, g, request, session
+from flask.cli import AppGroup
+from sqlalchemy.exc import DBAPIError
+from config import app, current_branch, db
+
+# One database per hospital branch. The main branch uses
+# SQLALCHEMY_DATABASE_URI, the others the urls of BRANCH_DATABASE_URLS,
+# which become SQLAlchemy binds. A request works on one branch, picked by
+# its URL prefix (/north/doctor) or else by the session (/branches/north, or
+# the branch the user logged in to); the session and db.engine then use
+# that branch's engine, and the process caches keep one slot per branch, so
+# a branch's traffic never touches another branch's pool or caches. Admin
+# reports across branches run fan_out(), one app context per branch on a
+# thread pool, and merge the results. A branch other than the main one that
+# fails the startup schema check is unavailable (503) instead of keeping the
+# others from serving, and is checked again every BRANCH_RECHECK_SECONDS.
+
+def names():
+    return [app.config['MAIN_BRANCH'], *app.config['BRANCHES']]
+
+# runs the block against `branch`, in an app context (and session) of its own
+@contextmanager
+def using(branch):
+    with app.app_context():
+        g.branch = branch
+        yield
+
+# Process-local state kept once per branch: attribute access goes to the
+# instance of the current branch, created on first use.
+class PerBranch:
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._instances = {}
+
+    def current(self):
+        branch = current_branch()
+        instance = self._instances.get(branch)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.setdefault(branch, self._factory())
+        return instance
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    def discard_all(self):
+        with self._lock:
+            self._instances = {}
+
+# /<branch>/... is served as ... with the prefix moved to SCRIPT_NAME, so
+# url_for() keeps every link of the page within the branch
+class BranchPrefix:
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        prefix = path.split('/', 2)[1] if path.startswith('/') else ''
+        if prefix and prefix in names():
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + '/' + prefix
+            environ['PATH_INFO'] = path[len(prefix) + 1:] or '/'
+            environ['hms.branch'] = prefix
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = BranchPrefix(app.wsgi_app)
+
+# branch names that would hide a route of the app behind a prefix
+def clashing_names():
+    segments = {rule.rule.split('/')[1].split('<')[0] for rule in app.url_map.iter_rules()}
+    return sorted(set(names()) & segments)
+
+# branch -> (why it is unavailable, when that was last checked)
+_unavailable = {}
+_unavailable_lock = threading.Lock()
+
+def mark_unavailable(branch, reason):
+    app.logger.error("branch %s is unavailable: %s", branch, reason)
+    with _unavailable_lock:
+        _unavailable[branch] = (reason, time.monotonic())
+
+def mark_available(branch):
+    with _unavailable_lock:
+        _unavailable.pop(branch, None)
+
+# why `branch` cannot be served right now, or None; a branch marked
+# unavailable is checked again once BRANCH_RECHECK_SECONDS have passed
+def unavailable(branch):
+    entry = _unavailable.get(branch)
+    if entry is None:
+        return None
+    reason, checked = entry
+    if time.monotonic() - checked < app.config['BRANCH_RECHECK_SECONDS']:
+        return reason
+    from migrations import schema_problem
+
+    with using(branch):
+        reason = schema_problem()
+    if reason:
+        with _unavailable_lock:
+            _unavailable[branch] = (reason, time.monotonic())
+    else:
+        app.logger.info("branch %s is available again", branch)
+        mark_available(branch)
+    return reason
+
+@app.before_request
+def route_branch():
+    # static files are the same for every branch, and reading the session
+    # would add Vary: Cookie to them
+    if request.endpoint == 'static':
+        return
+    branch = request.environ.get('hms.branch') or session.get('branch')
+    if branch not in names():
+        branch = None
+    g.branch = branch
+    if unavailable(current_branch()):
+        abort(503, description=f"branch {current_branch()} is unavailable")
+    # a patient or doctor login belongs to the branch it was made in
+    logged_in = session.get('branch')
+    if logged_in and logged_in != current_branch() and session.get('user_type') in ('patient', 'doctor'):
+        session.clear()
+
+@app.context_processor
+def branch_context():
+    return {'branch_names': names(), 'current_branch': current_branch()}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _pool():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=min(app.config['BRANCH_FANOUT_WORKERS'], len(names())),
+                thread_name_prefix='branch'
+            )
+        return _executor
+
+def _forget_pool():
+    global _executor
+    _executor = None
+    _stuck.clear()
+
+# a forked worker starts without the parent's threads
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pool)
+
+def _run(branch, fn):
+    with using(branch):
+        return fn()
+
+# branch -> the call of an earlier fan_out that timed out and still holds a
+# pool thread; the branch gets no other thread until it returns, so a hung
+# branch ties up one thread and the others keep answering
+_stuck = {}
+
+# Calls fn() for every branch at once, each in an app context bound to its
+# branch. Returns ({branch: result}, {branch: error}); a branch that fails,
+# is unavailable or has not answered within BRANCH_FANOUT_TIMEOUT_MS is
+# reported as an error instead of holding up the others.
+def fan_out(fn):
+    futures, errors = {}, {}
+    for branch in names():
+        reason = unavailable(branch)
+        stuck = _stuck.get(branch)
+        if reason:
+            errors[branch] = reason
+        elif stuck is not None and not stuck.done():
+            errors[branch] = "still busy with an earlier request that timed out"
+        else:
+            _stuck.pop(branch, None)
+            futures[branch] = _pool().submit(_run, branch, fn)
+    done, _ = wait(futures.values(), timeout=app.config['BRANCH_FANOUT_TIMEOUT_MS'] / 1000)
+    results = {}
+    for branch, future in futures.items():
+        if future not in done:
+            if not future.cancel():
+                _stuck[branch] = future
+            errors[branch] = "timed out"
+        elif future.exception() is not None:
+            app.logger.warning("branch %s failed: %s", branch, future.exception())
+            errors[branch] = str(future.exception())
+        else:
+            results[branch] = future.result()
+    return results, errors
+
+branches_cli = AppGroup('branches', help='List the hospital branches.')
+
+@branches_cli.command('list')
+def list_command():
+    """Show each branch with its database and schema version."""
+    from migrations import current_version
+
+    for branch in names():
+        with using(branch):
+            try:
+                with db.engine.connect() as conn:
+                    version = current_version(conn)
+            except DBAPIError as e:
+                version = f"unavailable ({e.__class__.__name__})"
+            click.echo(f"{branch}\t{db.engine.url.render_as_string(hide_password=True)}\tschema {version}")
+
+app.cli.add_command(branches_cli)
@@ -0,0 +1,231 @@
+import csv
+import enum
+import json
+import sys
+import time
+from datetime import date, datetime
+import click
+from sqlalchemy import select
+from config import app, db
+
+BATCH_SIZE = 5000
+
+# tables that can be moved in and out, in foreign-key order
+TABLES = ['department', 'doctor', 'patient', 'appointment', 'treatment']
+
+# Patients and doctors are matched on their codes, not on the integer keys,
+# which are local to one database. Those keys are not taken from imported
+# records; import_records sets the references from the codes.
+NATURAL_KEYS = {'patient': ['patient_id'], 'doctor': ['doctor_id']}
+SURROGATE_KEYS = {'patient_key', 'doctor_key'}
+
+# table -> [(key column, referenced table, code column)]; the code column has
+# the same name in both tables
+REFERENCES = {
+    'appointment': [('patient_key', 'patient', 'patient_id'), ('doctor_key', 'doctor', 'doctor_name')],
+    'treatment': [('patient_key', 'patient', 'patient_id')],
+}
+
+# INSERT that skips ('ignore') or overwrites ('upsert') rows whose key
+# already exists, for the dialects that support ON CONFLICT
+def dialect_insert(table):
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise click.ClickException(f"bulk upserts are not supported on {dialect}")
+    return insert(table)
+
+def conflict_insert(table, on_conflict='ignore'):
+    stmt = dialect_insert(table)
+    keys = NATURAL_KEYS.get(table.name) or [col.name for col in table.primary_key.columns]
+    if on_conflict == 'upsert':
+        updates = {
+            col.name: stmt.excluded[col.name] for col in table.columns
+            if col.name not in keys and not col.primary_key
+        }
+        if updates:
+            return stmt.on_conflict_do_update(index_elements=keys, set_=updates)
+    return stmt.on_conflict_do_nothing(index_elements=keys)
+
+def _python_type(column):
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return str
+
+# text value from a CSV/NDJSON record -> value for the column
+def _parse(column, value):
+    if value is None or value == '':
+        return None if column.nullable else value
+    python_type = _python_type(column)
+    if issubclass(python_type, enum.Enum):
+        if isinstance(value, str) and value in python_type.__members__:
+            return python_type[value]
+        return python_type(value)
+    if python_type is date and isinstance(value, str):
+        return date.fromisoformat(value)
+    if python_type is datetime and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    if python_type is int:
+        return int(value)
+    return value
+
+def _dump(value):
+    if isinstance(value, enum.Enum):
+        return value.name
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+def _format(path, fmt):
+    if fmt:
+        return fmt
+    return 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+def read_records(stream, fmt):
+    if fmt == 'csv':
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+def batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Sets the keys of a batch's references from their codes, one query per
+# reference, so the unique slot index sees imported appointments at once.
+# Codes that match nothing leave the key NULL.
+def _resolve(conn, table_name, rows):
+    for key, target, code in REFERENCES.get(table_name, []):
+        referenced = db.metadata.tables[target]
+        codes = {row[code] for row in rows if row.get(code) is not None}
+        found = dict(conn.execute(
+            select(referenced.c[code], referenced.c[key]).where(referenced.c[code].in_(codes))
+        ).all()) if codes else {}
+        for row in rows:
+            row[key] = found.get(row.get(code))
+
+# Streams records into `table` with one executemany INSERT per batch and one
+# commit per batch, so memory stays flat and a failure only loses its batch.
+def import_records(table, records, on_conflict='ignore', batch_size=BATCH_SIZE):
+    stmt = conflict_insert(table, on_conflict)
+    columns = {col.name: col for col in table.columns if col.name not in SURROGATE_KEYS}
+    total = 0
+    for batch in batches(records, batch_size):
+        rows = [
+            {name: _parse(columns[name], value) for name, value in record.items() if name in columns}
+            for record in batch
+        ]
+        with db.engine.begin() as conn:
+            _resolve(conn, table.name, rows)
+            conn.execute(stmt, rows)
+        total += len(rows)
+    return total
+
+# Streams the rows of `statement` through a server-side cursor, fetching
+# batch_size at a time; rows are never all held in memory. Pass `engine` when
+# iterating outside an app context, e.g. in a streamed response.
+def stream_rows(statement, batch_size=BATCH_SIZE, engine=None):
+    with (engine or db.engine).connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(statement)
+        for row in result:
+            yield {key: _dump(value) for key, value in row._mapping.items()}
+
+def export_records(table, batch_size=BATCH_SIZE):
+    return stream_rows(select(table).order_by(*table.primary_key.columns), batch_size)
+
+def write_records(records, stream, fmt, columns):
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, fieldnames=columns)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(record)
+    else:
+        for record in records:
+            stream.write(json.dumps(record) + '\n')
+
+# caches and id sequences that have to follow rows written behind the ORM's back
+def after_import(table_name):
+    from catalog import catalog
+    from ids import resync
+    from keys import fill
+    from medicines import backfill
+    from openings import invalidate_all as invalidate_openings
+    from stats import rebuild, refresh_counters
+    from timeline import invalidate_all_timelines
+
+    if table_name in ('department', 'doctor'):
+        catalog.invalidate()
+    if table_name in ('patient', 'treatment', 'appointment'):
+        invalidate_all_timelines()
+    if table_name in ('patient', 'doctor', 'appointment'):
+        resync(table_name)
+    if table_name in ('doctor', 'appointment'):
+        invalidate_openings()
+    with db.engine.begin() as conn:
+        if table_name in ('patient', 'doctor', 'appointment', 'treatment'):
+            fill(conn)
+        if table_name == 'appointment':
+            rebuild(conn)
+        elif table_name in ('patient', 'doctor'):
+            refresh_counters(conn)
+    if table_name in ('treatment', 'appointment'):
+        backfill(db.engine.begin, app.config['MEDICINE_BACKFILL_BATCH'])
+
+def _open(path, mode):
+    if path == '-':
+        return (sys.stdin if 'r' in mode else sys.stdout), False
+    return open(path, mode, encoding='utf-8', newline=''), True
+
+@app.cli.command('import-data')
+@click.argument('table', type=click.Choice(TABLES))
+@click.argument('path')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+@click.option('--on-conflict', type=click.Choice(['ignore', 'upsert']), default='ignore',
+              help='Keep (ignore) or overwrite (upsert) rows whose key already exists.')
+@click.option('--batch-size', type=int, default=BATCH_SIZE, show_default=True)
+def import_data_command(table, path, fmt, on_conflict, batch_size):
+    """Stream a CSV or NDJSON file (or - for stdin) into a table."""
+    stream, close = _open(path, 'r')
+    started = time.perf_counter()
+    try:
+        total = import_records(
+            db.metadata.tables[table], read_records(stream, _format(path, fmt)),
+            on_conflict=on_conflict, batch_size=batch_size
+        )
+    finally:
+        if close:
+            stream.close()
+    after_import(table)
+    elapsed = time.perf_counter() - started
+    click.echo(f"imported {total} {table} rows in {elapsed:.1f}s", err=True)
+
+@app.cli.command('export-data')
+@click.argument('table', type=click.Choice(TABLES))
+@click.argument('path', default='-')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'ndjson']), help='Defaults to the file extension.')
+@click.option('--batch-size', type=int, default=BATCH_SIZE, show_default=True)
+def export_data_command(table, path, fmt, batch_size):
+    """Stream a table to a CSV or NDJSON file (or - for stdout)."""
+    sql_table = db.metadata.tables[table]
+    stream, close = _open(path, 'w')
+    try:
+        write_records(
+            export_records(sql_table, batch_size), stream,
+            _format(path, fmt), [col.name for col in sql_table.columns]
+        )
+    finally:
+        stream.flush()
+        if close:
+            stream.close()
@@ -0,0 +1,97 @@
+import threading
+from collections import namedtuple
+from models import Department, Doctor
+from branches import PerBranch
+from versions import versions
+
+# immutable snapshots, safe to share between requests and threads; they keep
+# the model attribute names so templates and helpers use them unchanged
+CachedDepartment = namedtuple(
+    'CachedDepartment',
+    'department_id department_name department_description doctors_registered'
+)
+CachedDoctor = namedtuple(
+    'CachedDoctor',
+    'doctor_id doctor_name department_id specialization department doctor_key'
+)
+
+# Read-through cache of departments and doctors. Every read compares the
+# cached version token with the shared one; a write route calls invalidate()
+# after committing, which bumps the token so every worker reloads the
+# catalog (two queries) on its next read.
+class Catalog:
+    KEY = 'catalog'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._data = None
+
+    def version(self):
+        return versions.get(self.KEY)
+
+    def _load(self):
+        departments = {
+            dep.department_id: CachedDepartment(
+                dep.department_id, dep.department_name,
+                dep.department_description, dep.doctors_registered
+            )
+            for dep in Department.query.order_by(Department.department_id)
+        }
+        doctors = [
+            CachedDoctor(
+                doc.doctor_id, doc.doctor_name, doc.department_id,
+                doc.specialization, departments.get(doc.department_id), doc.doctor_key
+            )
+            for doc in Doctor.query.order_by(Doctor.doctor_id)
+        ]
+        by_department = {}
+        for doc in doctors:
+            by_department.setdefault(doc.department_id, []).append(doc)
+        return {
+            'departments': departments,
+            'doctors': doctors,
+            'by_id': {doc.doctor_id: doc for doc in doctors},
+            'by_name': {doc.doctor_name: doc for doc in reversed(doctors)},
+            'by_key': {doc.doctor_key: doc for doc in doctors},
+            'by_department': by_department,
+        }
+
+    def _current(self):
+        version = self.version()
+        data = self._data
+        if data is None or self._version != version:
+            with self._lock:
+                if self._data is None or self._version != version:
+                    self._data = self._load()
+                    self._version = version
+                data = self._data
+        return data
+
+    def invalidate(self):
+        versions.bump(self.KEY)
+        self._data = None
+
+    def departments(self):
+        return list(self._current()['departments'].values())
+
+    def department(self, department_id):
+        return self._current()['departments'].get(department_id)
+
+    def doctors(self):
+        return self._current()['doctors']
+
+    def doctors_in(self, department_id):
+        return self._current()['by_department'].get(department_id, [])
+
+    def doctor(self, doctor_id):
+        return self._current()['by_id'].get(doctor_id)
+
+    def doctor_by_name(self, doctor_name):
+        return self._current()['by_name'].get(doctor_name)
+
+    def doctor_by_key(self, doctor_key):
+        return self._current()['by_key'].get(doctor_key)
+
+# one per branch, each with the branch's departments and doctors
+catalog = PerBranch(Catalog)
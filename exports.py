@@ -0,0 +1,135 @@
+import csv
+import io
+import zlib
+from datetime import date
+from sqlalchemy import select, union_all
+from models import Patient, Doctor, Department, Appointment_status
+from archive import SOURCES
+from bulk import stream_rows
+
+# Admin report exports. Each dataset is a SELECT streamed through a
+# server-side cursor and written out as CSV a chunk of rows at a time, so a
+# response holds one chunk in memory however many rows it has.
+
+CHUNK_ROWS = 500
+
+# Excel reads a UTF-8 BOM as "this file is UTF-8"
+BOM = '\ufeff'
+
+# cells starting with these are run as formulas by spreadsheet programs
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+def patients_query(filters):
+    return select(
+        Patient.patient_id, Patient.patient_name, Patient.email, Patient.contact_no
+    ).order_by(Patient.patient_id)
+
+def doctors_query(filters):
+    return (
+        select(
+            Doctor.doctor_id, Doctor.doctor_name, Doctor.specialization,
+            Department.department_name.label('department')
+        )
+        .join(Department, Department.department_id == Doctor.department_id)
+        .order_by(Doctor.doctor_id)
+    )
+
+# appointments and treatments cover the live and the archived rows
+def _appointments(appointment, filters):
+    query = (
+        select(
+            appointment.appointment_id, appointment.date, appointment.time, appointment.status,
+            appointment.doctor_name, appointment.patient_id, Patient.patient_name
+        )
+        .outerjoin(Patient, Patient.patient_key == appointment.patient_key)
+    )
+    if filters.get('start'):
+        query = query.where(appointment.date >= filters['start'])
+    if filters.get('end'):
+        query = query.where(appointment.date <= filters['end'])
+    if filters.get('doctor'):
+        query = query.where(appointment.doctor_name == filters['doctor'])
+    if filters.get('department'):
+        query = query.where(appointment.doctor_name.in_(
+            select(Doctor.doctor_name).where(Doctor.department_id == filters['department'])
+        ))
+    if filters.get('status'):
+        query = query.where(appointment.status == filters['status'])
+    return query
+
+def appointments_query(filters):
+    rows = union_all(*[_appointments(appointment, filters) for appointment, _ in SOURCES]).subquery('rows')
+    return select(*rows.c).order_by(rows.c.date, rows.c.appointment_id)
+
+def _treatments(appointment, treatment, filters):
+    query = (
+        select(
+            treatment.appointment_id, appointment.date, appointment.doctor_name, treatment.patient_id,
+            treatment.test_done, treatment.diagnosis, treatment.prescription, treatment.medicines
+        )
+        .join(appointment, appointment.appointment_id == treatment.appointment_id)
+    )
+    if filters.get('start'):
+        query = query.where(appointment.date >= filters['start'])
+    if filters.get('end'):
+        query = query.where(appointment.date <= filters['end'])
+    return query
+
+def treatments_query(filters):
+    rows = union_all(*[_treatments(appointment, treatment, filters) for appointment, treatment in SOURCES]).subquery('rows')
+    return select(*rows.c).order_by(rows.c.appointment_id)
+
+DATASETS = {
+    'patients': patients_query,
+    'doctors': doctors_query,
+    'appointments': appointments_query,
+    'treatments': treatments_query,
+}
+
+def _date(value):
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+# the filters an export understands, parsed from the query string
+def export_filters(args):
+    status = args.get('status')
+    department = args.get('department')
+    return {
+        'start': _date(args.get('start')),
+        'end': _date(args.get('end')),
+        'doctor': args.get('doctor') or None,
+        'department': int(department) if department and department.isdigit() else None,
+        'status': Appointment_status[status] if status in Appointment_status.__members__ else None,
+    }
+
+def csv_chunks(statement, engine, chunk_rows=CHUNK_ROWS):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write(BOM)
+    writer.writerow([col.name for col in statement.selected_columns])
+    rows = 0
+    for record in stream_rows(statement, batch_size=chunk_rows, engine=engine):
+        writer.writerow([_cell(value) for value in record.values()])
+        rows += 1
+        if rows % chunk_rows == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
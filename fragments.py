@@ -0,0 +1,111 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import Response, current_app, make_response, request
+from markupsafe import Markup
+from catalog import catalog
+from config import app, current_branch
+import assets
+
+# Rendered HTML of the tables built from doctors and departments (department
+# cards, doctor lists, the admin doctor table). They only change when the
+# catalog does, so each fragment is cached under the catalog's version token:
+# add/edit/delete doctor, seeding and imports call catalog.invalidate(), which
+# bumps the token, and every worker drops its fragments on the next render.
+# The same token, hashed with whatever else a page shows and the static
+# build it links, is the page's ETag.
+
+def _size(key, html):
+    return len(html) + sum(len(part) for part in key)
+
+# One bounded LRU per fragment name, so a table rendered under many query
+# strings cannot push the other fragments out.
+class FragmentCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._version = None
+        self._bytes = 0
+
+    def get(self, version, key):
+        with self._lock:
+            if version != self._version:
+                return None
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+            return html
+
+    def put(self, version, key, html):
+        limit = current_app.config['FRAGMENT_CACHE_BYTES']
+        size = _size(key, html)
+        if size > limit:
+            return
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._bytes = 0
+                self._version = version
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= _size(key, old)
+            self._entries[key] = html
+            self._bytes += size
+            while self._bytes > limit:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self._bytes -= _size(evicted_key, evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._version = None
+
+caches = {}
+_caches_lock = threading.Lock()
+
+def fragment_cache(name):
+    key = (current_branch(), name)
+    cache = caches.get(key)
+    if cache is None:
+        with _caches_lock:
+            cache = caches.setdefault(key, FragmentCache())
+    return cache
+
+def _key(parts):
+    return tuple(part.decode() if isinstance(part, bytes) else str(part) for part in parts)
+
+# {% call cached_fragment('name', part, ...) %} ... {% endcall %}
+# renders the body once per catalog version and set of parts; the parts must
+# cover everything in the body that is not catalog data (ids, query string)
+@app.template_global()
+def cached_fragment(name, *parts, caller):
+    cache = fragment_cache(name)
+    version = catalog.version()
+    key = _key(parts)
+    html = cache.get(version, key)
+    if html is None:
+        html = str(caller())
+        cache.put(version, key, html)
+    return Markup(html)
+
+def etag(*parts):
+    # the branch too: two branches may show the same URL (session routing);
+    # and the static build, whose file names the page links
+    digest = hashlib.sha1(repr((current_branch(), catalog.version(), assets.version()) + _key(parts)).encode())
+    return digest.hexdigest()
+
+# Serves a page built from catalog data with an ETag of the catalog version
+# and `parts`. A browser sending that ETag back gets 304 Not Modified and
+# `render` is not called at all.
+def conditional_page(render, *parts):
+    tag = etag(*parts)
+    if request.if_none_match.contains(tag):
+        response = Response(status=304)
+    else:
+        response = make_response(render())
+    response.set_etag(tag)
+    # the pages hold session data: the browser may keep them, but must ask first
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,44 @@
+import multiprocessing
+import os
+
+# gunicorn settings for `gunicorn -c gunicorn.conf.py wsgi:application` and
+# `flask serve`. The app is loaded once in the master and forked into
+# WEB_CONCURRENCY worker processes of WEB_THREADS threads each; every worker
+# drops the master's pooled connections right after the fork (see
+# config.dispose_engines) and opens its own.
+
+bind = os.environ.get('WEB_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+preload_app = True
+
+# on SIGTERM/SIGINT workers stop accepting, finish their requests for up to
+# graceful_timeout seconds and then exit
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+keepalive = 5
+
+# recycle workers now and then so slow leaks cannot build up; 0 turns it off
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get('WEB_ACCESS_LOG') or None
+errorlog = '-'
+
+def on_starting(server):
+    # every worker keeps its own metrics; /metrics adds up their files
+    from metrics import share_between_workers
+    share_between_workers()
+
+def worker_exit(server, worker):
+    # a stopped worker closes its connections instead of leaving them to the OS,
+    # and leaves its last metrics behind for the others to report
+    from config import dispose_engines
+    from metrics import flush
+    dispose_engines()
+    flush()
+
+def on_exit(server):
+    from config import dispose_engines
+    dispose_engines()
@@ -0,0 +1,110 @@
+import os
+import threading
+from flask import current_app
+from sqlalchemy import Integer, cast, create_engine, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import NullPool
+from config import db
+from models import IdSequence, Patient, Doctor, Appointment
+from branches import PerBranch
+
+# id series: existing-id expression used to seed the sequence, first value, display format
+SERIES = {
+    'patient': (cast(func.substr(Patient.patient_id, 2), Integer), 1, lambda n: 'P' + str(n).zfill(3)),
+    'doctor': (cast(func.substr(Doctor.doctor_id, 2), Integer), 1, lambda n: f"D{n:03d}"),
+    'appointment': (Appointment.appointment_id, 101, lambda n: n),
+}
+
+# Hands out ids from a persistent sequence table. Each process reserves a
+# block of ID_BLOCK_SIZE numbers with one atomic UPDATE and serves the rest
+# from memory, so concurrent workers never see the same number and most
+# inserts need no extra query. Unused numbers in a block are simply skipped.
+class IdAllocator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._blocks = {}
+        self._engine = None
+
+    def reset(self):
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def next(self, name):
+        with self._lock:
+            current, end = self._blocks.get(name, (0, 0))
+            if current < end:
+                self._blocks[name] = (current + 1, end)
+                return SERIES[name][2](current)
+
+        # reserve without holding the lock, so threads that still have numbers
+        # left never wait on a reservation
+        current, end = self._reserve(name, current_app.config['ID_BLOCK_SIZE'])
+        with self._lock:
+            # another thread may have installed a fresh block meanwhile, the
+            # rest of this one is skipped then
+            held, held_end = self._blocks.get(name, (0, 0))
+            if held >= held_end:
+                self._blocks[name] = (current + 1, end)
+        return SERIES[name][2](current)
+
+    # Reservations use their own unpooled connection: the calling request
+    # already holds one from the pool, and when every pooled connection belongs
+    # to a request waiting for ids a second checkout would never be served.
+    def _connect(self):
+        if self._engine is None:
+            self._engine = create_engine(db.engine.url, poolclass=NullPool)
+        return self._engine.begin()
+
+    def _reserve(self, name, size):
+        while True:
+            try:
+                # separate connection, so the reservation commits independently of the request
+                with self._connect() as conn:
+                    bumped = conn.execute(
+                        update(IdSequence)
+                        .where(IdSequence.name == name)
+                        .values(next_value=IdSequence.next_value + size)
+                    ).rowcount
+                    if bumped:
+                        end = conn.execute(
+                            select(IdSequence.next_value).where(IdSequence.name == name)
+                        ).scalar_one()
+                        return end - size, end
+
+                    # first use of this series: continue after the highest existing id
+                    existing, first, _ = SERIES[name]
+                    highest = conn.execute(select(func.max(existing))).scalar()
+                    start = max(first, (highest or 0) + 1)
+                    conn.execute(insert(IdSequence).values(name=name, next_value=start + size))
+                    return start, start + size
+            except IntegrityError:
+                # another process seeded the series first, take a block from it instead
+                continue
+
+# each branch has its own sequences
+allocator = PerBranch(IdAllocator)
+
+# a forked worker must not reuse the parent's reserved blocks
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=allocator.discard_all)
+
+# moves a sequence past ids that were written without it (bulk imports)
+def resync(name):
+    existing, first, _ = SERIES[name]
+    with db.engine.begin() as conn:
+        highest = conn.execute(select(func.max(existing))).scalar() or 0
+        conn.execute(
+            update(IdSequence)
+            .where(IdSequence.name == name, IdSequence.next_value <= highest)
+            .values(next_value=highest + 1)
+        )
+    allocator.reset()
+
+def next_patient_id():
+    return allocator.next('patient')
+
+def next_doctor_id():
+    return allocator.next('doctor')
+
+def next_appointment_id():
+    return allocator.next('appointment')
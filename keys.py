@@ -0,0 +1,67 @@
+from sqlalchemy import func, select, union_all, update
+from config import db
+from models import (
+    Patient, Doctor, Appointment, Treatment, ArchivedAppointment, ArchivedTreatment,
+    AppointmentStat, TreatmentMedicine, WaitlistEntry
+)
+
+# Integer surrogate keys. Appointments and treatments, live and archived,
+# reference patients and doctors by patient_key / doctor_key; the patient
+# code and doctor name they also carry are copies kept for display and for
+# the lookups that still go by name.
+
+# the key of the patient with code `patient_id`, as a subquery, so a new row
+# can reference the patient without a lookup round trip
+def patient_key(patient_id):
+    return select(Patient.patient_key).where(Patient.patient_id == patient_id).scalar_subquery()
+
+# Sets the keys of rows written without them (bulk imports, the data
+# generator) from their patient code and doctor name. Rows whose patient or
+# doctor no longer exists keep NULL.
+def fill(conn):
+    for appointment in (Appointment, ArchivedAppointment):
+        conn.execute(
+            update(appointment)
+            .where(appointment.patient_key.is_(None))
+            .values(patient_key=select(Patient.patient_key)
+                    .where(Patient.patient_id == appointment.patient_id)
+                    .scalar_subquery())
+        )
+        conn.execute(
+            update(appointment)
+            .where(appointment.doctor_key.is_(None))
+            .values(doctor_key=select(func.min(Doctor.doctor_key))
+                    .where(Doctor.doctor_name == appointment.doctor_name)
+                    .scalar_subquery())
+        )
+    for treatment in (Treatment, ArchivedTreatment):
+        conn.execute(
+            update(treatment)
+            .where(treatment.patient_key.is_(None))
+            .values(patient_key=select(Patient.patient_key)
+                    .where(Patient.patient_id == treatment.patient_id)
+                    .scalar_subquery())
+        )
+
+# Rewrites the copies of a doctor's name after a rename, in the caller's
+# transaction. Appointments and statistics are found by key; the tables that
+# only carry the name (prescriptions, waitlist) are matched on the old name,
+# which is unique among doctors (uq_doctor_name).
+def rename_doctor(doctor_key, old_name, new_name):
+    if old_name == new_name:
+        return
+    appointment_ids = union_all(*[
+        select(appointment.appointment_id).where(appointment.doctor_key == doctor_key)
+        for appointment in (Appointment, ArchivedAppointment)
+    ])
+    statements = [
+        update(Appointment).where(Appointment.doctor_key == doctor_key),
+        update(ArchivedAppointment).where(ArchivedAppointment.doctor_key == doctor_key),
+        update(TreatmentMedicine).where(TreatmentMedicine.appointment_id.in_(appointment_ids)),
+        update(AppointmentStat).where(AppointmentStat.doctor_key == doctor_key),
+        update(WaitlistEntry).where(WaitlistEntry.doctor_name == old_name),
+    ]
+    for statement in statements:
+        db.session.execute(
+            statement.values(doctor_name=new_name).execution_options(synchronize_session=False)
+        )
@@ -0,0 +1,203 @@
+import re
+from collections import Counter
+from contextlib import nullcontext
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, delete, func, insert, select, union_all
+from config import app, db
+from models import Medicine, Patient, TreatmentMedicine
+from archive import SOURCES
+from bulk import dialect_insert
+from catalog import catalog
+from pagination import keyset_paginate
+
+# Medication catalog. The free-text medicines of a treatment are split into
+# one treatment_medicine row per medicine, each pointing at a row of the
+# medicine table, so "who is on X" and "what is prescribed most" are index
+# range scans instead of a parse of every treatment. start_treatment writes
+# the rows with the treatment; `flask medicines backfill` rebuilds them from
+# the stored strings.
+
+SEPARATORS = re.compile(r'[,;\n]+')
+# list markers doctors type in front of a medicine: "- ", "* ", "1. ", "2) "
+LIST_MARKERS = re.compile(r'^(?:[-*\u2022]+|\d+[.)])\s*')
+NAME_LENGTH = 100
+
+PER_PAGE = 25
+
+# (key, name) of each medicine in a medicines string, once each, as written
+def parse(text):
+    found = {}
+    for part in SEPARATORS.split(text or ''):
+        name = ' '.join(LIST_MARKERS.sub('', part.strip()).split())[:NAME_LENGTH]
+        if name:
+            found.setdefault(name.lower(), name)
+    return list(found.items())
+
+# medicine_id per key, adding the medicines the catalog does not have yet;
+# `conn` is a connection or the session
+def medicine_ids(conn, names):
+    if not names:
+        return {}
+    stmt = dialect_insert(Medicine.__table__)
+    conn.execute(stmt.on_conflict_do_nothing(index_elements=['key']),
+                 [{'key': key, 'name': name} for key, name in names.items()])
+    return dict(conn.execute(select(Medicine.key, Medicine.medicine_id).where(Medicine.key.in_(names))).all())
+
+# treatment_medicine rows of (appointment_id, patient_id, date, doctor_name, medicines) entries
+def _rows(conn, entries):
+    parsed = [(entry, parse(entry[4])) for entry in entries]
+    names = {}
+    for _, found in parsed:
+        for key, name in found:
+            names.setdefault(key, name)
+    ids = medicine_ids(conn, names)
+    return [
+        {
+            'appointment_id': appointment_id, 'medicine_id': ids[key],
+            'patient_id': patient_id, 'date': day, 'doctor_name': doctor_name,
+        }
+        for (appointment_id, patient_id, day, doctor_name, _), found in parsed
+        for key, _ in found
+    ]
+
+# replaces the medicine rows of one appointment's treatment, in the caller's transaction
+def record(conn, appointment, medicines):
+    conn.execute(delete(TreatmentMedicine).where(TreatmentMedicine.appointment_id == appointment.appointment_id))
+    rows = _rows(conn, [(
+        appointment.appointment_id, appointment.patient_id, appointment.date,
+        appointment.doctor_name, medicines
+    )])
+    if rows:
+        conn.execute(insert(TreatmentMedicine), rows)
+
+# Rebuilds the rows of the next `batch_size` treatments, live and archived,
+# after appointment id `after`. Returns (last appointment id or None when
+# there are no more, treatments read, medicine rows written).
+def backfill_batch(conn, after, batch_size):
+    arms = []
+    for appointment, treatment in SOURCES:
+        arm = (
+            select(treatment.appointment_id, treatment.patient_id, appointment.date,
+                   appointment.doctor_name, treatment.medicines)
+            .join(appointment, appointment.appointment_id == treatment.appointment_id)
+        )
+        if after is not None:
+            arm = arm.where(treatment.appointment_id > after)
+        arms.append(arm.order_by(treatment.appointment_id).limit(batch_size).subquery().select())
+    batch = union_all(*arms).subquery('batch')
+    entries = conn.execute(
+        select(*batch.c).order_by(batch.c.appointment_id).limit(batch_size)
+    ).all()
+    if not entries:
+        return None, 0, 0
+
+    last = entries[-1].appointment_id
+    window = TreatmentMedicine.appointment_id <= last
+    if after is not None:
+        window = and_(TreatmentMedicine.appointment_id > after, window)
+    conn.execute(delete(TreatmentMedicine).where(window))
+    rows = _rows(conn, entries)
+    if rows:
+        conn.execute(insert(TreatmentMedicine), rows)
+    return last, len(entries), len(rows)
+
+# Walks every treatment once, `batch_size` per transaction opened by `begin`.
+# Safe to re-run: each batch replaces the rows of its id range.
+def backfill(begin, batch_size, echo=None):
+    last = None
+    treatments = rows = 0
+    while True:
+        with begin() as conn:
+            last, read, written = backfill_batch(conn, last, batch_size)
+        if last is None:
+            break
+        treatments += read
+        rows += written
+        if echo:
+            echo(f"{treatments} treatments, {rows} medicine rows")
+    return treatments, rows
+
+def backfill_in(conn, batch_size):
+    return backfill(lambda: nullcontext(conn), batch_size)
+
+# medicines whose name starts with `prefix`, for the lookup box
+def find(prefix, limit=20):
+    key = ' '.join(prefix.split()).lower()
+    if not key:
+        return []
+    return db.session.execute(
+        select(Medicine.medicine_id, Medicine.name)
+        .where(Medicine.key >= key, Medicine.key < key + '\uffff')
+        .order_by(Medicine.key)
+        .limit(limit)
+    ).all()
+
+# Patients prescribed the medicine on or after `since`, most recently
+# prescribed first, one page at a time.
+def patients_on(medicine_id, since, cursor=None, per_page=PER_PAGE):
+    latest = (
+        select(
+            TreatmentMedicine.patient_id,
+            func.max(TreatmentMedicine.date).label('last_prescribed'),
+            func.count().label('prescriptions')
+        )
+        .where(TreatmentMedicine.medicine_id == medicine_id, TreatmentMedicine.date >= since)
+        .group_by(TreatmentMedicine.patient_id)
+        .subquery('latest')
+    )
+    query = (
+        db.session.query(latest.c.patient_id, Patient.patient_name, latest.c.last_prescribed, latest.c.prescriptions)
+        .join(Patient, Patient.patient_id == latest.c.patient_id)
+    )
+    return keyset_paginate(
+        query, latest.c.last_prescribed, latest.c.patient_id,
+        cursor=cursor, descending=True, per_page=per_page,
+        key=lambda row: [row.last_prescribed, row.patient_id]
+    )
+
+# [(doctor_name, medicine_id, prescriptions)] between two days, inclusive
+def prescribing(start, end):
+    return db.session.execute(
+        select(TreatmentMedicine.doctor_name, TreatmentMedicine.medicine_id, func.count())
+        .where(TreatmentMedicine.date >= start, TreatmentMedicine.date <= end)
+        .group_by(TreatmentMedicine.doctor_name, TreatmentMedicine.medicine_id)
+    ).all()
+
+# Most prescribed medicines overall and per department between two days:
+# (overall, [(department_name, top)]) where each top is a list of
+# (medicine_id, name, prescriptions). Doctors map to departments through
+# the catalog, as in the appointment reports.
+def top_medicines(start, end, limit=10):
+    overall = Counter()
+    departments = {}
+    for doctor_name, medicine_id, count in prescribing(start, end):
+        doctor = catalog.doctor_by_name(doctor_name)
+        name = doctor.department.department_name if doctor and doctor.department else 'Unknown'
+        departments.setdefault(name, Counter())[medicine_id] += count
+        overall[medicine_id] += count
+
+    names = {}
+    if overall:
+        names = dict(db.session.execute(
+            select(Medicine.medicine_id, Medicine.name).where(Medicine.medicine_id.in_(overall))
+        ).all())
+
+    def top(counts):
+        return [(medicine_id, names.get(medicine_id), count) for medicine_id, count in counts.most_common(limit)]
+
+    return top(overall), [(name, top(counts)) for name, counts in sorted(departments.items())]
+
+medicines_cli = AppGroup('medicines', help='Maintain the medication catalog.')
+
+@medicines_cli.command('backfill')
+@click.option('--batch-size', type=int, help='Treatments per transaction (default: MEDICINE_BACKFILL_BATCH).')
+def backfill_command(batch_size):
+    """Rebuild the medicine rows of every treatment from its medicines text."""
+    batch_size = batch_size or current_app.config['MEDICINE_BACKFILL_BATCH']
+    treatments, rows = backfill(db.engine.begin, batch_size, echo=lambda msg: click.echo(msg, err=True))
+    count = db.session.execute(select(func.count()).select_from(Medicine)).scalar()
+    click.echo(f"{treatments} treatments, {rows} prescriptions of {count} medicines")
+
+app.cli.add_command(medicines_cli)
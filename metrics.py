@@ -0,0 +1,310 @@
+import glob
+import hmac
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from flask import Response, abort, g, has_request_context, request
+from flask import before_render_template, request_finished, request_started, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import app
+
+# Per-request instrumentation: every SQL statement and template render run
+# while a request is being served is timed and added to that request's
+# totals, which are folded into per-endpoint counters when it finishes.
+# Counters live in this process. Under gunicorn (see gunicorn.conf.py) every
+# worker also writes its counters to a file in METRICS_DIR every
+# METRICS_FLUSH_SECONDS, and /metrics serves the sum over all those files,
+# so a scrape sees the whole server whichever worker answers it.
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# literals and expanded IN lists, so one loop over ids is one statement shape
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PARAM_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+SPACES = re.compile(r"\s+")
+
+def statement_shape(statement):
+    shape = LITERALS.sub('?', statement)
+    shape = PARAM_LISTS.sub('(?)', shape)
+    return SPACES.sub(' ', shape).strip()
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, data):
+        self.counts = [a + b for a, b in zip(self.counts, data['counts'])]
+        self.sum += data['sum']
+        self.count += data['count']
+
+    def dump(self):
+        return {'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+class EndpointStats:
+    def __init__(self):
+        self.responses = Counter()        # status code -> requests
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.sql_seconds = 0.0
+        self.render_seconds = 0.0
+        self.n_plus_one = 0
+
+    def merge(self, data):
+        self.responses.update({int(status): count for status, count in data['responses'].items()})
+        self.duration.merge(data['duration'])
+        self.queries.merge(data['queries'])
+        self.sql_seconds += data['sql_seconds']
+        self.render_seconds += data['render_seconds']
+        self.n_plus_one += data['n_plus_one']
+
+    def dump(self):
+        return {
+            'responses': dict(self.responses),
+            'duration': self.duration.dump(),
+            'queries': self.queries.dump(),
+            'sql_seconds': self.sql_seconds,
+            'render_seconds': self.render_seconds,
+            'n_plus_one': self.n_plus_one,
+        }
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.dirty = False
+
+    def record(self, endpoint, status, total, queries, sql_seconds, render_seconds, n_plus_one):
+        with self._lock:
+            stats = self._endpoints.get(endpoint)
+            if stats is None:
+                stats = self._endpoints[endpoint] = EndpointStats()
+            stats.responses[status] += 1
+            stats.duration.observe(total)
+            stats.queries.observe(queries)
+            stats.sql_seconds += sql_seconds
+            stats.render_seconds += render_seconds
+            stats.n_plus_one += n_plus_one
+            self.dirty = True
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def merge(self, dumped):
+        with self._lock:
+            for endpoint, data in dumped.items():
+                stats = self._endpoints.get(endpoint)
+                if stats is None:
+                    stats = self._endpoints[endpoint] = EndpointStats()
+                stats.merge(data)
+
+    def dump(self):
+        with self._lock:
+            self.dirty = False
+            return {endpoint: stats.dump() for endpoint, stats in self._endpoints.items()}
+
+    # Prometheus text exposition format 0.0.4
+    def render(self):
+        lines = []
+
+        def header(name, kind, help):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, endpoint, hist):
+            for bound, count in zip(hist.buckets, hist.counts):
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="+Inf"}} {hist.count}')
+            lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {hist.sum}')
+            lines.append(f'{name}_count{{endpoint="{endpoint}"}} {hist.count}')
+
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+
+            header('hms_requests_total', 'counter', 'Requests served, by endpoint and status code.')
+            for endpoint, stats in endpoints:
+                for status, count in sorted(stats.responses.items()):
+                    lines.append(f'hms_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+
+            header('hms_request_duration_seconds', 'histogram', 'Total time spent serving a request.')
+            for endpoint, stats in endpoints:
+                histogram('hms_request_duration_seconds', endpoint, stats.duration)
+
+            header('hms_request_sql_queries', 'histogram', 'SQL statements executed per request.')
+            for endpoint, stats in endpoints:
+                histogram('hms_request_sql_queries', endpoint, stats.queries)
+
+            header('hms_request_sql_seconds_total', 'counter', 'Time spent executing SQL statements.')
+            for endpoint, stats in endpoints:
+                lines.append(f'hms_request_sql_seconds_total{{endpoint="{endpoint}"}} {stats.sql_seconds}')
+
+            header('hms_request_render_seconds_total', 'counter', 'Time spent rendering templates.')
+            for endpoint, stats in endpoints:
+                lines.append(f'hms_request_render_seconds_total{{endpoint="{endpoint}"}} {stats.render_seconds}')
+
+            header('hms_n_plus_one_total', 'counter', 'Statement shapes repeated more than N_PLUS_ONE_THRESHOLD times in one request.')
+            for endpoint, stats in endpoints:
+                lines.append(f'hms_n_plus_one_total{{endpoint="{endpoint}"}} {stats.n_plus_one}')
+
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+# --- counters shared between worker processes
+
+def _worker_file(directory):
+    return os.path.join(directory, f"worker-{os.getpid()}.json")
+
+# writes this worker's counters to its file in METRICS_DIR
+def flush():
+    directory = app.config['METRICS_DIR']
+    if not directory:
+        return
+    path = _worker_file(directory)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(registry.dump(), f)
+    os.replace(tmp, path)
+
+# the counters of every worker, from their files, this worker's taken live;
+# files of exited workers stay, so the totals never go backwards
+def combined():
+    directory = app.config['METRICS_DIR']
+    if not directory:
+        return registry
+    total = Registry()
+    total.merge(registry.dump())
+    own = _worker_file(directory)
+    for path in glob.glob(os.path.join(directory, 'worker-*.json')):
+        if path == own:
+            continue
+        try:
+            with open(path) as f:
+                total.merge(json.load(f))
+        except (FileNotFoundError, ValueError):
+            continue  # replaced or half written meanwhile
+    return total
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+def _flush_periodically():
+    while True:
+        time.sleep(app.config['METRICS_FLUSH_SECONDS'])
+        if registry.dirty:
+            flush()
+
+# started by the first request of each worker, so it runs after the fork
+def _start_flusher():
+    global _flusher
+    with _flusher_lock:
+        if _flusher is None or _flusher.pid != os.getpid():
+            thread = threading.Thread(target=_flush_periodically, name='metrics-flush', daemon=True)
+            thread.pid = os.getpid()
+            thread.start()
+            _flusher = thread
+
+# Called by gunicorn in the master before the workers start: the counters of
+# the previous run are dropped and the workers share METRICS_DIR (by default
+# instance/metrics).
+def share_between_workers():
+    directory = app.config['METRICS_DIR'] or os.path.join(app.instance_path, 'metrics')
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, 'worker-*.json*')):
+        os.remove(path)
+    app.config['METRICS_DIR'] = directory
+
+def _tracking():
+    return has_request_context() and 'metrics_started' in g
+
+# --- SQLAlchemy engine events, for every engine the app creates
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _tracking():
+        g.metrics_sql_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    if _tracking() and 'metrics_sql_started' in g:
+        g.metrics_sql_seconds += time.perf_counter() - g.pop('metrics_sql_started')
+        g.metrics_shapes[statement_shape(statement)] += 1
+
+# --- Flask signals
+
+@before_render_template.connect_via(app)
+def _before_render(sender, template, context, **extra):
+    if _tracking():
+        g.metrics_render_started = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def _after_render(sender, template, context, **extra):
+    if _tracking() and 'metrics_render_started' in g:
+        g.metrics_render_seconds += time.perf_counter() - g.pop('metrics_render_started')
+
+@request_started.connect_via(app)
+def _request_started(sender, **extra):
+    if not app.config['METRICS_ENABLED']:
+        return
+    g.metrics_started = time.perf_counter()
+    g.metrics_sql_seconds = 0.0
+    g.metrics_render_seconds = 0.0
+    g.metrics_shapes = Counter()
+
+@request_finished.connect_via(app)
+def _request_finished(sender, response, **extra):
+    if not _tracking() or request.endpoint == 'metrics':
+        return
+    total = time.perf_counter() - g.metrics_started
+    endpoint = request.endpoint or 'unmatched'
+    shapes = g.metrics_shapes
+
+    threshold = app.config['N_PLUS_ONE_THRESHOLD']
+    repeated = [(count, shape) for shape, count in shapes.items() if count > threshold]
+    for count, shape in repeated:
+        app.logger.warning("possible N+1 in %s: statement ran %d times: %s", endpoint, count, shape)
+
+    registry.record(
+        endpoint, response.status_code, total, sum(shapes.values()),
+        g.metrics_sql_seconds, g.metrics_render_seconds, len(repeated)
+    )
+    if app.config['METRICS_DIR']:
+        _start_flusher()
+
+# A reverse proxy on the same host makes every request look local, so the
+# local-only default also turns away requests a proxy forwarded; set
+# METRICS_TOKEN to scrape through a proxy or from another host.
+FORWARDED_HEADERS = ('Forwarded', 'X-Forwarded-For', 'X-Real-IP')
+
+def _allowed():
+    token = app.config['METRICS_TOKEN']
+    if token:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}")
+    if not app.config['METRICS_LOCAL_ONLY']:
+        return True
+    return (
+        request.remote_addr in ('127.0.0.1', '::1')
+        and not any(header in request.headers for header in FORWARDED_HEADERS)
+    )
+
+#Prometheus scrape endpoint, for METRICS_TOKEN bearers or direct local requests
+@app.route('/metrics')
+def metrics():
+    if not _allowed():
+        abort(404)
+    return Response(combined().render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,360 @@
+import click
+from sqlalchemy import func, inspect, select, text
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from config import app, current_branch, db
+from models import SchemaVersion
+import branches
+
+# Ordered schema migrations for databases created before a model change.
+# Each one is a function of an open connection and must be safe to re-run
+# (IF NOT EXISTS), because db.create_all() already builds the latest schema
+# on a fresh database and the migrations are then applied on top of it.
+MIGRATIONS = []
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def current_version(conn):
+    return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+def pending(conn):
+    version = current_version(conn)
+    return [m for m in MIGRATIONS if m[0] > version]
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+def _stored_version():
+    try:
+        with db.engine.connect() as conn:
+            return current_version(conn)
+    except DBAPIError:
+        return 0
+
+# why the current branch's database cannot be served, or None
+def schema_problem():
+    version = _stored_version()
+    if version == latest_version():
+        return None
+    return (
+        f"database schema of branch {current_branch()} is at version {version} but the code "
+        f"expects {latest_version()}; run `flask --app app init-db` for a new database "
+        f"or `flask --app app upgrade-db` for an existing one"
+    )
+
+# Startup gate: refuse to serve a main branch database the code does not
+# match. Any other branch that does not match is only marked unavailable,
+# so one broken branch does not take the others down.
+def check_schema():
+    for branch in branches.names():
+        with branches.using(branch):
+            problem = schema_problem()
+        if problem and branch == app.config['MAIN_BRANCH']:
+            raise SchemaOutOfDate(problem)
+        if problem:
+            branches.mark_unavailable(branch, problem)
+        else:
+            branches.mark_available(branch)
+    clashing = branches.clashing_names()
+    if clashing:
+        raise RuntimeError(f"branch names {', '.join(clashing)} are also routes of the app, rename them")
+    return latest_version()
+
+def upgrade(echo=None):
+    SchemaVersion.__table__.create(db.engine, checkfirst=True)
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        try:
+            with db.engine.begin() as conn:
+                if current_version(conn) >= version:
+                    continue
+                fn(conn)
+                conn.execute(SchemaVersion.__table__.insert().values(
+                    version=version, description=description
+                ))
+        except IntegrityError:
+            # another worker recorded this version first
+            continue
+        applied.append(version)
+        if echo:
+            echo(f"applied {version}: {description}")
+    return applied
+
+@migration(1, "unique live slot per doctor")
+def _slot_index(conn):
+    clashes = conn.execute(text(
+        "SELECT doctor_name, date, time, COUNT(*) FROM appointment "
+        "WHERE status != 'Cancelled' GROUP BY doctor_name, date, time HAVING COUNT(*) > 1"
+    )).all()
+    if clashes:
+        raise click.ClickException(
+            "double-booked slots must be cancelled before upgrading: " +
+            ", ".join(f"{d} {day} {t}" for d, day, t, _ in clashes)
+        )
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_appointment_slot "
+        "ON appointment (doctor_name, date, time) WHERE status != 'Cancelled'"
+    ))
+
+@migration(2, "indexes for login, dashboard and history lookups")
+def _hot_lookup_indexes(conn):
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS ix_patient_name ON patient (patient_name)",
+        "CREATE INDEX IF NOT EXISTS ix_doctor_name ON doctor (doctor_name)",
+        "CREATE INDEX IF NOT EXISTS ix_doctor_department ON doctor (department_id)",
+        "CREATE INDEX IF NOT EXISTS ix_appointment_doctor_date_status ON appointment (doctor_name, date, status)",
+        "CREATE INDEX IF NOT EXISTS ix_appointment_patient_date ON appointment (patient_id, date)",
+        "CREATE INDEX IF NOT EXISTS ix_treatment_appointment ON treatment (appointment_id)",
+    ):
+        conn.execute(text(statement))
+
+# filled by migration 11, once appointments carry doctor keys
+@migration(3, "appointment statistics tables")
+def _stats_tables(conn):
+    from models import AppointmentStat, StatCounter
+
+    AppointmentStat.__table__.create(conn, checkfirst=True)
+    StatCounter.__table__.create(conn, checkfirst=True)
+
+@migration(4, "treatment full-text search index")
+def _treatment_search(conn):
+    from search import rebuild
+
+    rebuild(conn)
+
+@migration(5, "index for a doctor's completed patients")
+def _completed_patients_index(conn):
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_appointment_doctor_status_patient "
+        "ON appointment (doctor_name, status, patient_id)"
+    ))
+
+@migration(6, "appointment and treatment archive tables")
+def _archive_tables(conn):
+    from models import ArchivedAppointment, ArchivedTreatment
+    from search import install
+
+    ArchivedAppointment.__table__.create(conn, checkfirst=True)
+    ArchivedTreatment.__table__.create(conn, checkfirst=True)
+    # archiving a treatment must keep its search entry
+    install(conn)
+
+@migration(7, "medicine catalog and per-treatment medicine rows")
+def _medicine_catalog(conn):
+    from models import Medicine, TreatmentMedicine
+    from medicines import backfill_in
+
+    Medicine.__table__.create(conn, checkfirst=True)
+    TreatmentMedicine.__table__.create(conn, checkfirst=True)
+    backfill_in(conn, app.config['MEDICINE_BACKFILL_BATCH'])
+
+@migration(8, "appointment waitlist")
+def _waitlist(conn):
+    from models import WaitlistEntry
+
+    WaitlistEntry.__table__.create(conn, checkfirst=True)
+
+# SQLite cannot change a primary key in place: copies the rows into a table
+# of the model's shape, then swaps it in (foreign key checks are off).
+# `values` are the SELECT expressions for `columns`.
+def _rebuild(conn, table, columns, values):
+    rebuilt = table.name + '__rekey'
+    # left behind by an earlier attempt: pysqlite commits CREATE TABLE on its own
+    conn.execute(text(f"DROP TABLE IF EXISTS {rebuilt}"))
+    ddl = str(CreateTable(table).compile(conn))
+    create = ddl.replace(f"CREATE TABLE {table.name} (", f"CREATE TABLE {rebuilt} (", 1)
+    assert create != ddl
+    conn.execute(text(create))
+    conn.execute(text(
+        f"INSERT INTO {rebuilt} ({', '.join(columns)}) SELECT {', '.join(values)} FROM {table.name}"
+    ))
+    conn.execute(text(f"DROP TABLE {table.name}"))
+    conn.execute(text(f"ALTER TABLE {rebuilt} RENAME TO {table.name}"))
+    for index in table.indexes:
+        index.create(conn)
+
+# Makes `key` the integer primary key of `table` and its old primary key
+# `code` a unique column. Existing rows are numbered in their storage order.
+def _rekey(conn, table, key, code):
+    columns = [column['name'] for column in inspect(conn).get_columns(table.name)]
+    if key in columns:
+        return
+    if conn.dialect.name == 'sqlite':
+        _rebuild(conn, table, [key] + columns, ['rowid'] + columns)
+    else:
+        primary_key = inspect(conn).get_pk_constraint(table.name)['name']
+        conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {key} SERIAL"))
+        # drops the foreign keys to the code too; _restore_foreign_keys puts them back
+        conn.execute(text(f"ALTER TABLE {table.name} DROP CONSTRAINT {primary_key} CASCADE"))
+        conn.execute(text(f"ALTER TABLE {table.name} ADD PRIMARY KEY ({key})"))
+        conn.execute(text(f"ALTER TABLE {table.name} ADD UNIQUE ({code})"))
+
+def _restore_foreign_keys(conn, targets):
+    inspector = inspect(conn)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {
+            (tuple(fk['constrained_columns']), fk['referred_table'])
+            for fk in inspector.get_foreign_keys(table.name)
+        }
+        for fk in table.foreign_key_constraints:
+            columns = tuple(column.name for column in fk.columns)
+            if fk.referred_table.name in targets and (columns, fk.referred_table.name) not in existing:
+                referred = ', '.join(element.column.name for element in fk.elements)
+                conn.execute(text(
+                    f"ALTER TABLE {table.name} ADD FOREIGN KEY ({', '.join(columns)}) "
+                    f"REFERENCES {fk.referred_table.name} ({referred})"
+                ))
+
+@migration(9, "integer surrogate keys for patients and doctors")
+def _surrogate_keys(conn):
+    from models import Patient, Doctor, Appointment, Treatment, ArchivedAppointment, ArchivedTreatment
+    from keys import fill
+
+    _rekey(conn, Patient.__table__, 'patient_key', 'patient_id')
+    _rekey(conn, Doctor.__table__, 'doctor_key', 'doctor_id')
+    if conn.dialect.name != 'sqlite':
+        _restore_foreign_keys(conn, {'patient', 'doctor'})
+
+    references = [
+        (Appointment, 'patient_key', 'patient'), (Appointment, 'doctor_key', 'doctor'),
+        (Treatment, 'patient_key', 'patient'),
+        (ArchivedAppointment, 'patient_key', None), (ArchivedAppointment, 'doctor_key', None),
+        (ArchivedTreatment, 'patient_key', None),
+    ]
+    for model, column, target in references:
+        table = model.__tablename__
+        if column in [c['name'] for c in inspect(conn).get_columns(table)]:
+            continue
+        reference = f" REFERENCES {target} ({column})" if target else ""
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} INTEGER{reference}"))
+    fill(conn)
+
+    # the completed-patients lookup now goes by key
+    conn.execute(text("DROP INDEX IF EXISTS ix_appointment_doctor_status_patient"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_appointment_archive_doctor_status_patient"))
+    for model in (Appointment, Treatment, ArchivedAppointment, ArchivedTreatment):
+        for index in model.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+@migration(10, "unique doctor names")
+def _unique_doctor_names(conn):
+    duplicates = conn.execute(text(
+        "SELECT doctor_name, COUNT(*) FROM doctor GROUP BY doctor_name HAVING COUNT(*) > 1"
+    )).all()
+    if duplicates:
+        raise click.ClickException(
+            "doctors sharing a name must be renamed before upgrading: " +
+            ", ".join(f"{name} ({count} doctors)" for name, count in duplicates)
+        )
+    conn.execute(text("DROP INDEX IF EXISTS ix_doctor_name"))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_doctor_name ON doctor (doctor_name)"))
+
+# SQLite hands a deleted row's INTEGER PRIMARY KEY out again unless the
+# table is AUTOINCREMENT; rebuilds `table` that way and starts its sequence
+# after every key still referenced. SERIAL never reuses a value.
+def _never_reuse(conn, table, key):
+    if conn.dialect.name != 'sqlite':
+        return
+    ddl = conn.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table.name}
+    ).scalar()
+    if 'AUTOINCREMENT' not in ddl.upper():
+        columns = [column['name'] for column in inspect(conn).get_columns(table.name)]
+        _rebuild(conn, table, columns, columns)
+    inspector = inspect(conn)
+    highest = max(
+        conn.execute(text(f"SELECT MAX({key}) FROM {name}")).scalar() or 0
+        for name in inspector.get_table_names()
+        if key in [column['name'] for column in inspector.get_columns(name)]
+    )
+    conn.execute(text("DELETE FROM sqlite_sequence WHERE name = :name"), {'name': table.name})
+    conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"),
+                 {'name': table.name, 'seq': highest})
+
+# Slots, occupancy and statistics go by doctor_key, so a new doctor who
+# takes a deleted doctor's name starts with none of that doctor's bookings.
+@migration(11, "slots and statistics by doctor key")
+def _doctor_key_slots(conn):
+    from models import Patient, Doctor, Appointment, AppointmentStat, WaitlistEntry, Waitlist_status
+    from stats import rebuild
+
+    _never_reuse(conn, Patient.__table__, 'patient_key')
+    _never_reuse(conn, Doctor.__table__, 'doctor_key')
+
+    clashes = conn.execute(text(
+        "SELECT MIN(doctor_name), date, time, COUNT(*) FROM appointment "
+        "WHERE status != 'Cancelled' AND doctor_key IS NOT NULL "
+        "GROUP BY doctor_key, date, time HAVING COUNT(*) > 1"
+    )).all()
+    if clashes:
+        raise click.ClickException(
+            "double-booked slots must be cancelled before upgrading: " +
+            ", ".join(f"{d} {day} {t}" for d, day, t, _ in clashes)
+        )
+    conn.execute(text("DROP INDEX IF EXISTS uq_appointment_slot"))
+    for index in Appointment.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+    AppointmentStat.__table__.drop(conn, checkfirst=True)
+    AppointmentStat.__table__.create(conn)
+    rebuild(conn)
+
+    # waiting entries of doctors deleted before delete_doctor withdrew them
+    conn.execute(
+        WaitlistEntry.__table__.update()
+        .where(
+            WaitlistEntry.status == Waitlist_status.Waiting,
+            WaitlistEntry.doctor_name.is_not(None),
+            WaitlistEntry.doctor_name.not_in(select(Doctor.doctor_name))
+        )
+        .values(status=Waitlist_status.Withdrawn)
+    )
+
+# every branch's database, each in its own app context
+def _each_branch():
+    for branch in branches.names():
+        with branches.using(branch):
+            if len(branches.names()) > 1:
+                click.echo(f"branch {branch}:")
+            yield
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables and bring the schema to the latest version."""
+    for _ in _each_branch():
+        db.metadata.create_all(db.engine)
+        upgrade(echo=click.echo)
+        click.echo(f"schema is at version {latest_version()}")
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Apply pending schema migrations to every branch's database."""
+    for _ in _each_branch():
+        db.metadata.create_all(db.engine)
+        applied = upgrade(echo=click.echo)
+        if not applied:
+            click.echo(f"schema is up to date (version {latest_version()})")
+
+@app.cli.command('seed')
+def seed_command():
+    """Insert the default departments and doctors (existing rows are kept)."""
+    from catalog import catalog
+    from models import insert_departments, insert_doctors
+    from stats import refresh_counters
+
+    insert_departments()
+    insert_doctors()
+    with db.engine.begin() as conn:
+        refresh_counters(conn)
+    catalog.invalidate()
+    click.echo("seeded departments and doctors")
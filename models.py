@@ -1,48 +1,233 @@
 from datetime import datetime
 from enum import Enum
 from config import db
+from bulk import conflict_insert
 
+# Patients and doctors are keyed by an integer surrogate; the "P001"/"D001"
+# codes shown in the UI and URLs stay as unique columns. A key is never
+# handed out again after its row is deleted (AUTOINCREMENT on SQLite), since
+# appointments, treatments and statistics keep referencing it.
 class Patient(db.Model):
-    patient_id = db.Column(db.String(10), primary_key=True)
+    patient_key = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.String(10), nullable=False, unique=True)
     patient_name = db.Column(db.String(50), nullable=False)
     password = db.Column(db.String(8), nullable=False)
     email = db.Column(db.String(30), nullable=True)
     contact_no = db.Column(db.String(10),  nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_patient_name', 'patient_name'),
+        {'sqlite_autoincrement': True},
+    )
+
 class Doctor(db.Model):
-    doctor_id = db.Column(db.String(10), primary_key=True)
+    doctor_key = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.String(10), nullable=False, unique=True)
     doctor_name = db.Column(db.String(50), nullable=False)
     department_id = db.Column(db.Integer, db.ForeignKey('department.department_id'), nullable=False)
     specialization = db.Column(db.String(80), nullable=False)
 
     department = db.relationship('Department', backref='doctors')
 
+    __table_args__ = (
+        # doctors log in, and the waitlist and prescriptions are kept, by name
+        db.Index('uq_doctor_name', 'doctor_name', unique=True),
+        db.Index('ix_doctor_department', 'department_id'),
+        {'sqlite_autoincrement': True},
+    )
+
+# per-doctor working hours; doctors without rows use the default template in slots.py
+class DoctorSchedule(db.Model):
+    doctor_id = db.Column(db.String(10), db.ForeignKey('doctor.doctor_id'), primary_key=True)
+    weekday = db.Column(db.Integer, primary_key=True)        # 0 = Monday ... 6 = Sunday
+    start_time = db.Column(db.String(5), primary_key=True)   # "09:00"
+    end_time = db.Column(db.String(5), nullable=False)       # "13:00"
+    slot_minutes = db.Column(db.Integer, nullable=False, default=60)
+
 class Department(db.Model):
     department_id = db.Column(db.Integer, primary_key=True)
     department_name = db.Column(db.String(80), nullable=False)
     department_description = db.Column(db.String(100), nullable=False)
     doctors_registered = db.Column(db.Integer, nullable=False)
 
+# patient_key is the reference, but the primary key is still the patient code:
+# treatments of patients deleted before the keys were added have no key
 class Treatment(db.Model):
     patient_id = db.Column(db.String(10), db.ForeignKey('patient.patient_id'), nullable=False, primary_key=True)
     appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.appointment_id'), nullable=False, primary_key=True)
+    patient_key = db.Column(db.Integer, db.ForeignKey('patient.patient_key'), nullable=True)
     test_done = db.Column(db.String(100), nullable=False)
     diagnosis = db.Column(db.String(200), nullable=False)
     prescription = db.Column(db.String(200), nullable=False)
     medicines = db.Column(db.String(300), nullable=False)
 
+    # lookups by patient_id use the primary key index
+    __table_args__ = (
+        db.Index('ix_treatment_appointment', 'appointment_id'),
+        db.Index('ix_treatment_patient_key', 'patient_key', 'appointment_id'),
+    )
+
+# one row per applied migration, see migrations.py
+class SchemaVersion(db.Model):
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+# next unallocated number per id series ("patient", "doctor", "appointment"), see ids.py
+class IdSequence(db.Model):
+    name = db.Column(db.String(20), primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False)
+
 class Appointment_status(Enum):
     Booked = "booked"
     Cancelled = "cancelled"
     Completed = "completed"
 
+# patient_key and doctor_key are the references; patient_id and doctor_name
+# are copies of the patient's code and the doctor's name for display and the
+# lookups by name (a doctor rename rewrites them, see keys.py). The keys are
+# NULL only on rows whose patient or doctor was already gone when they were added.
 class Appointment(db.Model):
     appointment_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    patient_id = db.Column(db.String(10), db.ForeignKey('patient.patient_id'), nullable=False)
-    doctor_name = db.Column(db.String(30), db.ForeignKey('doctor.doctor_name'), nullable=False)
+    patient_id = db.Column(db.String(10), nullable=False)
+    doctor_name = db.Column(db.String(30), nullable=False)
     date = db.Column(db.Date, nullable=False)
     time = db.Column(db.String(30), nullable=False)
     status = db.Column(db.Enum(Appointment_status), nullable=False, default=Appointment_status.Booked)
+    patient_key = db.Column(db.Integer, db.ForeignKey('patient.patient_key'), nullable=True)
+    doctor_key = db.Column(db.Integer, db.ForeignKey('doctor.doctor_key'), nullable=True)
+
+    patient = db.relationship('Patient')
+
+    # a doctor's slot can only be held by one live appointment; cancelling frees it
+    __table_args__ = (
+        db.Index('ix_appointment_doctor_date_status', 'doctor_name', 'date', 'status'),
+        db.Index('ix_appointment_patient_date', 'patient_id', 'date'),
+        db.Index('ix_appointment_doctor_key_date', 'doctor_key', 'date', 'status'),
+        db.Index('ix_appointment_patient_key_date', 'patient_key', 'date'),
+        db.Index('ix_appointment_doctor_key_status_patient', 'doctor_key', 'status', 'patient_key'),
+        db.Index(
+            'uq_appointment_slot', 'doctor_key', 'date', 'time',
+            unique=True,
+            sqlite_where=db.text("status != 'Cancelled'"),
+            postgresql_where=db.text("status != 'Cancelled'")
+        ),
+    )
+
+class Waitlist_status(Enum):
+    Waiting = "waiting"
+    Fulfilled = "fulfilled"
+    Withdrawn = "withdrawn"
+    Expired = "expired"
+
+# Patients waiting for a slot with one doctor (doctor_name) or with any doctor
+# of a department (department_id) on a day between start_date and end_date.
+# When an appointment is cancelled, waitlist.py books the freed slot for the
+# longest-waiting eligible entry in the same transaction.
+class WaitlistEntry(db.Model):
+    __tablename__ = 'waitlist'
+
+    entry_id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.String(10), db.ForeignKey('patient.patient_id'), nullable=False)
+    doctor_name = db.Column(db.String(30), nullable=True)
+    department_id = db.Column(db.Integer, nullable=True)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    status = db.Column(db.Enum(Waitlist_status), nullable=False, default=Waitlist_status.Waiting)
+    appointment_id = db.Column(db.Integer, nullable=True)   # the slot it was given
+
+    # the queues, oldest first; the dates and patient are in the index so
+    # finding the first eligible waiter never reads the table
+    __table_args__ = (
+        db.Index('ix_waitlist_doctor_queue', 'doctor_name', 'status', 'created_at', 'entry_id',
+                 'start_date', 'end_date', 'patient_id'),
+        db.Index('ix_waitlist_department_queue', 'department_id', 'status', 'created_at', 'entry_id',
+                 'start_date', 'end_date', 'patient_id'),
+        db.Index('ix_waitlist_patient', 'patient_id', 'status'),
+    )
+
+# Completed and cancelled appointments past the retention window, and their
+# treatments, moved out of the live tables by archive.py. Same columns as the
+# live tables; no foreign keys, so archived history outlives its references.
+class ArchivedAppointment(db.Model):
+    __tablename__ = 'appointment_archive'
+
+    appointment_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    patient_id = db.Column(db.String(10), nullable=False)
+    doctor_name = db.Column(db.String(30), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    time = db.Column(db.String(30), nullable=False)
+    status = db.Column(db.Enum(Appointment_status), nullable=False)
+    patient_key = db.Column(db.Integer, nullable=True)
+    doctor_key = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_appointment_archive_patient_date', 'patient_id', 'date'),
+        db.Index('ix_appointment_archive_doctor_date', 'doctor_name', 'date'),
+        db.Index('ix_appointment_archive_doctor_key_date', 'doctor_key', 'date'),
+        db.Index('ix_appointment_archive_patient_key_date', 'patient_key', 'date'),
+        db.Index('ix_appointment_archive_doctor_key_status_patient', 'doctor_key', 'status', 'patient_key'),
+    )
+
+class ArchivedTreatment(db.Model):
+    __tablename__ = 'treatment_archive'
+
+    patient_id = db.Column(db.String(10), primary_key=True)
+    appointment_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    test_done = db.Column(db.String(100), nullable=False)
+    diagnosis = db.Column(db.String(200), nullable=False)
+    prescription = db.Column(db.String(200), nullable=False)
+    medicines = db.Column(db.String(300), nullable=False)
+    patient_key = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_treatment_archive_appointment', 'appointment_id'),
+        db.Index('ix_treatment_archive_patient_key', 'patient_key', 'appointment_id'),
+    )
+
+# one row per distinct medicine written in a treatment; `key` is the name
+# lowercased with single spaces, so "Paracetamol  500mg" and "paracetamol
+# 500mg" are the same medicine
+class Medicine(db.Model):
+    medicine_id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(100), nullable=False, unique=True)
+    name = db.Column(db.String(100), nullable=False)
+
+# The medicines of each treatment, live or archived, as rows: medicines.py
+# writes them with the treatment and they stay when it is archived. The
+# appointment's patient, date and doctor are copied in so the pharmacy
+# lookups never touch the appointment tables.
+class TreatmentMedicine(db.Model):
+    __tablename__ = 'treatment_medicine'
+
+    appointment_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.medicine_id'), primary_key=True)
+    patient_id = db.Column(db.String(10), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    doctor_name = db.Column(db.String(30), nullable=False)
+
+    __table_args__ = (
+        # patients on a medicine, newest prescriptions first
+        db.Index('ix_treatment_medicine_medicine_date', 'medicine_id', 'date', 'patient_id'),
+        # prescribing counts over a period, per doctor and department
+        db.Index('ix_treatment_medicine_date', 'date', 'doctor_name', 'medicine_id', 'patient_id'),
+    )
+
+# appointments per day, doctor and status, kept up to date by stats.py in the
+# same transaction as every booking and status change. doctor_name is a copy
+# for the reports; appointments without a doctor key count under key 0.
+class AppointmentStat(db.Model):
+    date = db.Column(db.Date, primary_key=True)
+    doctor_key = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.Enum(Appointment_status), primary_key=True)
+    doctor_name = db.Column(db.String(50), nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+# running totals ("patients", "doctors", "appointments")
+class StatCounter(db.Model):
+    name = db.Column(db.String(20), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
 
 departments = [
     (1001, "Eyes", "Vision-related problems and diseases.", 2),
@@ -90,24 +275,27 @@ doctors = [
     ("D030", "Dr. Amit Desai", 1010, "Neurology, Stroke, Neurodegenerative diseases"),
 ]
 
+# one batched INSERT ... ON CONFLICT DO NOTHING per table, existing rows are kept
 def insert_departments():
-    for dep_id, name, desc, count in departments:
-        if not Department.query.filter_by(department_id=dep_id).first():
-            db.session.add(Department(
-                department_id=dep_id,
-                department_name=name,
-                department_description=desc,
-                doctors_registered=count
-            ))
-            db.session.commit()
+    db.session.execute(conflict_insert(Department.__table__), [
+        dict(
+            department_id=dep_id,
+            department_name=name,
+            department_description=desc,
+            doctors_registered=count
+        )
+        for dep_id, name, desc, count in departments
+    ])
+    db.session.commit()
 
 def insert_doctors():
-    for did, dname, dep, spec in doctors:
-        if not Doctor.query.filter_by(doctor_id=did).first():
-            db.session.add(Doctor(
-                doctor_id=did,
-                doctor_name=dname,
-                department_id=dep,
-                specialization=spec
-            ))
-            db.session.commit()
\ No newline at end of file
+    db.session.execute(conflict_insert(Doctor.__table__), [
+        dict(
+            doctor_id=did,
+            doctor_name=dname,
+            department_id=dep,
+            specialization=spec
+        )
+        for did, dname, dep, spec in doctors
+    ])
+    db.session.commit()
\ No newline at end of file
@@ -0,0 +1,170 @@
+import bisect
+import threading
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+from flask import current_app
+from sqlalchemy import select
+from config import db
+from models import Appointment, Appointment_status
+from catalog import catalog
+from branches import PerBranch
+from slots import Slot, day_slots, slot_label, working_templates
+from versions import versions
+
+# "Next available slot" across a department. For each department the
+# upcoming slots of all its doctors are laid out on one time axis, and each
+# doctor gets two bitsets over it (Python ints, bit i = slot i): the slots the
+# doctor works and the slots already booked. The booked bits come from one
+# query over the department's appointments in the horizon. Free slots are
+# `works & ~booked`, so finding the earliest ones is a few big-int operations
+# however many doctors and days there are.
+#
+# A matrix is kept per process and department. Bookings and cancellations
+# patch it in place and increment the department's version counter, so the
+# other workers reload theirs (one query) on their next search. The partial
+# unique index on the slot still decides every booking.
+
+Opening = namedtuple('Opening', 'doctor slot')
+
+class Occupancy:
+    def __init__(self, start, doctors, templates, booked_rows, version):
+        self.start = start
+        self.version = version
+        self.doctors = doctors
+        days = current_app.config['SLOT_SEARCH_DAYS']
+
+        # time axis: every distinct (day, start, end) any doctor works
+        columns = set()
+        doctor_slots = []
+        for doctor in doctors:
+            mine = []
+            for offset in range(days):
+                day = start + timedelta(days=offset)
+                for s, e in day_slots(templates[doctor.doctor_id], day):
+                    mine.append((day, s, e))
+            columns.update(mine)
+            doctor_slots.append(mine)
+        self.columns = sorted(columns)
+        self.starts = [datetime.combine(day, s) for day, s, _ in self.columns]
+        position = {column: i for i, column in enumerate(self.columns)}
+        self.by_label = {(day, slot_label(s, e)): i for (day, s, e), i in position.items()}
+
+        self.rows = {doctor.doctor_key: r for r, doctor in enumerate(doctors)}
+        self.works = [0] * len(doctors)
+        for r, mine in enumerate(doctor_slots):
+            for column in mine:
+                self.works[r] |= 1 << position[column]
+        self.booked = [0] * len(doctors)
+        for doctor_key, day, label in booked_rows:
+            self.patch(doctor_key, day, label, True)
+
+    def patch(self, doctor_key, day, label, booked):
+        r = self.rows.get(doctor_key)
+        i = self.by_label.get((day, label))
+        if r is None or i is None:
+            return
+        if booked:
+            self.booked[r] |= 1 << i
+        else:
+            self.booked[r] &= ~(1 << i)
+
+    # the first `limit` free (doctor, slot) pairs after `now`, by time, then doctor
+    def first_free(self, limit, now):
+        after = ~((1 << bisect.bisect_right(self.starts, now)) - 1)
+        free = [works & ~booked & after for works, booked in zip(self.works, self.booked)]
+        pending = 0
+        for bits in free:
+            pending |= bits
+        openings = []
+        while pending and len(openings) < limit:
+            lowest = pending & -pending
+            i = lowest.bit_length() - 1
+            day, s, e = self.columns[i]
+            for r, bits in enumerate(free):
+                if bits & lowest:
+                    openings.append(Opening(self.doctors[r], Slot(day, s, e)))
+                    if len(openings) == limit:
+                        break
+            pending ^= lowest
+        return openings
+
+_lock = threading.Lock()
+# department_id -> Occupancy, per branch
+_matrices = PerBranch(dict)
+
+def _key(department_id):
+    return f"openings:{department_id}"
+
+# doctors (catalog) and bookings (global token and per-department counter)
+def _version(department_id):
+    return (catalog.version(), versions.get('openings'), versions.counter(_key(department_id)))
+
+def _load(department_id, start, version):
+    doctors = sorted(catalog.doctors_in(department_id), key=lambda doc: doc.doctor_id)
+    end = start + timedelta(days=current_app.config['SLOT_SEARCH_DAYS'] - 1)
+    keys = [doc.doctor_key for doc in doctors]
+    booked = db.session.execute(
+        select(Appointment.doctor_key, Appointment.date, Appointment.time)
+        .where(
+            Appointment.doctor_key.in_(keys),
+            Appointment.date >= start,
+            Appointment.date <= end,
+            Appointment.status != Appointment_status.Cancelled
+        )
+        .group_by(Appointment.doctor_key, Appointment.date, Appointment.time)
+    ).all() if keys else []
+    templates = working_templates([doc.doctor_id for doc in doctors])
+    return Occupancy(start, doctors, templates, booked, version)
+
+def occupancy(department_id):
+    start = date.today()
+    version = _version(department_id)
+    matrix = _matrices.get(department_id)
+    if matrix is None or matrix.start != start or matrix.version != version:
+        matrix = _load(department_id, start, version)
+        with _lock:
+            _matrices.current()[department_id] = matrix
+    return matrix
+
+# earliest free slots with any doctor of the department
+def next_available(department_id, limit=None):
+    limit = limit or current_app.config['SLOT_SEARCH_RESULTS']
+    return occupancy(department_id).first_free(limit, datetime.now())
+
+# Called after bookings or cancellations are committed. Patches this
+# process's matrices and moves the department's counter on. A matrix that
+# was current and whose counter this call moved by exactly one has seen
+# every change and is kept under the new count; otherwise another writer
+# got in between and the matrix is dropped, to be reloaded by the next
+# search.
+def _changed(appointments, booked):
+    by_department = {}
+    for appointment in appointments:
+        doctor = catalog.doctor_by_key(appointment.doctor_key)
+        if doctor is not None:
+            by_department.setdefault(doctor.department_id, []).append(appointment)
+    for department_id, changed in by_department.items():
+        before = _version(department_id)
+        count = versions.increment(_key(department_id))
+        with _lock:
+            matrix = _matrices.get(department_id)
+            if matrix is None:
+                continue
+            if matrix.version != before or count != before[2] + 1:
+                del _matrices.current()[department_id]
+                continue
+            for appointment in changed:
+                matrix.patch(appointment.doctor_key, appointment.date, appointment.time, booked)
+            matrix.version = before[:2] + (count,)
+
+def booked(appointment):
+    _changed([appointment], True)
+
+def released(appointments):
+    _changed(appointments, False)
+
+# after bulk writes that may touch any department
+def invalidate_all():
+    versions.bump('openings')
+    with _lock:
+        _matrices.clear()
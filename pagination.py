@@ -0,0 +1,121 @@
+import base64
+import binascii
+import json
+from datetime import date
+from enum import Enum
+from sqlalchemy import literal, tuple_
+
+PER_PAGE = 25
+
+# a single page of rows plus the opaque cursors pointing either side of it
+class Page:
+    def __init__(self, items, sort, direction, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.sort = sort
+        self.direction = direction
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+def _dump(value):
+    if isinstance(value, Enum):
+        return value.name
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+def _load(column, value):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if value is None:
+        return None
+    if issubclass(python_type, Enum):
+        return python_type[value]
+    if issubclass(python_type, date):
+        return date.fromisoformat(value)
+    return value
+
+def encode_cursor(mark, values):
+    raw = json.dumps({mark: [_dump(v) for v in values]}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(token):
+    if not token:
+        return None, None
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        mark, values = next(iter(payload.items()))
+    except (ValueError, TypeError, StopIteration, binascii.Error):
+        return None, None
+    if mark not in ('after', 'before') or not isinstance(values, list):
+        return None, None
+    return mark, values
+
+# Keyset (seek) pagination: instead of OFFSET, every page filters on the
+# (sort column, primary key) of the last row seen, so page N costs the same
+# index range scan as page 1.
+# `key` maps a result row to its (sort, key) values when rows are not plain
+# model instances, e.g. for multi-entity queries
+def keyset_paginate(query, sort_column, key_column, cursor=None, descending=False, per_page=PER_PAGE, key=None):
+    columns = [key_column] if sort_column is key_column else [sort_column, key_column]
+    mark, values = decode_cursor(cursor)
+    if values is not None and len(values) != len(columns):
+        mark, values = None, None
+    # a tampered cursor whose values do not fit the columns is the first page too
+    if values is not None:
+        try:
+            values = [_load(col, v) for col, v in zip(columns, values)]
+        except (ValueError, KeyError, TypeError):
+            mark, values = None, None
+
+    backwards = mark == 'before'
+    reverse = backwards != descending
+
+    if values is not None:
+        values = [literal(v, col.type) for col, v in zip(columns, values)]
+        row = tuple_(*columns) if len(columns) > 1 else columns[0]
+        bound = tuple_(*values) if len(values) > 1 else values[0]
+        query = query.filter(row < bound if reverse else row > bound)
+
+    query = query.order_by(*[col.desc() if reverse else col.asc() for col in columns])
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backwards:
+        rows.reverse()
+
+    def key_of(obj):
+        if key is not None:
+            return key(obj)[-len(columns):]
+        return [getattr(obj, col.key) for col in columns]
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or backwards:
+            next_cursor = encode_cursor('after', key_of(rows[-1]))
+        if (has_more and backwards) or (mark == 'after'):
+            prev_cursor = encode_cursor('before', key_of(rows[0]))
+
+    return Page(rows, sort_column.key, 'desc' if descending else 'asc', next_cursor, prev_cursor)
+
+# reads <prefix>_sort / <prefix>_dir / <prefix>_cursor from the query string
+def paginate_from_args(query, args, prefix, sorts, key_column, default_sort, per_page=PER_PAGE):
+    sort = args.get(prefix + '_sort', default_sort)
+    if sort not in sorts:
+        sort = default_sort
+    descending = args.get(prefix + '_dir') == 'desc'
+    page = keyset_paginate(
+        query, sorts[sort], key_column,
+        cursor=args.get(prefix + '_cursor'),
+        descending=descending,
+        per_page=per_page
+    )
+    page.sort = sort
+    return page
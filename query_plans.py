@@ -0,0 +1,129 @@
+import re
+from contextlib import contextmanager
+import click
+from sqlalchemy import event
+from config import app, db
+from models import Patient, Doctor, Department, Appointment, Medicine
+
+# tables that grow with hospital traffic; catalog tables (department, doctor)
+# are small and are listed in full on purpose
+HOT_TABLES = {'patient', 'appointment', 'treatment', 'treatment_medicine', 'waitlist'}
+
+# "SCAN x" since SQLite 3.36, "SCAN TABLE x" before
+FULL_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+# records EXPLAIN QUERY PLAN for every SELECT (WITH ... SELECT too) the engine runs inside the block
+@contextmanager
+def capture_plans(engine):
+    plans = []
+
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+            probe = conn.connection.dbapi_connection.cursor()
+            try:
+                probe.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+                plans.append((statement, [row[3] for row in probe.fetchall()]))
+            finally:
+                probe.close()
+
+    event.listen(engine, 'before_cursor_execute', explain)
+    try:
+        yield plans
+    finally:
+        event.remove(engine, 'before_cursor_execute', explain)
+
+# an unfiltered page read in index order (no WHERE, no sort step) stops
+# after LIMIT rows, so its SCAN is not a full one
+def bounded_scan(statement, plan):
+    return (
+        re.search(r'\bLIMIT\b', statement) is not None
+        and re.search(r'\bWHERE\b', statement) is None
+        and not any('TEMP B-TREE' in detail for detail in plan)
+    )
+
+def full_scans(statement, plan):
+    if bounded_scan(statement, plan):
+        return []
+    scans = []
+    for detail in plan:
+        match = FULL_SCAN.match(detail)
+        if match and match.group(1) in HOT_TABLES:
+            scans.append(detail)
+    return scans
+
+# (route, method, url, form data, session) for every route that filters a hot table
+def route_requests():
+    patient = Patient.query.first()
+    doctor = Doctor.query.first()
+    department = Department.query.first()
+    appointment = Appointment.query.first()
+    medicine = Medicine.query.first()
+
+    admin_session = {'user_type': 'admin', 'admin': 'Admin'}
+    requests = [
+        ('admin_dashboard', 'GET', '/admin', None, admin_session),
+        ('admin_reports', 'GET', '/admin/reports', None, admin_session),
+    ]
+    if patient:
+        patient_session = {'user_type': 'patient', 'patient_id': patient.patient_id, 'patient_name': patient.patient_name}
+        requests += [
+            ('login', 'POST', '/login', {'username': patient.patient_name, 'password': patient.password}, {}),
+            ('register', 'POST', '/register', {'username': patient.patient_name, 'password': 'x'}, {}),
+            ('view_appointment', 'GET', '/view_appointment', None, patient_session),
+            ('waitlist_page', 'GET', '/waitlist', None, patient_session),
+            ('history', 'GET', f'/history/{patient.patient_id}', None, patient_session),
+            ('past_history', 'GET', f'/past_history/{patient.patient_id}', None, {}),
+            ('patient_history', 'GET', f'/patient_history/{patient.patient_id}', None, {}),
+        ]
+    if doctor:
+        doctor_session = {'user_type': 'doctor', 'doctor_id': doctor.doctor_id, 'doctor_name': doctor.doctor_name}
+        requests += [
+            ('login', 'POST', '/login', {'username': doctor.doctor_name, 'password': 'doctor'}, {}),
+            ('doctor_dashboard', 'GET', '/doctor', None, doctor_session),
+            ('doctor_availability', 'GET', '/doc_availability', None, doctor_session),
+            ('check_availability', 'GET', f'/availability?doctor_id={doctor.doctor_id}', None, {}),
+            ('search_records', 'GET', '/doctor/search?q=a&mine=1', None, doctor_session),
+            ('admin_export', 'GET', f'/admin/export/appointments?doctor={doctor.doctor_name}', None, admin_session),
+        ]
+    if department:
+        requests += [
+            ('view_doctors', 'GET', f'/view_doctors/{department.department_id}', None, {}),
+            ('next_available', 'GET', f'/next_available/{department.department_id}', None, {}),
+        ]
+    if appointment:
+        requests.append(('start_treatment', 'GET', f'/start_treatment/{appointment.appointment_id}', None, {}))
+    requests.append(('admin_medicines', 'GET', '/admin/medicines?q=a', None, admin_session))
+    if medicine:
+        requests.append(('medicine_patients', 'GET', f'/admin/medicines/{medicine.medicine_id}', None, admin_session))
+    return requests
+
+def check_routes():
+    failures = []
+    client = app.test_client()
+    for route, method, url, data, session in route_requests():
+        with client.session_transaction() as sess:
+            sess.clear()
+            sess.update(session)
+        with capture_plans(db.engine) as plans:
+            response = client.open(url, method=method, data=data)
+            # streamed bodies (exports) run their queries as they are read
+            response.get_data()
+        # a route that errors out never got to the queries worth checking
+        if not 200 <= response.status_code < 400:
+            failures.append((route, f"HTTP {response.status_code}", f"{method} {url}"))
+        for statement, plan in plans:
+            for detail in full_scans(statement, plan):
+                failures.append((route, detail, ' '.join(statement.split())))
+    return failures
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if a route errors or a route query falls back to a full scan of a hot table."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('EXPLAIN QUERY PLAN checks need a SQLite database')
+    failures = check_routes()
+    for route, detail, statement in failures:
+        click.echo(f"{route}: {detail}\n    {statement}", err=True)
+    if failures:
+        raise click.ClickException(f"{len(failures)} failed route(s) or full table scan(s) found")
+    click.echo("no full table scans")
@@ -0,0 +1,131 @@
+import re
+import click
+from flask.cli import AppGroup
+from sqlalchemy import Float, Integer, and_, column, func, literal, literal_column, or_, select, table, text, union_all
+from config import app, db
+from models import Patient
+from archive import SOURCES
+from pagination import keyset_paginate
+
+# Full-text index over the free-text treatment columns. On SQLite it is an
+# FTS5 table whose rowid is the appointment id, kept in step with `treatment`
+# by triggers, so start_treatment, bulk imports and deletes all update it in
+# the same transaction as the row itself. Archiving a treatment keeps its
+# entry. Other databases fall back to LIKE.
+
+COLUMNS = ['test_done', 'diagnosis', 'prescription', 'medicines']
+# bm25 weight per column: a hit in the diagnosis or medicines counts double
+WEIGHTS = [1.0, 2.0, 1.0, 2.0]
+
+PER_PAGE = 20
+
+fts = table('treatment_fts', column('rowid', Integer), *[column(name) for name in COLUMNS])
+
+def available(bind=None):
+    return (bind or db.engine).dialect.name == 'sqlite'
+
+def _fts_statements():
+    new_values = ', '.join(f"new.{name}" for name in COLUMNS)
+    names = ', '.join(COLUMNS)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS treatment_fts USING fts5({names}, tokenize='porter unicode61')",
+        f"""CREATE TRIGGER IF NOT EXISTS treatment_fts_insert AFTER INSERT ON treatment BEGIN
+            INSERT INTO treatment_fts(rowid, {names}) VALUES (new.appointment_id, {new_values});
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS treatment_fts_delete AFTER DELETE ON treatment
+        WHEN NOT EXISTS (SELECT 1 FROM treatment_archive WHERE appointment_id = old.appointment_id) BEGIN
+            DELETE FROM treatment_fts WHERE rowid = old.appointment_id;
+        END""",
+        f"""CREATE TRIGGER IF NOT EXISTS treatment_fts_update AFTER UPDATE ON treatment BEGIN
+            DELETE FROM treatment_fts WHERE rowid = old.appointment_id;
+            INSERT INTO treatment_fts(rowid, {names}) VALUES (new.appointment_id, {new_values});
+        END""",
+    ]
+
+# creates the index and (re)creates its triggers
+def install(conn):
+    if not available(conn):
+        return
+    conn.execute(text("DROP TRIGGER IF EXISTS treatment_fts_delete"))
+    for statement in _fts_statements():
+        conn.execute(text(statement))
+
+# installs the index, then refills it from the live and archived treatments
+def rebuild(conn):
+    if not available(conn):
+        return
+    install(conn)
+    names = ', '.join(COLUMNS)
+    conn.execute(text("DELETE FROM treatment_fts"))
+    for _, treatment in SOURCES:
+        conn.execute(text(
+            f"INSERT INTO treatment_fts(rowid, {names}) SELECT appointment_id, {names} FROM {treatment.__tablename__}"
+        ))
+    conn.execute(text("INSERT INTO treatment_fts(treatment_fts) VALUES ('optimize')"))
+
+# words of the search box -> FTS5 query: every word must match, as a prefix
+def match_expression(terms):
+    words = re.findall(r'\w+', terms.lower())
+    return ' AND '.join(f'"{word}"*' for word in words)
+
+# (appointment_id, score) of every matching treatment, lower score ranks higher
+def _matches(terms):
+    if available():
+        return (
+            select(
+                fts.c.rowid.label('appointment_id'),
+                func.bm25(literal_column('treatment_fts'), *WEIGHTS, type_=Float).label('score')
+            )
+            .where(literal_column('treatment_fts').op('MATCH')(match_expression(terms)))
+            .cte('matches')
+            .prefix_with('MATERIALIZED')
+        )
+    words = re.findall(r'\w+', terms.lower())
+    return union_all(*[
+        select(treatment.appointment_id, literal(0.0, Float).label('score'))
+        .where(and_(*[
+            or_(*[getattr(treatment, name).ilike(f"%{word}%") for name in COLUMNS])
+            for word in words
+        ]))
+        for _, treatment in SOURCES
+    ]).cte('matches')
+
+# Best matches first, one page at a time, live and archived records alike.
+# `doctor_name` limits the search to that doctor's own appointments.
+def search_treatments(terms, cursor=None, doctor_name=None, per_page=PER_PAGE):
+    matches = _matches(terms)
+    arms = []
+    for appointment, treatment in SOURCES:
+        arm = (
+            select(
+                matches.c.score, treatment.appointment_id, treatment.patient_id, Patient.patient_name,
+                appointment.date, appointment.doctor_name, *[getattr(treatment, name) for name in COLUMNS]
+            )
+            .select_from(matches)
+            .join(treatment, treatment.appointment_id == matches.c.appointment_id)
+            .join(appointment, appointment.appointment_id == treatment.appointment_id)
+            .outerjoin(Patient, Patient.patient_key == treatment.patient_key)
+        )
+        if doctor_name:
+            arm = arm.where(appointment.doctor_name == doctor_name)
+        arms.append(arm)
+    results = union_all(*arms).subquery('results')
+    return keyset_paginate(
+        db.session.query(results), results.c.score, results.c.appointment_id,
+        cursor=cursor, per_page=per_page,
+        key=lambda row: [row.score, row.appointment_id]
+    )
+
+search_cli = AppGroup('search', help='Maintain the treatment search index.')
+
+@search_cli.command('rebuild')
+def rebuild_command():
+    """Recreate the treatment search index from the treatment table."""
+    if not available():
+        raise click.ClickException("the search index needs SQLite FTS5; other databases search with LIKE")
+    with db.engine.begin() as conn:
+        rebuild(conn)
+        count = conn.execute(text("SELECT count(*) FROM treatment_fts")).scalar()
+    click.echo(f"indexed {count} treatments")
+
+app.cli.add_command(search_cli)
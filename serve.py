@@ -0,0 +1,37 @@
+import os
+import click
+from config import app
+
+# `flask serve`: the production server, gunicorn with the settings of
+# gunicorn.conf.py, which the options below override.
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+
+@app.cli.command('serve')
+@click.option('--bind', '-b', help='Address to listen on (default: WEB_BIND or 127.0.0.1:8000).')
+@click.option('--workers', '-w', type=int, help='Worker processes (default: WEB_CONCURRENCY or one per CPU).')
+@click.option('--threads', '-t', type=int, help='Threads per worker (default: WEB_THREADS or 4).')
+def serve_command(bind, workers, threads):
+    """Serve the app with gunicorn worker processes."""
+    try:
+        from gunicorn.app.base import Application
+    except ImportError:
+        raise click.ClickException("serving needs gunicorn (pip install gunicorn), which runs on Linux and macOS")
+
+    overrides = {'bind': bind, 'workers': workers, 'threads': threads}
+
+    class HMSApplication(Application):
+        def init(self, parser, opts, args):
+            pass
+
+        def load_config(self):
+            self.load_config_from_file(CONFIG_FILE)
+            for key, value in overrides.items():
+                if value is not None:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            from app import create_app
+            return create_app()
+
+    HMSApplication(usage=None).run()
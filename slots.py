@@ -0,0 +1,136 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+from config import db
+from models import Appointment, Appointment_status, DoctorSchedule
+from stats import appointment_booked
+from keys import patient_key
+
+# default working-hours template: Monday to Saturday, two sessions, one-hour slots
+SLOT_MINUTES = 60
+WORKING_DAYS = range(0, 6)
+WORKING_HOURS = [("09:00", "13:00"), ("16:00", "20:00")]
+HORIZON_DAYS = 7
+
+def _parse(hhmm):
+    return datetime.strptime(hhmm, "%H:%M").time()
+
+# appointment.time keeps the label format the booking form has always used
+def slot_label(start, end):
+    return "{} to {}".format(
+        start.strftime("%I:%M %p").lstrip("0"),
+        end.strftime("%I:%M %p").lstrip("0")
+    )
+
+class Slot:
+    def __init__(self, day, start, end, booked=False):
+        self.day = day
+        self.start = start
+        self.end = end
+        self.label = slot_label(start, end)
+        self.booked = booked
+
+    @property
+    def past(self):
+        return datetime.combine(self.day, self.start) <= datetime.now()
+
+    @property
+    def available(self):
+        return not self.booked and not self.past
+
+# {doctor_id: {weekday: [(start, end, slot_minutes), ...]}} for some doctors, one query
+def working_templates(doctor_ids):
+    templates = {doctor_id: {} for doctor_id in doctor_ids}
+    for row in DoctorSchedule.query.filter(DoctorSchedule.doctor_id.in_(templates)):
+        templates[row.doctor_id].setdefault(row.weekday, []).append(
+            (_parse(row.start_time), _parse(row.end_time), row.slot_minutes)
+        )
+    for template in templates.values():
+        if not template:
+            for weekday in WORKING_DAYS:
+                template[weekday] = [(_parse(s), _parse(e), SLOT_MINUTES) for s, e in WORKING_HOURS]
+        for sessions in template.values():
+            sessions.sort()
+    return templates
+
+# {weekday: [(start, end, slot_minutes), ...]} for one doctor
+def working_template(doctor_id):
+    return working_templates([doctor_id])[doctor_id]
+
+def day_slots(template, day):
+    slots = []
+    for start, end, minutes in template.get(day.weekday(), []):
+        cursor = datetime.combine(day, start)
+        stop = datetime.combine(day, end)
+        step = timedelta(minutes=minutes)
+        while cursor + step <= stop:
+            slots.append((cursor.time(), (cursor + step).time()))
+            cursor += step
+    return slots
+
+# per-day occupancy index {date: {slot label, ...}} for one doctor, built in a single query
+def occupancy(doctor_key, start, end):
+    rows = (
+        db.session.query(Appointment.date, Appointment.time)
+        .filter(
+            Appointment.doctor_key == doctor_key,
+            Appointment.date >= start,
+            Appointment.date <= end,
+            Appointment.status != Appointment_status.Cancelled
+        )
+        .all()
+    )
+    index = {}
+    for day, label in rows:
+        index.setdefault(day, set()).add(label)
+    return index
+
+# [(day, [Slot, ...]), ...] for the next `days` days
+def availability(doctor, start=None, days=HORIZON_DAYS):
+    start = start or date.today()
+    end = start + timedelta(days=days - 1)
+    template = working_template(doctor.doctor_id)
+    taken = occupancy(doctor.doctor_key, start, end)
+
+    chart = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        booked = taken.get(day, set())
+        chart.append((day, [
+            Slot(day, s, e, booked=slot_label(s, e) in booked)
+            for s, e in day_slots(template, day)
+        ]))
+    return chart
+
+def default_slot_labels():
+    day = date.today()
+    template = {day.weekday(): [(_parse(s), _parse(e), SLOT_MINUTES) for s, e in WORKING_HOURS]}
+    return [slot_label(s, e) for s, e in day_slots(template, day)]
+
+def is_valid_slot(doctor, day, label):
+    for s, e in day_slots(working_template(doctor.doctor_id), day):
+        if slot_label(s, e) == label:
+            return not Slot(day, s, e).past
+    return False
+
+# Claims a slot with a plain INSERT. The partial unique index on
+# (doctor_key, date, time) rejects a second live appointment for the same
+# slot, so two concurrent bookings cannot both succeed. Returns None on conflict.
+def claim_slot(appointment_id, patient_id, doctor, day, label):
+    appointment = Appointment(
+        appointment_id=appointment_id,
+        patient_id=patient_id,
+        patient_key=patient_key(patient_id),
+        doctor_name=doctor.doctor_name,
+        doctor_key=doctor.doctor_key,
+        date=day,
+        time=label,
+        status=Appointment_status.Booked
+    )
+    try:
+        db.session.add(appointment)
+        appointment_booked(appointment)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return None
+    return appointment
@@ -0,0 +1,261 @@
+from collections import Counter
+import click
+from flask.cli import AppGroup
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.orm.attributes import set_committed_value
+from config import app, db
+from archive import all_appointments
+from bulk import dialect_insert
+from catalog import catalog
+from models import Patient, Doctor, Appointment, Appointment_status, AppointmentStat, StatCounter
+
+# Every helper here only adds statements to the current session; the
+# caller's commit makes the counters and the change they describe land in
+# the same transaction.
+
+# statistics key of appointments whose doctor was gone before keys were added
+NO_DOCTOR = 0
+
+def _bump_stat(day, doctor_key, doctor_name, status, delta):
+    stmt = dialect_insert(AppointmentStat.__table__).values(
+        date=day, doctor_key=NO_DOCTOR if doctor_key is None else doctor_key,
+        doctor_name=doctor_name, status=status, count=delta
+    )
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['date', 'doctor_key', 'status'],
+        set_={'count': AppointmentStat.__table__.c.count + stmt.excluded['count']}
+    ))
+
+def _bump_counter(name, delta):
+    stmt = dialect_insert(StatCounter.__table__).values(name=name, value=delta)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['name'],
+        set_={'value': StatCounter.__table__.c.value + stmt.excluded['value']}
+    ))
+
+def appointment_booked(appointment):
+    _bump_stat(appointment.date, appointment.doctor_key, appointment.doctor_name, appointment.status, 1)
+    _bump_counter('appointments', 1)
+
+# Moves a booked appointment to `status` (completed or cancelled) with a
+# conditional UPDATE so that two concurrent requests cannot both count the
+# same transition. Returns False when the appointment was not booked: a
+# cancelled slot may have been booked again since, and reviving the old
+# appointment would double-book it.
+def set_status(appointment, status):
+    old = appointment.status
+    if old != Appointment_status.Booked or status == old:
+        return False
+    changed = db.session.execute(
+        update(Appointment)
+        .where(Appointment.appointment_id == appointment.appointment_id, Appointment.status == old)
+        .values(status=status)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not changed:
+        return False
+    set_committed_value(appointment, 'status', status)
+    _bump_stat(appointment.date, appointment.doctor_key, appointment.doctor_name, old, -1)
+    _bump_stat(appointment.date, appointment.doctor_key, appointment.doctor_name, status, 1)
+    return True
+
+# set_status for many appointments at once: the booked ones among `rows`,
+# the appointments' (appointment_id, date, doctor_key, doctor_name, status)
+# as read in this transaction, get one UPDATE and one statistics bump per day and
+# doctor. Returns the ids that changed: a row another request moved in the
+# meantime is left alone, as in set_status. Without UPDATE ... RETURNING
+# the rows must have been read FOR UPDATE.
+def set_statuses(rows, status):
+    booked = Appointment_status.Booked
+    group = [row for row in rows if row.status == booked]
+    if not group or status == booked:
+        return set()
+
+    stmt = (
+        update(Appointment)
+        .where(Appointment.appointment_id.in_([row.appointment_id for row in group]), Appointment.status == booked)
+        .values(status=status)
+        .execution_options(synchronize_session=False)
+    )
+    if db.engine.dialect.update_returning:
+        ids = set(db.session.execute(stmt.returning(Appointment.appointment_id)).scalars())
+    else:
+        db.session.execute(stmt)
+        ids = {row.appointment_id for row in group}
+    changed = [row for row in group if row.appointment_id in ids]
+
+    deltas = Counter()
+    for row in changed:
+        deltas[(row.date, row.doctor_key, row.doctor_name)] += 1
+    for (day, doctor_key, doctor_name), delta in deltas.items():
+        _bump_stat(day, doctor_key, doctor_name, booked, -delta)
+        _bump_stat(day, doctor_key, doctor_name, status, delta)
+    return {row.appointment_id for row in changed}
+
+def patient_added():
+    _bump_counter('patients', 1)
+
+def patient_removed():
+    _bump_counter('patients', -1)
+
+def doctor_added():
+    _bump_counter('doctors', 1)
+
+def doctor_removed():
+    _bump_counter('doctors', -1)
+
+def totals():
+    values = dict(db.session.query(StatCounter.name, StatCounter.value))
+    return {name: values.get(name, 0) for name in ('doctors', 'patients', 'appointments')}
+
+# ground truth, computed from the live and archived tables
+def _actual_stats():
+    appointments = all_appointments(columns=['date', 'doctor_key', 'doctor_name', 'status'])
+    doctor_key = func.coalesce(appointments.c.doctor_key, NO_DOCTOR)
+    return select(
+        appointments.c.date, doctor_key, func.max(appointments.c.doctor_name), appointments.c.status, func.count()
+    ).group_by(appointments.c.date, doctor_key, appointments.c.status)
+
+def _actual_counters(conn):
+    return {
+        'doctors': conn.execute(select(func.count()).select_from(Doctor)).scalar(),
+        'patients': conn.execute(select(func.count()).select_from(Patient)).scalar(),
+        'appointments': conn.execute(
+            select(func.count()).select_from(all_appointments(columns=['appointment_id']))
+        ).scalar(),
+    }
+
+def refresh_counters(conn):
+    conn.execute(delete(StatCounter))
+    conn.execute(insert(StatCounter), [
+        {'name': name, 'value': value} for name, value in _actual_counters(conn).items()
+    ])
+
+# recomputes every aggregate from scratch on an open connection/transaction
+def rebuild(conn):
+    conn.execute(delete(AppointmentStat))
+    conn.execute(insert(AppointmentStat).from_select(
+        ['date', 'doctor_key', 'doctor_name', 'status', 'count'], _actual_stats()
+    ))
+    refresh_counters(conn)
+
+# list of (what, stored, actual) for every aggregate that has drifted
+def verify(conn):
+    names = {}
+    stored = {}
+    for day, doctor, name, status, count in conn.execute(select(
+        AppointmentStat.date, AppointmentStat.doctor_key, AppointmentStat.doctor_name,
+        AppointmentStat.status, AppointmentStat.count
+    )):
+        names[doctor] = name
+        if count:
+            stored[(day, doctor, status)] = count
+    actual = {}
+    for day, doctor, name, status, count in conn.execute(_actual_stats()):
+        names[doctor] = name
+        actual[(day, doctor, status)] = count
+    drift = [
+        (f"{day} {names[doctor]} {status.name}", stored.get((day, doctor, status), 0), actual.get((day, doctor, status), 0))
+        for day, doctor, status in sorted(set(stored) | set(actual), key=lambda k: (k[0], k[1], k[2].name))
+        if stored.get((day, doctor, status), 0) != actual.get((day, doctor, status), 0)
+    ]
+    counters = dict(conn.execute(select(StatCounter.name, StatCounter.value)).all())
+    for name, value in _actual_counters(conn).items():
+        if counters.get(name, 0) != value:
+            drift.append((name, counters.get(name, 0), value))
+    return drift
+
+# --- reporting, reads only the aggregate tables (doctor -> department via the catalog cache)
+
+def status_columns():
+    return [status.name for status in Appointment_status]
+
+def _pivot(rows):
+    table = {}
+    for key, status, count in rows:
+        table.setdefault(key, dict.fromkeys(status_columns(), 0))[status.name] += count
+    return table
+
+def by_day(start, end):
+    return sorted(_pivot(
+        db.session.query(AppointmentStat.date, AppointmentStat.status, func.sum(AppointmentStat.count))
+        .filter(AppointmentStat.date >= start, AppointmentStat.date <= end)
+        .group_by(AppointmentStat.date, AppointmentStat.status)
+    ).items())
+
+# [(doctor_key, doctor_name, counts)], by name
+def by_doctor(start, end):
+    rows = _pivot(
+        ((doctor_key, doctor_name), status, count)
+        for doctor_key, doctor_name, status, count in db.session.query(
+            AppointmentStat.doctor_key, AppointmentStat.doctor_name,
+            AppointmentStat.status, func.sum(AppointmentStat.count)
+        )
+        .filter(AppointmentStat.date >= start, AppointmentStat.date <= end)
+        .group_by(AppointmentStat.doctor_key, AppointmentStat.doctor_name, AppointmentStat.status)
+    )
+    return sorted(((key, name, counts) for (key, name), counts in rows.items()), key=lambda row: (row[1], row[0]))
+
+def by_department(doctor_rows):
+    departments = {}
+    for doctor_key, _, counts in doctor_rows:
+        doctor = catalog.doctor_by_key(doctor_key)
+        name = doctor.department.department_name if doctor and doctor.department else 'Unknown'
+        row = departments.setdefault(name, dict.fromkeys(status_columns(), 0))
+        for status, count in counts.items():
+            row[status] += count
+    return sorted(departments.items())
+
+# one branch's share of the cross-branch report
+def summary(start, end):
+    doctor_rows = by_doctor(start, end)
+    period = dict.fromkeys(status_columns(), 0)
+    for _, _, counts in doctor_rows:
+        for status, count in counts.items():
+            period[status] += count
+    return {
+        'totals': totals(),
+        'period': period,
+        'departments': dict(by_department(doctor_rows)),
+        'days': dict(by_day(start, end)),
+    }
+
+def _add(into, counts):
+    for name, count in counts.items():
+        into[name] = into.get(name, 0) + count
+    return into
+
+# sums the summaries of several branches; departments match by name
+def merge(summaries):
+    merged = {'totals': {}, 'period': {}, 'departments': {}, 'days': {}}
+    for branch_summary in summaries:
+        _add(merged['totals'], branch_summary['totals'])
+        _add(merged['period'], branch_summary['period'])
+        for table in ('departments', 'days'):
+            for key, counts in branch_summary[table].items():
+                _add(merged[table].setdefault(key, dict.fromkeys(status_columns(), 0)), counts)
+    merged['departments'] = sorted(merged['departments'].items())
+    merged['days'] = sorted(merged['days'].items())
+    return merged
+
+stats_cli = AppGroup('stats', help='Maintain the appointment statistics tables.')
+
+@stats_cli.command('rebuild')
+def rebuild_command():
+    """Recompute all statistics from the live tables."""
+    with db.engine.begin() as conn:
+        rebuild(conn)
+    click.echo("statistics rebuilt")
+
+@stats_cli.command('verify')
+def verify_command():
+    """Compare the statistics with the live tables."""
+    with db.engine.connect() as conn:
+        drift = verify(conn)
+    for what, stored, actual in drift:
+        click.echo(f"{what}: stored {stored}, actual {actual}", err=True)
+    if drift:
+        raise click.ClickException(f"{len(drift)} statistic(s) out of date, run `flask stats rebuild`")
+    click.echo("statistics are up to date")
+
+app.cli.add_command(stats_cli)
@@ -0,0 +1,145 @@
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+from flask import current_app
+from sqlalchemy import func, select, union_all
+from config import db
+from models import Patient
+from archive import SOURCES
+from pagination import keyset_paginate
+from branches import PerBranch
+from versions import versions
+
+TimelineEntry = namedtuple(
+    'TimelineEntry',
+    'appointment_id date time doctor_name test_done diagnosis prescription medicines'
+)
+TimelinePatient = namedtuple('TimelinePatient', 'patient_id patient_name')
+TimelineSummary = namedtuple('TimelineSummary', 'visits last_visit latest_diagnosis')
+
+class Timeline:
+    def __init__(self, patient, summary, page):
+        self.patient = patient
+        self.summary = summary
+        self.page = page
+
+# every treated visit of the patient, live and archived, as TimelineEntry columns
+def _visits(patient_key, name='visits'):
+    # filtering both sides on patient_key lets each arm use its (patient_key, ...) index
+    return union_all(*[
+        select(
+            appointment.appointment_id, appointment.date, appointment.time, appointment.doctor_name,
+            treatment.test_done, treatment.diagnosis, treatment.prescription, treatment.medicines
+        )
+        .join(appointment, treatment.appointment_id == appointment.appointment_id)
+        .where(treatment.patient_key == patient_key, appointment.patient_key == patient_key)
+        for appointment, treatment in SOURCES
+    ]).subquery(name)
+
+def _summary(patient_key):
+    visits = _visits(patient_key)
+    newest = _visits(patient_key, 'newest')
+    latest = (
+        select(newest.c.diagnosis)
+        .order_by(newest.c.date.desc(), newest.c.appointment_id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    count, last_visit, latest_diagnosis = db.session.execute(select(
+        func.count(),
+        func.max(visits.c.date),
+        latest
+    ).select_from(visits)).one()
+    return TimelineSummary(count, last_visit, latest_diagnosis)
+
+def _page(patient_key, cursor, per_page):
+    visits = _visits(patient_key)
+    page = keyset_paginate(
+        db.session.query(visits),
+        visits.c.date, visits.c.appointment_id,
+        cursor=cursor, descending=True, per_page=per_page,
+        key=lambda row: [row.date, row.appointment_id]
+    )
+    page.items = [TimelineEntry(*row) for row in page.items]
+    return page
+
+# The newest page and summary of recently viewed patients, kept per process
+# in a bounded LRU. Entries carry the version token of the patient's bucket,
+# which start_treatment bumps, so every worker drops a stale timeline.
+class TimelineCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, patient_id, version):
+        with self._lock:
+            entry = self._entries.get(patient_id)
+            if entry is None or entry[0] != version:
+                return None
+            self._entries.move_to_end(patient_id)
+            return entry[1]
+
+    def put(self, patient_id, version, timeline):
+        with self._lock:
+            self._entries[patient_id] = (version, timeline)
+            self._entries.move_to_end(patient_id)
+            while len(self._entries) > current_app.config['TIMELINE_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+
+    def discard(self, patient_id):
+        with self._lock:
+            self._entries.pop(patient_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+cache = PerBranch(TimelineCache)
+
+# Patients share VERSION_BUCKETS tokens, so the shared backend holds a fixed
+# number of keys however many patients are treated; a treatment also drops
+# the cached timelines of the other patients in its bucket.
+VERSION_BUCKETS = 64
+
+def _key(patient_id):
+    return f"timeline:{zlib.crc32(patient_id.encode()) % VERSION_BUCKETS}"
+
+def _version(patient_id):
+    return versions.get(_key(patient_id))
+
+# Treatment history of one patient, newest first, one page at a time.
+# Returns None when the patient does not exist.
+def patient_timeline(patient_id, cursor=None):
+    per_page = current_app.config['TIMELINE_PER_PAGE']
+    version = None
+    if not cursor:
+        version = _version(patient_id)
+        cached = cache.get(patient_id, version)
+        if cached is not None:
+            return cached
+
+    row = db.session.execute(
+        select(Patient.patient_key, Patient.patient_id, Patient.patient_name)
+        .where(Patient.patient_id == patient_id)
+    ).first()
+    if row is None:
+        return None
+
+    timeline = Timeline(
+        TimelinePatient(row.patient_id, row.patient_name),
+        _summary(row.patient_key), _page(row.patient_key, cursor, per_page)
+    )
+    if not cursor:
+        cache.put(patient_id, version, timeline)
+    return timeline
+
+# called after a treatment for the patient is committed
+def invalidate_timeline(patient_id):
+    versions.bump(_key(patient_id))
+    cache.discard(patient_id)
+
+# called after bulk writes that may touch any patient
+def invalidate_all_timelines():
+    for bucket in range(VERSION_BUCKETS):
+        versions.bump(f"timeline:{bucket}")
+    cache.clear()
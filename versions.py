@@ -0,0 +1,146 @@
+import os
+import re
+import threading
+import time
+try:
+    import fcntl
+except ImportError:  # Windows, where the app runs as a single process
+    fcntl = None
+from flask import current_app
+from config import current_branch
+
+# Version tokens shared between worker processes. A cache remembers the token
+# it was filled under and refills once the token changes; writers bump the
+# token after committing. get() returns None for a key never bumped, bump()
+# returns the new token. increment() treats the token as a counter and
+# returns its new value atomically, so a writer can tell whether anyone
+# else changed the key since it last read it.
+
+def new_token():
+    return f"{time.time_ns()}-{os.getpid()}"
+
+_increment_lock = threading.Lock()
+
+# a counter token as an int; keys never incremented (or holding a bump()
+# token) count as 0
+def _count(token):
+    try:
+        return int(token)
+    except (TypeError, ValueError):
+        return 0
+
+# tokens held in this process only (single worker, or tests)
+class LocalVersions:
+    def __init__(self):
+        self.tokens = {}
+
+    def get(self, key):
+        return self.tokens.get(key)
+
+    def bump(self, key):
+        token = self.tokens[key] = new_token()
+        return token
+
+    def increment(self, key):
+        with _increment_lock:
+            value = self.tokens[key] = _count(self.tokens.get(key)) + 1
+        return value
+
+# one small file per key, shared by every worker on the host
+class FileVersions:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_.-]', '_', key))
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path, token):
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, 'w') as f:
+            f.write(token)
+        os.replace(tmp, path)
+
+    def bump(self, key):
+        os.makedirs(self.directory, exist_ok=True)
+        token = new_token()
+        self._write(self._path(key), token)
+        return token
+
+    # read-modify-write under an flock on a lock file next to the token, so
+    # readers still only ever see whole files
+    def increment(self, key):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        with _increment_lock, open(path + '.lock', 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            value = _count(self.get(key)) + 1
+            self._write(path, str(value))
+        return value
+
+# tokens in redis, shared by every worker on every host
+class RedisVersions:
+    def __init__(self, url, prefix='hms:version:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND is a redis:// url but the redis package is not installed")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def bump(self, key):
+        token = new_token()
+        self.client.set(self.prefix + key, token)
+        return token.encode()  # what get() reads back
+
+    def increment(self, key):
+        return self.client.incr(self.prefix + key)
+
+def make_backend(setting):
+    if setting == 'local':
+        return LocalVersions()
+    if setting == 'file':
+        return FileVersions(os.path.join(current_app.instance_path, 'versions'))
+    if setting.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisVersions(setting)
+    raise RuntimeError(f"unknown CACHE_BACKEND {setting!r}")
+
+# resolves the configured backend on first use
+class Versions:
+    def __init__(self):
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = make_backend(current_app.config['CACHE_BACKEND'])
+        return self._backend
+
+    # each branch has its own tokens; the main branch keeps the plain keys
+    def _scoped(self, key):
+        branch = current_branch()
+        return key if branch == current_app.config['MAIN_BRANCH'] else f"{branch}:{key}"
+
+    def get(self, key):
+        return self.backend.get(self._scoped(key))
+
+    def bump(self, key):
+        return self.backend.bump(self._scoped(key))
+
+    def counter(self, key):
+        return _count(self.get(key))
+
+    def increment(self, key):
+        return self.backend.increment(self._scoped(key))
+
+versions = Versions()
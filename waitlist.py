@@ -0,0 +1,189 @@
+from datetime import date
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, select, text, union_all, update
+from config import app, db
+from models import Appointment, Appointment_status, WaitlistEntry, Waitlist_status
+from bulk import dialect_insert
+from catalog import catalog
+from ids import next_appointment_id
+from keys import patient_key
+from slots import is_valid_slot
+from stats import appointment_booked, set_status
+
+# Waitlist for fully booked doctors and departments. A patient queues for one
+# doctor or for any doctor of a department, on any day in a range. When an
+# appointment is cancelled, backfill() books the freed slot for the waiter
+# who joined first, in the same transaction as the cancellation: each queue
+# is an index in priority order, so picking the waiter is two short index
+# walks however long the waitlist is.
+
+# waiters tried when another cancellation takes the one we picked
+CLAIM_ATTEMPTS = 3
+
+# the first waiting entry of one queue that can take `appointment`'s slot
+def _queue(column, value, appointment):
+    return (
+        select(WaitlistEntry.entry_id, WaitlistEntry.patient_id, WaitlistEntry.created_at)
+        .where(
+            column == value,
+            WaitlistEntry.status == Waitlist_status.Waiting,
+            WaitlistEntry.start_date <= appointment.date,
+            WaitlistEntry.end_date >= appointment.date,
+            # whoever cancelled does not get the slot back
+            WaitlistEntry.patient_id != appointment.patient_id
+        )
+        .order_by(WaitlistEntry.created_at, WaitlistEntry.entry_id)
+        .limit(1)
+        .subquery()
+        .select()
+    )
+
+# (entry_id, patient_id, created_at) of the best-ranked waiter for the slot
+# of `appointment` with `doctor`, or None
+def best_waiter(doctor, appointment):
+    waiters = union_all(
+        _queue(WaitlistEntry.doctor_name, doctor.doctor_name, appointment),
+        _queue(WaitlistEntry.department_id, doctor.department_id, appointment),
+    ).subquery('waiters')
+    return db.session.execute(
+        select(*waiters.c).order_by(waiters.c.created_at, waiters.c.entry_id).limit(1)
+    ).first()
+
+# Books the slot of a just-cancelled appointment for the best-ranked waiter,
+# as appointment `appointment_id`. Only adds statements to the session: the
+# caller's commit makes the cancellation, the new appointment and the
+# fulfilled entry land together. The id must be taken before the transaction
+# writes anything, since on SQLite reserving a block of ids from inside it
+# would wait on its own lock. Returns the new appointment, or None when
+# nobody is waiting, the slot is past, or it was booked again meanwhile.
+def backfill(appointment, appointment_id):
+    doctor = catalog.doctor_by_key(appointment.doctor_key)
+    if doctor is None or not is_valid_slot(doctor, appointment.date, appointment.time):
+        return None
+
+    for _ in range(CLAIM_ATTEMPTS):
+        waiter = best_waiter(doctor, appointment)
+        if waiter is None:
+            return None
+        claimed = db.session.execute(
+            update(WaitlistEntry)
+            .where(WaitlistEntry.entry_id == waiter.entry_id, WaitlistEntry.status == Waitlist_status.Waiting)
+            .values(status=Waitlist_status.Fulfilled, appointment_id=appointment_id)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if claimed:
+            break
+    else:
+        return None
+
+    replacement = Appointment(
+        appointment_id=appointment_id,
+        patient_id=waiter.patient_id,
+        doctor_name=appointment.doctor_name,
+        doctor_key=doctor.doctor_key,
+        date=appointment.date,
+        time=appointment.time,
+        status=Appointment_status.Booked
+    )
+    # the partial unique index on the slot still decides, as in claim_slot
+    inserted = db.session.execute(
+        dialect_insert(Appointment.__table__)
+        .values(
+            appointment_id=replacement.appointment_id, patient_id=replacement.patient_id,
+            patient_key=patient_key(replacement.patient_id),
+            doctor_name=replacement.doctor_name, doctor_key=replacement.doctor_key, date=replacement.date,
+            time=replacement.time, status=replacement.status
+        )
+        .on_conflict_do_nothing(
+            index_elements=['doctor_key', 'date', 'time'],
+            index_where=text("status != 'Cancelled'")
+        )
+    ).rowcount
+    if not inserted:
+        # the waiter keeps their place for the next cancellation
+        db.session.execute(
+            update(WaitlistEntry)
+            .where(WaitlistEntry.entry_id == waiter.entry_id)
+            .values(status=Waitlist_status.Waiting, appointment_id=None)
+            .execution_options(synchronize_session=False)
+        )
+        return None
+    appointment_booked(replacement)
+    return replacement
+
+# Cancels one appointment and backfills its slot, in the caller's
+# transaction. Returns (whether it was cancelled, the new appointment or None).
+def cancel(appointment):
+    appointment_id = next_appointment_id()
+    if not set_status(appointment, Appointment_status.Cancelled):
+        return False, None
+    return True, backfill(appointment, appointment_id)
+
+def open_entries(patient_id):
+    return db.session.execute(
+        select(func.count())
+        .select_from(WaitlistEntry)
+        .where(WaitlistEntry.patient_id == patient_id, WaitlistEntry.status == Waitlist_status.Waiting)
+    ).scalar()
+
+# the patient's entries, newest first
+def entries(patient_id, limit=50):
+    return (
+        WaitlistEntry.query
+        .filter_by(patient_id=patient_id)
+        .order_by(WaitlistEntry.created_at.desc(), WaitlistEntry.entry_id.desc())
+        .limit(limit)
+        .all()
+    )
+
+def join(patient_id, start, end, doctor_name=None, department_id=None):
+    entry = WaitlistEntry(
+        patient_id=patient_id, doctor_name=doctor_name, department_id=department_id,
+        start_date=start, end_date=end, status=Waitlist_status.Waiting
+    )
+    db.session.add(entry)
+    return entry
+
+# False when the entry is not the patient's or no longer waiting
+def withdraw(patient_id, entry_id):
+    return bool(db.session.execute(
+        update(WaitlistEntry)
+        .where(
+            WaitlistEntry.entry_id == entry_id,
+            WaitlistEntry.patient_id == patient_id,
+            WaitlistEntry.status == Waitlist_status.Waiting
+        )
+        .values(status=Waitlist_status.Withdrawn)
+        .execution_options(synchronize_session=False)
+    ).rowcount)
+
+# Withdraws the waiting entries for a doctor who is being deleted, in the
+# caller's transaction; a later doctor of the same name must not inherit them.
+def withdraw_doctor(doctor_name):
+    return db.session.execute(
+        update(WaitlistEntry)
+        .where(WaitlistEntry.doctor_name == doctor_name, WaitlistEntry.status == Waitlist_status.Waiting)
+        .values(status=Waitlist_status.Withdrawn)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+# Closes entries whose range has passed. They can never be given a slot, but
+# they sit at the front of their queue and every backfill would step over them.
+def expire(conn, today=None):
+    return conn.execute(
+        update(WaitlistEntry)
+        .where(WaitlistEntry.status == Waitlist_status.Waiting, WaitlistEntry.end_date < (today or date.today()))
+        .values(status=Waitlist_status.Expired)
+    ).rowcount
+
+waitlist_cli = AppGroup('waitlist', help='Maintain the appointment waitlist.')
+
+@waitlist_cli.command('expire')
+def expire_command():
+    """Close waitlist entries whose day range is over (run daily)."""
+    with db.engine.begin() as conn:
+        count = expire(conn)
+    click.echo(f"expired {count} waitlist entries")
+
+app.cli.add_command(waitlist_cli)
@@ -0,0 +1,6 @@
+# WSGI entry point for production servers, e.g.
+#   gunicorn -c gunicorn.conf.py wsgi:application
+# or `flask --app app serve`, which runs the same thing.
+from app import create_app
+
+application = create_app()